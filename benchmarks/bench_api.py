@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+### Drive the API in-process the way the react-admin frontend does (lists,
+### filters, sorts, ranges, getOne and history across quarters) against the
+### local stand-in backend (lib/local) seeded with synthetic data, and
+### report latency percentiles, throughput and peak RSS for each scenario.
+### Query execution in the stand-in is part of every timing, so compare runs
+### with each other rather than with production.
+###   python benchmarks/bench_api.py [--users N] [--days N] [--requests N] [--json FILE]
+import argparse
+import os
+import random
+import resource
+import statistics
+import string
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.parse import quote
+
+### Configuration is read at import time, so this has to happen before
+### anything from the package is imported
+os.environ['CLEXFA_LOCAL_BACKEND'] = ':memory:'
+os.environ.setdefault('REMOTE_CMD_HOST','gadi')
+os.environ.setdefault('CLEXFA_AUTH_SECRET','benchmark')
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','src','clex_functional_accounting','function'))
+
+from werkzeug.test import Client
+
+from clex_functional_accounting.lib import auth, blob, cosmosdb, quarters, serialise, storage_snapshot
+from clex_functional_accounting.ingest_tools.update_nci_account import summarise_compute
+
+FILESYSTEMS=[ 'scratch', 'gdata' ]
+
+def _name(rng: random.Random, n: int) -> str:
+    return ''.join(rng.choices(string.ascii_lowercase,k=n))
+
+def _ts(t: datetime) -> str:
+    return t.isoformat(timespec='microseconds') + "Z"
+
+def _container(db_writer: cosmosdb.CosmosDBWriter, name: str, quarterly: bool=False):
+    return db_writer.get_container(name,cosmosdb.DATABASE_ID,quarterly=quarterly)
+
+def seed(args, rng: random.Random, now: datetime) -> dict:
+
+    ### Users and projects as the blobs written by update_users_and_projects
+    projects = sorted({ _name(rng,2) + str(rng.randint(0,99)) for _ in range(args.projects*2) })[:args.projects]
+    users = { f"{_name(rng,3)}{i:03d}": { 'uid': 10000+i,
+                                           'gid': 10000+i,
+                                           'pw_name': f"{_name(rng,6).title()} {_name(rng,8).title()}",
+                                           'home': f"/home/{i%1000}/u{i}",
+                                           'groups': rng.sample(projects,k=rng.randint(1,4)) } for i in range(args.users) }
+    groups = { p: { 'gid': 20000+i, 'users': [] } for i,p in enumerate(projects) }
+    for user,d in users.items():
+        for p in d['groups']:
+            groups[p]['users'].append(user)
+
+    blob_writer = blob.get_shared_writer()
+    blob_writer.write_item(users,blob.CONTAINER,'users')
+    blob_writer.write_item(groups,blob.CONTAINER,'groups')
+    blob_writer.write_item(projects,blob.CONTAINER,'projectlist')
+
+    db_writer = cosmosdb.get_shared_writer()
+    ts = _ts(now)
+
+    ### Latest values, one row per (user, project) plus each project's total
+    compute_latest=[]
+    files_latest=[]
+    for user,d in users.items():
+        for p in d['groups']:
+            compute_latest.append({ 'id': f"gadi_{user}_{p}", 'ts': ts, 'project': p, 'system': 'gadi', 'user': user, 'usage': round(rng.random()*1e5,2) })
+            for fs in FILESYSTEMS:
+                files_latest.append({ 'id': f"gadi_{fs}_{user}_{p}_{p}", 'ts': ts, 'fs': fs, 'user': user, 'ownership': p, 'location': p,
+                                      'size': rng.randint(0,2**40), 'inodes': rng.randint(0,2**20), 'system': 'gadi' })
+    for p in projects:
+        compute_latest.append({ 'id': f"gadi_total_{p}", 'ts': ts, 'project': p, 'system': 'gadi', 'user': 'total', 'usage': sum( i['usage'] for i in compute_latest if i['project'] == p ) })
+    storage_latest = [ { 'id': f"gadi_{fs}_{p}", 'ts': ts, 'project': p, 'fs': fs, 'system': 'gadi',
+                         'usage': rng.randint(0,2**44), 'quota': 2**44, 'limit': 2**45,
+                         'iusage': rng.randint(0,2**22), 'iquota': 2**22, 'ilimit': 2**23 } for p in projects for fs in FILESYSTEMS ]
+
+    for name,rows in ( ('compute_latest',compute_latest), ('files_report_latest',files_latest), ('storage_latest',storage_latest), ('compute_summary',summarise_compute(compute_latest,ts)) ):
+        _ = _container(db_writer,name)
+        for row in rows:
+            db_writer.create_item(name,row)
+
+    ### History, written straight to the container so each row lands in
+    ### the partition for its own quarter
+    compute = _container(db_writer,'compute',True)
+    files_report = _container(db_writer,'files_report',True)
+    storage = _container(db_writer,'storage',True)
+    history_users = list(users)[:args.history_users]
+    history_projects = projects[:args.history_projects]
+    start = now - timedelta(days=args.days)
+    t = start.replace(hour=0,minute=25,second=3,microsecond=0)
+    usage = {}
+    quarter = None
+    while t < now:
+        q = quarters.quarter(t)
+        if q != quarter:
+            ### Compute usage is cumulative over a quarter
+            usage = {}
+            quarter = q
+        for user in history_users:
+            p = users[user]['groups'][0]
+            usage[user] = usage.get(user,0.0) + round(rng.random()*100,2)
+            compute.create_item(body={ 'id': f"{user}_{p}_{t.isoformat()}", 'ts': _ts(t), 'project': p, 'system': 'gadi', 'user': user, 'usage': usage[user], 'PartitionKey': q })
+            if t.hour == 0:
+                files_report.create_item(body={ 'id': f"{user}_{p}_{t.isoformat()}", 'ts': _ts(t), 'fs': 'scratch', 'user': user, 'ownership': p, 'location': p,
+                                                'size': rng.randint(0,2**40), 'inodes': rng.randint(0,2**20), 'system': 'gadi', 'PartitionKey': q })
+        for p in history_projects:
+            for fs in FILESYSTEMS:
+                storage.create_item(body={ 'id': f"{p}_{fs}_{t.isoformat()}", 'ts': _ts(t), 'project': p, 'fs': fs, 'system': 'gadi',
+                                           'usage': rng.randint(0,2**44), 'quota': 2**44, 'limit': 2**45,
+                                           'iusage': rng.randint(0,2**22), 'iquota': 2**22, 'ilimit': 2**23, 'PartitionKey': q })
+        t = t + timedelta(hours=6)
+
+    storage_snapshot.publish(blob_writer,files_latest,storage_latest,ts,[ 'compute', 'storage', 'files_report', 'lquota', 'massdata' ])
+    blob_writer.mark_ingest([ 'compute', 'storage', 'files_report', 'lquota', 'massdata' ],ts)
+
+    return { 'users': list(users), 'projects': projects, 'history_users': history_users, 'history_projects': history_projects }
+
+def _q(path: str, **params) -> str:
+    ### filter, sort and range are JSON encoded, anything else is sent as is
+    return path + '?' + '&'.join( f"{k}={quote(v if isinstance(v,str) else serialise.dumps_str(v))}" for k,v in params.items() )
+
+def scenarios(data: dict, now: datetime, rng: random.Random) -> dict:
+    ### Each scenario returns a new URL every call, shaped like the requests
+    ### react-admin makes for that view
+    def days_ago(n: int) -> str:
+        return _ts(now - timedelta(days=n))
+    def history_user() -> str:
+        return rng.choice(data['history_users'])
+    return {
+        'users list': lambda: _q('/api/v0/users',sort=['id','ASC'],range=[0,24]),
+        'users filter': lambda: _q('/api/v0/users',filter={'id':rng.choice(data['users'])[:2]},sort=['id','ASC'],range=[0,24]),
+        'users getOne': lambda: f"/api/v0/users/{rng.choice(data['users'])}",
+        'groups list': lambda: _q('/api/v0/groups',sort=['id','ASC'],range=[0,24]),
+        'compute_latest list': lambda: _q('/api/v0/compute_latest',sort=['usage','DESC'],range=[0,24]),
+        'compute_latest page 5': lambda: _q('/api/v0/compute_latest',sort=['usage','DESC'],range=[100,124]),
+        'compute_latest filter': lambda: _q('/api/v0/compute_latest',filter={'project':rng.choice(data['projects'])},sort=['usage','DESC'],range=[0,24]),
+        'compute_latest getOne': lambda: f"/api/v0/compute_latest/{rng.choice(data['users'])}",
+        'compute 30 days': lambda: _q('/api/v0/compute',filter={'user':history_user(),'ts':[days_ago(30),days_ago(0)]},sort=['ts','ASC'],range=[0,199]),
+        'compute 1 year': lambda: _q('/api/v0/compute',filter={'user':history_user(),'ts':[days_ago(365),days_ago(0)]},sort=['ts','ASC'],range=[0,1999]),
+        'compute_rollup week': lambda: _q('/api/v0/compute_rollup',filter={'user':history_user(),'ts':[days_ago(365),days_ago(0)]},bucket='week'),
+        'storage_latest list': lambda: _q('/api/v0/storage_latest',sort=['size','DESC'],range=[0,24]),
+        'storage_latest filter': lambda: _q('/api/v0/storage_latest',filter={'ownership':rng.choice(data['projects'])},sort=['size','DESC'],range=[0,24]),
+        'storage_project_latest': lambda: _q('/api/v0/storage_project_latest',sort=['usage','DESC'],range=[0,24]),
+        'storage 180 days': lambda: _q('/api/v0/storage',filter={'ownership':rng.choice(data['history_projects']),'ts':[days_ago(180),days_ago(0)]},sort=['ts','ASC'],range=[0,999]),
+    }
+
+def rss_mb() -> float:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/2**20
+    except OSError:
+        ### Peak rather than current, but all that's available here
+        scale = 2**20 if sys.platform == 'darwin' else 2**10
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/scale
+
+class PeakRSS():
+    ### Samples RSS in the background while a scenario runs
+    def __init__(self, interval: float=0.005):
+        self.interval = interval
+        self.peak = 0.0
+        self.running = False
+
+    def _run(self):
+        while self.running:
+            self.peak = max(self.peak,rss_mb())
+            time.sleep(self.interval)
+
+    def __enter__(self) -> "PeakRSS":
+        self.peak = rss_mb()
+        self.running = True
+        self.thread = threading.Thread(target=self._run,daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.running = False
+        self.thread.join()
+        self.peak = max(self.peak,rss_mb())
+
+def run_scenario(client: Client, headers: dict, make_url, n: int, concurrency: int) -> dict:
+
+    def one(url: str) -> float:
+        start = time.perf_counter()
+        response = client.get(url,headers=headers)
+        response.get_data()
+        elapsed = time.perf_counter() - start
+        if response.status_code != 200:
+            raise RuntimeError(f"{url} returned {response.status_code}")
+        return elapsed
+
+    urls = [ make_url() for _ in range(n) ]
+    with PeakRSS() as rss:
+        start = time.perf_counter()
+        if concurrency > 1:
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                latencies = list(pool.map(one,urls))
+        else:
+            latencies = [ one(url) for url in urls ]
+        wall = time.perf_counter() - start
+
+    cuts = statistics.quantiles(latencies,n=100,method='inclusive')
+    return { 'n': n,
+             'p50': cuts[49]*1000,
+             'p95': cuts[94]*1000,
+             'p99': cuts[98]*1000,
+             'rps': n/wall,
+             'rss': rss.peak }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users',type=int,default=5000)
+    parser.add_argument('--projects',type=int,default=200)
+    parser.add_argument('--days',type=int,default=730,help="Length of history to generate")
+    parser.add_argument('--history-users',type=int,default=50,help="Users with 6-hourly compute history")
+    parser.add_argument('--history-projects',type=int,default=10,help="Projects with 6-hourly storage history")
+    parser.add_argument('--requests',type=int,default=200,help="Requests per scenario")
+    parser.add_argument('--warmup',type=int,default=5,help="Untimed requests per scenario")
+    parser.add_argument('--concurrency',type=int,default=1)
+    parser.add_argument('--only',action='append',help="Only run scenarios containing this string")
+    parser.add_argument('--json',help="Also write the results to this file")
+    parser.add_argument('--seed',type=int,default=0)
+    args = parser.parse_args()
+
+    ### Imported here so the environment set up above is in place
+    import function_app
+
+    rng = random.Random(args.seed)
+    now = datetime.now()
+
+    t = time.perf_counter()
+    data = seed(args,rng,now)
+    print(f"Seeded in {time.perf_counter()-t:.1f}s, RSS {rss_mb():.0f}MB",file=sys.stderr)
+
+    client = Client(function_app.werkzeug_app)
+    headers = { 'Authorization': auth.issue_token() }
+
+    results = {}
+    print(f"{'scenario':<24} {'n':>5} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'req/s':>8} {'peak RSS':>9}")
+    for name,make_url in scenarios(data,now,rng).items():
+        if args.only and not any( i in name for i in args.only ):
+            continue
+        for _ in range(args.warmup):
+            client.get(make_url(),headers=headers).get_data()
+        r = run_scenario(client,headers,make_url,args.requests,args.concurrency)
+        results[name] = r
+        print(f"{name:<24} {r['n']:>5} {r['p50']:>8.2f} {r['p95']:>8.2f} {r['p99']:>8.2f} {r['rps']:>8.1f} {r['rss']:>7.0f}MB")
+
+    if args.json:
+        with open(args.json,'wb') as f:
+            f.write(serialise.dumps({ 'args': vars(args), 'results': results }))
+
+if __name__ == "__main__":
+    main()
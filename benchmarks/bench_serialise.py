@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+### Compare the JSON backends available to lib.serialise on payloads shaped
+### like the ones the API and ingest tools handle.
+###   python benchmarks/bench_serialise.py [--scale N]
+import argparse
+import random
+import string
+import timeit
+import uuid
+
+from clex_functional_accounting.lib import serialise
+
+def _name(n: int) -> str:
+    return ''.join(random.choices(string.ascii_lowercase,k=n))
+
+def users_blob(n: int) -> dict:
+    projects=[ _name(2) + str(random.randint(0,99)) for _ in range(200) ]
+    return { f"{_name(3)}{i:03d}": { 'uid': 10000+i,
+                                     'gid': 10000+i,
+                                     'pw_name': f"{_name(6).title()} {_name(8).title()}",
+                                     'home': f"/home/{i%1000}/{_name(3)}{i:03d}",
+                                     'groups': random.sample(projects,k=random.randint(1,12)) } for i in range(n) }
+
+def compute_rows(n: int) -> list:
+    return [ { 'id': str(uuid.uuid4()),
+               'ts': f"2024-0{random.randint(1,9)}-{random.randint(10,28)}T{random.choice(['00','06','12','18'])}:25:03.123456Z",
+               'project': _name(2) + str(random.randint(0,99)),
+               'system': 'gadi',
+               'user': _name(3) + str(random.randint(100,999)),
+               'usage': round(random.random()*1e6,2) } for _ in range(n) ]
+
+def files_report(n: int) -> list:
+    return [ { 'uid': random.randint(10000,20000),
+               'gid': random.randint(10000,20000),
+               'project': _name(2) + str(random.randint(0,99)),
+               'blocks': { 'single': random.randint(0,2**40), 'multiple': random.randint(0,2**20) },
+               'count': { 'single': random.randint(0,2**24), 'multiple': random.randint(0,2**10) } } for _ in range(n) ]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scale',type=float,default=1.0,help="Multiply payload sizes by this")
+    parser.add_argument('--repeat',type=int,default=5)
+    args = parser.parse_args()
+
+    random.seed(0)
+    payloads = {
+        'users blob': users_blob(int(5000*args.scale)),
+        'compute page': compute_rows(int(20000*args.scale)),
+        'files report': files_report(int(50000*args.scale)),
+    }
+
+    print(f"{'payload':<14} {'size':>9} {'backend':<8} {'dumps ms':>9} {'loads ms':>9} {'speedup':>8}")
+    for name, payload in payloads.items():
+        encoded = serialise.BACKENDS['json'][0](payload)
+        baseline = None
+        for backend, (dumps, loads) in serialise.BACKENDS.items():
+            t_dumps = min(timeit.repeat(lambda: dumps(payload),number=1,repeat=args.repeat))*1000
+            t_loads = min(timeit.repeat(lambda: loads(encoded),number=1,repeat=args.repeat))*1000
+            if baseline is None:
+                baseline = t_dumps + t_loads
+            print(f"{name:<14} {len(encoded)/2**20:>7.1f}MB {backend:<8} {t_dumps:>9.1f} {t_loads:>9.1f} {baseline/(t_dumps+t_loads):>7.1f}x")
+    print(f"lib.serialise is using '{serialise.BACKEND}'")
+
+if __name__ == "__main__":
+    main()
@@ -3,33 +3,87 @@
 from werkzeug.wrappers import Request, Response
 from werkzeug.routing import Map, Rule
 from werkzeug.exceptions import HTTPException, NotFound
-from clex_functional_accounting.lib import cosmosdb,blob,group_list
-import json
+from clex_functional_accounting.lib import cosmosdb,blob,group_list,auth,config,serialise,storage_snapshot,storage_series,compute_series,quarters,timing,latest
+from clex_functional_accounting.lib.cache import TTLCache
+import contextvars
 import hashlib
+import heapq
+import itertools
 import os
+import time
 import uuid
+import zlib
 
-from datetime import datetime, timedelta
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 
 import azure.functions as func
 import azure.cosmos.exceptions as cosmos_exceptions
 
-from typing import Any, Dict, List, Union
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 one_hour=timedelta(hours=1)
-four_weeks=timedelta(weeks=4)
 
 STANDARD_HEADERS= {
-        'Cache-Control': 'public'
+        'Cache-Control': 'private'
     }
 
+### Where the data served by each endpoint comes from. Blob sources are
+### validated by the blob's ETag, the rest by the time of their last ingest
+ENDPOINT_SOURCES = {
+    'api_get_users': [ 'users', 'projectlist' ],
+    'api_get_groups': [ 'groups', 'projectlist' ],
+    'api_get_compute_latest': [ 'compute' ],
+    'api_get_compute': [ 'compute' ],
+    'api_get_compute_rollup': [ 'compute' ],
+    'api_get_storage_latest': [ 'storage', 'files_report' ],
+    'api_get_storage_project_latest': [ 'storage' ],
+    'api_get_storage': [ 'storage', 'files_report' ],
+}
+BLOB_SOURCES=[ 'users', 'groups', 'projectlist' ]
+
+### (period in hours, first hour, minute) in UTC of the ingest jobs that
+### update each source. Keep in sync with the schedules in .github/workflows
+INGEST_SCHEDULES = {
+    'users': [ (6,0,5), ],
+    'groups': [ (6,0,5), ],
+    'projectlist': [ (6,0,5), ],
+    'compute': [ (6,0,25), ],
+    'storage': [ (6,0,15), (6,0,25) ],
+    'files_report': [ (24,22,5), ],
+}
+### How long after its scheduled start an ingest job may still be running,
+### or its results not yet visible through the blob cache
+INGEST_RUN_MARGIN=timedelta(hours=1)
+
+### In order of preference
+CONTENT_ENCODINGS=[ 'br', 'gzip' ] if brotli else [ 'gzip', ]
+### Bytes of JSON to accumulate before handing them on to be sent
+STREAM_CHUNK_SIZE=65536
+
+ROLLUP_BUCKETS=[ 'day', 'week', 'month' ]
+ROLLUP_FIELDS=[ 'id', 'bucket', 'ts', 'project', 'user', 'usage' ]
+
+### Fields served from each container, only these are read from Cosmos
+COMPUTE_FIELDS=[ 'id', 'ts', 'project', 'user', 'usage' ]
+STORAGE_FIELDS=[ 'id', 'ts', 'project', 'fs', 'usage', 'quota', 'limit', 'iusage', 'iquota', 'ilimit' ]
+FILES_REPORT_FIELDS=storage_snapshot.FILES_REPORT_FIELDS
+
 SUBSTRING_MATCH_FIELDS=[ 'id', 'pw_name' ]
 INTEGER_FIELDS=[ 'uid', 'gid' ]
 
-class Datetime_with_quarter(datetime):
-    def quarter(self):
-        return f"{self.year}.q{(self.month-1)//3+1}"
+### Bounds the number of partition queries in flight from this worker
+query_pool = ThreadPoolExecutor(max_workers=config.settings['query_concurrency'])
 
+### Continuation tokens for the next page of each recently served query,
+### so paging through a *_latest container picks up where the last page
+### left off rather than re-reading everything before it
+continuation_cache = TTLCache(config.settings['continuation_cache_ttl'],config.settings['continuation_cache_size'])
 
 def content_range_headers(who: str, start: int, end: int, total: int):
     return {
@@ -63,16 +117,311 @@ def filter_list(in_list: List[Dict[str,Any]],filt:Dict[str,Union[str,int,List]])
     else:
         return in_list
 
-def remove_internal_data(in_list: List[Dict[str,Any]]) -> List[Dict[str,Any]]:
-    return [ {k:v for k,v in i.items() if not k[0] == '_' } for i in in_list ]
-
 def remove_internal_data_single(in_dict: Dict[str,Any]) -> Dict[str,Any]:
     return {k:v for k,v in in_dict.items() if not k[0] == '_' }
 
+def encode_rows(rows: Iterable[Dict[str,Any]]) -> Iterator[bytes]:
+    ### Serialise rows to a JSON list one at a time, dropping internal
+    ### fields as we go, so only one chunk of output is held at once
+    buf = [ b'[', ]
+    size = 0
+    sep = b''
+    s = timing.span('serialise')
+    for row in rows:
+        with s:
+            chunk = serialise.dumps({k:v for k,v in row.items() if not k[0] == '_' })
+        buf.append(sep + chunk)
+        sep = b', '
+        size += len(chunk)
+        if size >= STREAM_CHUNK_SIZE:
+            yield b''.join(buf)
+            buf = []
+            size = 0
+    buf.append(b']')
+    yield b''.join(buf)
+
+def compress(chunks: Iterable[bytes], encoding: str) -> Iterator[bytes]:
+    if encoding == 'br':
+        compressor = brotli.Compressor()
+        process, finish = compressor.process, compressor.finish
+    else:
+        compressor = zlib.compressobj(6,zlib.DEFLATED,31)
+        process, finish = compressor.compress, compressor.flush
+    s = timing.span('compress')
+    for chunk in chunks:
+        with s:
+            out = process(chunk)
+        if out:
+            yield out
+    with s:
+        out = finish()
+    yield out
+
+def json_response(request: Request, rows: Iterable[Dict[str,Any]], headers: Dict[str,str]) -> Response:
+    ### Streams rows (which may be a generator) back as a JSON list,
+    ### compressed if the client allows it
+    body = encode_rows(rows)
+    headers = headers | { 'Vary': 'Accept-Encoding' }
+    encoding = request.accept_encodings.best_match(CONTENT_ENCODINGS)
+    if encoding:
+        body = compress(body,encoding)
+        headers = headers | { 'Content-Encoding': encoding }
+    return Response(body,content_type="application/json",headers=headers,direct_passthrough=True)
+
+def submit(fn: Callable, *args) -> Future:
+    ### Run fn on the query pool, in a copy of the caller's context so
+    ### that anything it does is timed as part of the caller's request
+    return query_pool.submit(contextvars.copy_context().run,fn,*args)
+
+def logged_body(app_iter: Iterable[bytes], endpoint: Optional[str], status: int, spans: List[timing.Span], start: float) -> Iterator[bytes]:
+    ### The Azure Functions WSGI adapter reads the body but never calls
+    ### close(), so log once the body has been read instead
+    try:
+        yield from app_iter
+    finally:
+        if hasattr(app_iter,'close'):
+            app_iter.close()
+        timing.log(endpoint,status,spans,time.perf_counter()-start)
+        timing.end()
+
+def fan_out(fn: Callable, args: Iterable) -> List[Any]:
+    ### Like map(), but runs each call on the query pool. Results are in the
+    ### same order as args
+    return [ f.result() for f in [ submit(fn,a) for a in args ] ]
+
+def prefetch(streams: List[Iterator]) -> List[Iterator]:
+    ### Pull the first page of every stream concurrently, the rest are
+    ### fetched as they are consumed
+    heads = fan_out(lambda it: list(itertools.islice(it,1)),streams)
+    return [ itertools.chain(head,it) for head,it in zip(heads,streams) ]
+
+def parse_order(order_str: Optional[str]) -> Tuple[Optional[str],bool]:
+    if not order_str:
+        return None, False
+    order_tuple = order_str.split(' ')
+    return order_tuple[0], len(order_tuple) == 2 and order_tuple[1] == "DESC"
+
+def projection(fields: List[str], order_str: Optional[str]) -> List[str]:
+    ### Rows from several partitions are merged on the sort field, so it
+    ### has to come back with them
+    field, _ = parse_order(order_str)
+    if field and field not in fields:
+        return fields + [ field, ]
+    return fields
+
+def partition_page_size(start: Optional[int], end: Optional[int], n: int) -> Optional[int]:
+    ### Enough rows per round trip that, for evenly spread data, each
+    ### partition only needs to be visited about once to fill the range
+    if end is None:
+        return None
+    return min(max(end-start+1,-(-(end+1)//max(n,1))),1000)
+
+def merge_partitions(streams: List[Iterator], order_str: Optional[str], start: Optional[int]=None, end: Optional[int]=None) -> Iterator:
+    ### Each stream must already be sorted by order_str. Rows are merged
+    ### lazily, so nothing past 'end' is ever pulled from the server and
+    ### rows before 'start' are discarded as they go past
+    field, reverse = parse_order(order_str)
+    if field:
+        merged = heapq.merge(*streams,key=lambda x: x[field],reverse=reverse)
+    else:
+        merged = itertools.chain(*streams)
+    if start is not None:
+        merged = itertools.islice(merged,start,end+1)
+    return merged
+
+def query_range(db_writer: cosmosdb.CosmosDBWriter, container: str, fields: List[str], where: cosmosdb.Filter, order_str: Optional[str], start: int, end: int) -> Tuple[List[Dict[str,Any]],int]:
+    ### Fetch rows start to end (inclusive) of a query along with the total
+    ### number of rows it would return
+    count_future = submit(db_writer.count,container,where)
+    signature = serialise.dumps_str([container,fields,where.key(),order_str])
+    page_size = max(end-start+1,0)
+
+    token = None
+    if start:
+        entry = continuation_cache.fresh(f"{signature}_{start}")
+        token = entry.data if entry else None
+
+    if start == 0 or token:
+        rows, next_token = db_writer.query_page(container,fields=fields,where=where,order=order_str,page_size=page_size,continuation=token)
+        if next_token:
+            continuation_cache.put(f"{signature}_{start+len(rows)}",None,next_token)
+    else:
+        ### Nothing to resume from, have the server skip to the start instead
+        rows = db_writer.query(container,fields=fields,where=where,order=order_str,offset=start,limit=page_size)
+
+    return rows, count_future.result()
+
+def seconds_until_next_ingest(sources: List[str], now: Optional[datetime]=None) -> int:
+    if not now:
+        now = datetime.now(timezone.utc)
+    midnight = now.replace(hour=0,minute=0,second=0,microsecond=0)
+    out=[]
+    for source in sources:
+        for period, hour, minute in INGEST_SCHEDULES[source]:
+            t = midnight + timedelta(hours=hour,minutes=minute)
+            while t <= now:
+                t = t + timedelta(hours=period)
+            out.append((t - now).total_seconds())
+    return int(min(out))
+
+def cache_max_age(sources: List[str], now: Optional[datetime]=None) -> int:
+    ### How long a client may reuse a response without revalidating. While
+    ### an ingest job may be running, or only just finished, the ETag can't
+    ### be relied on to have moved yet, so only as long as the blob cache
+    ### keeps the ingest state. Otherwise until the next job starts
+    if not now:
+        now = datetime.now(timezone.utc)
+    midnight = now.replace(hour=0,minute=0,second=0,microsecond=0)
+    for source in sources:
+        for period, hour, minute in INGEST_SCHEDULES[source]:
+            ### The most recent start, which can be yesterday's
+            t = midnight + timedelta(hours=hour-24,minutes=minute)
+            while t + timedelta(hours=period) <= now:
+                t = t + timedelta(hours=period)
+            if now - t < INGEST_RUN_MARGIN:
+                return int(min(blob.CACHE_TTL,seconds_until_next_ingest(sources,now)))
+    return seconds_until_next_ingest(sources,now)
+
+def bucket_start(day: str, bucket: str) -> str:
+    ### First day of the bucket containing 'day' (YYYY-MM-DD)
+    if bucket == "month":
+        return day[:8] + "01"
+    if bucket == "week":
+        d = datetime.fromisoformat(day)
+        return (d - timedelta(days=d.weekday())).date().isoformat()
+    return day
+
+def daily_last(db_writer: cosmosdb.CosmosDBWriter, where: cosmosdb.Filter, quarter: str) -> List[Dict[str,Any]]:
+    ### The last compute row of each day for every user and project. Usage
+    ### can go down (e.g. corrections), so this isn't the day's MAX(usage).
+    ### The server finds when each was taken, then the rows from those
+    ### times are fetched. Each ingest run stamps every row with the same
+    ### ts, so there are about as many of those times as days
+    group = { 'project': 'c.project', 'user': 'c.user', 'day': 'LEFT(c.ts,10)' }
+    last = db_writer.aggregate("compute",group,{ 'ts': 'MAX(c.ts)' },where=where,quarter=quarter)
+    if not last:
+        return []
+    usage={}
+    for row in db_writer.query("compute",[ 'project', 'user', 'ts', 'usage' ],where.copy().isin('ts',sorted(set([ i['ts'] for i in last ]))),quarter=quarter):
+        k = ( row['project'], row['user'], row['ts'] )
+        usage[k] = max(usage.get(k,row['usage']),row['usage'])
+    out=[]
+    for row in last:
+        k = ( row['project'], row['user'], row['ts'] )
+        if k in usage:
+            out.append(row | { 'usage': usage[k] })
+    return out
+
+def last_seen(container: str, rows: List[Dict[str,Any]]) -> List[Dict[str,Any]]:
+    ### *_latest documents keep the ts of their last change, serve the
+    ### time of the last ingest that saw them instead
+    ingest_state = blob.get_shared_writer().read_item(blob.CONTAINER,blob.INGEST_STATE,default={})
+    return latest.refresh(container,rows,ingest_state)
+
+def snapshot_row_matches(row: Dict[str,Any], filt: Dict[str,Union[str,int,List]]) -> bool:
+    ### Filter storage_latest snapshot rows the same way the queries on
+    ### files_report_latest and storage_latest did: quota rows only
+    ### respond to project, filesystem and system filters, and are left out
+    ### altogether when looking for a specific user
+    for k,v in filt.items():
+        vals = v if isinstance(v,List) else [ v, ]
+        if k == 'system':
+            ### Snapshots published before rows were projected kept 'system'
+            if row.get('_system',row.get('system',None)) not in vals: return False
+        elif k == 'PartitionKey':
+            if '1' not in vals: return False
+        elif row.get('_quota',False):
+            if k == 'user':
+                return False
+            elif k in ( 'ownership', 'location', 'fs' ):
+                if row[k] not in vals: return False
+        elif row.get(k,None) not in vals:
+            return False
+    return True
+
 def sanitize_time(time: str) -> datetime:
+    ### Naive UTC, like the timestamps that are stored and datetime.now()
+    ### that partitions are planned against
     if time.endswith('Z'):
-        return Datetime_with_quarter.fromisoformat(time[:-1])
-    return Datetime_with_quarter.fromisoformat(time)
+        return datetime.fromisoformat(time[:-1])
+    t = datetime.fromisoformat(time)
+    if t.tzinfo is not None:
+        t = t.astimezone(timezone.utc).replace(tzinfo=None)
+    return t
+
+def build_filter(filt: Dict[str,Union[str,int,List]], skip: Iterable[str]=()) -> cosmosdb.Filter:
+    ### Each field in filt must match (one of) the value(s) given for it
+    where = cosmosdb.Filter()
+    for k,v in filt.items():
+        if k in skip: continue
+        where.isin(k,v if isinstance(v,List) else [ v, ])
+    return where
+
+def quota_filter(filt: Dict[str,Union[str,int,List]]) -> Dict[str,Union[str,int,List]]:
+    ### The parts of a files_report filter that apply to storage entries
+    quota_filt={}
+    for k,v in filt.items():
+        if k in ( 'ownership', 'location' ):
+            quota_filt["project"] = v
+        elif k in ( 'fs', 'system', 'PartitionKey' ):
+            quota_filt[k] = v
+    return quota_filt
+
+def time_partitions(timestamps: Optional[Union[str,List[str]]]) -> List[quarters.Partition]:
+    ### The quarters that can hold rows matching a ts filter. Data is never
+    ### recorded at exactly the scheduled time, so match anything within the
+    ### hour either side of a time, or of an interval
+    if not timestamps:
+        return quarters.plan()
+    timelist = sorted([ sanitize_time(i) for i in ( timestamps if isinstance(timestamps,List) else [ timestamps, ] ) ])
+    return quarters.plan(timelist[0] - one_hour,timelist[-1] + one_hour)
+
+def series_partitions(timestamps: Optional[Union[str,List[str]]]) -> Tuple[List[quarters.Partition],datetime,Optional[datetime]]:
+    ### Change-only storage history (see lib/storage_series.py) only has a
+    ### row where something changed, so reach back far enough to find the
+    ### sample in force at the start of the time range. Returns the
+    ### partitions to read and the range itself
+    if not timestamps:
+        start, end = quarters.quarter_start(datetime.now()), None
+    else:
+        timelist = sorted([ sanitize_time(i) for i in ( timestamps if isinstance(timestamps,List) else [ timestamps, ] ) ])
+        start, end = timelist[0] - one_hour, timelist[-1] + one_hour
+    return quarters.plan(start - storage_series.MAX_AGE,end), start, end
+
+def within(where: cosmosdb.Filter, partition: quarters.Partition) -> cosmosdb.Filter:
+    ### where, restricted to the part of the partition's quarter being asked for
+    out = where.copy()
+    if partition.start is not None:
+        out.compare('ts','>',partition.start.isoformat())
+    if partition.end is not None:
+        out.compare('ts','<',partition.end.isoformat())
+    return out
+
+def packed_within(where: cosmosdb.Filter, partition: quarters.Partition) -> cosmosdb.Filter:
+    ### Like within(), for packed compute documents (see
+    ### lib/compute_series.py). ts is that of a document's last sample, and
+    ### period the day its first could have been taken
+    out = where.copy()
+    if partition.start is not None:
+        out.compare('ts','>',partition.start.isoformat())
+    if partition.end is not None:
+        out.compare('period','<',partition.end.isoformat())
+    return out
+
+def packed_filter(filt: Dict[str,Union[str,int,List]]) -> cosmosdb.Filter:
+    ### The parts of a compute filter that packed documents can be queried on
+    return build_filter(filt,skip=[ k for k in filt if k not in compute_series.SERIES_FIELDS ])
+
+def packed_rows(docs: List[List[Dict[str,Any]]], partitions: List[quarters.Partition], filt: Dict[str,Union[str,int,List]], fields: Optional[List[str]]=None) -> List[Dict[str,Any]]:
+    ### compute rows in the packed documents returned for each partition
+    ### that match filt, with only fields if given
+    rest = { k:( v if isinstance(v,List) else [ v, ] ) for k,v in filt.items() if k != "ts" and k not in compute_series.SERIES_FIELDS }
+    out=[]
+    for partition,partition_docs in zip(partitions,docs):
+        for row in compute_series.unpack(partition_docs,partition.start,partition.end):
+            if all( row.get(k,None) in v for k,v in rest.items() ):
+                out.append({ k:row[k] for k in fields if k in row } if fields else row)
+    return out
 
 
 class AccountingAPI(object):
@@ -86,6 +435,7 @@ class AccountingAPI(object):
         
         url_map.append(Rule(f'/api/v0/auth',endpoint="api_auth"))
         url_map.append(Rule(f'/api/v0/checkauth',endpoint="api_checkauth"))
+        url_map.append(Rule(f'/api/v0/logout',endpoint="api_logout"))
         self.url_map = Map(url_map)
 
     def error_404(self):
@@ -99,8 +449,15 @@ class AccountingAPI(object):
 
     def wsgi_app(self, environ, start_response):
         request = Request(environ)
+        ### Rows are fetched as the response is sent, so only time spent
+        ### up to here is in Server-Timing, the log line has the lot
+        spans = timing.begin()
+        start = time.perf_counter()
         response = self.dispatch_request(request)
-        return response(environ, start_response)
+        if isinstance(response,HTTPException):
+            response = response.get_response(environ)
+        response.headers['Server-Timing'] = timing.server_timing(spans,time.perf_counter()-start)
+        return logged_body(response(environ, start_response),environ.get('clexfa.endpoint',None),response.status_code,spans,start)
     
     def __call__(self, environ, start_response: Response):
         return self.wsgi_app(environ, start_response)
@@ -114,30 +471,86 @@ class AccountingAPI(object):
             return self.error_404()
         except HTTPException as e:
             return e
+        request.environ['clexfa.endpoint'] = endpoint
         
         ### Check authentication before entering API funcitons
         ### By convention, API functions ending in 'auth'
         ### (api_auth and api_checkauth) do not require Authorization headers
         if not endpoint.endswith("auth"):
-            if 'Authorization' not in request.headers or ( not self._check_auth(request.headers['Authorization']) ):
+            with timing.span('auth'):
+                authorised = 'Authorization' in request.headers and self._check_auth(request.headers['Authorization'])
+            if not authorised:
                 return self.error_401()
 
+        ### Conditional requests. Data only changes when an ingest job runs,
+        ### so a client that already has the current version of a response
+        ### can be told so without querying anything
+        sources = ENDPOINT_SOURCES.get(endpoint,None)
+        if sources:
+            with timing.span('etag'):
+                etag = self._etag(request,endpoint,values,sources)
+            ### Only the client's own cache may keep a response, a shared
+            ### one would hand it to requests without a token
+            cache_headers = { 'Cache-Control': f"private, max-age={cache_max_age(sources)}" }
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304,headers=cache_headers)
+                response.set_etag(etag,weak=True)
+                ### Same as the 200 it stands in for
+                response.vary.update([ 'Accept-Encoding', 'Authorization' ])
+                return response
+
         try:
-            return getattr(self,endpoint)(request,**values)
+            response = getattr(self,endpoint)(request,**values)
         except NotFound:
             return self.error_404()
+        except cosmosdb.InvalidQuery:
+            return self.error_400()
         except HTTPException as e:
             return e
 
+        if sources and isinstance(response,Response) and response.status_code == 200:
+            response.headers.update(cache_headers)
+            response.set_etag(etag,weak=True)
+            ### Adds to Vary: Accept-Encoding from json_response
+            response.vary.add('Authorization')
+        return response
+
+    def _etag(self, request: Request, endpoint: str, values: Dict[str,Any], sources: List[str]) -> str:
+        blob_writer = blob.get_shared_writer()
+        validators=[]
+        ingest_state=None
+        for source in sources:
+            if source in BLOB_SOURCES:
+                validators.append(blob_writer.get_etag(blob.CONTAINER,source))
+            else:
+                ### Re-read at most once per blob cache TTL, so a new ingest
+                ### can take that long to invalidate cached responses
+                if ingest_state is None:
+                    ingest_state = blob_writer.read_item(blob.CONTAINER,blob.INGEST_STATE,default={})
+                validators.append(ingest_state.get(source,None))
+        return hashlib.sha1(serialise.dumps([endpoint,values,request.query_string.decode(),validators])).hexdigest()
+
     def _check_auth(self,key):
-        db_writer = cosmosdb.CosmosDBWriter()
+        ### Signed tokens are checked locally, only the (cached) revocation
+        ### list is ever fetched. UUID keys are looked up in Cosmos if
+        ### legacy keys are still accepted.
+        if auth.SECRET and auth.is_signed_token(key):
+            return auth.verify_token(key,self._revoked_tokens())
+        if not config.settings['auth_legacy_keys']:
+            return False
+        db_writer = cosmosdb.get_shared_writer()
         keys = db_writer.get_container("authkeys","Accounting")
         try:
-            keys.read_item(key,partition_key='1')
+            with timing.span('cosmos.read') as s:
+                keys.read_item(key,partition_key='1',response_hook=s.hook)
         except cosmos_exceptions.CosmosResourceNotFoundError:
             return False
         return True
 
+    def _revoked_tokens(self) -> Dict[str,int]:
+        blob_writer = blob.get_shared_writer()
+        return blob_writer.read_item(blob.CONTAINER,auth.REVOKED_BLOB,default={})
+
     def api_auth(self, request: Request):
         d = request.get_json()
         if "username" not in d:
@@ -149,14 +562,17 @@ class AccountingAPI(object):
         m.update(os.getenv('SALT',"").encode())
         d['password'] = m.hexdigest()
 
-        blob_writer = blob.BlobWriter()
+        blob_writer = blob.get_shared_writer()
         creds = blob_writer.read_item(blob.CONTAINER,'creds')
         if d['password'] != creds:
             return self.error_401()
 
+        if auth.SECRET:
+            return Response(auth.issue_token(),content_type="application/json")
+
         auth_key=str(uuid.uuid4())
 
-        db_writer = cosmosdb.CosmosDBWriter()
+        db_writer = cosmosdb.get_shared_writer()
         _ = db_writer.get_container("authkeys","Accounting")
         #keys.create_item(body={'id':auth_key,'PartitionKey':'1'})
         db_writer.create_item("authkeys",{'id':auth_key})
@@ -170,17 +586,34 @@ class AccountingAPI(object):
             return Response(None,status=204,headers=STANDARD_HEADERS)
         return self.error_401()
 
+    def api_logout(self,request: Request):
+        key = request.headers['Authorization']
+        if auth.SECRET and auth.is_signed_token(key):
+            ### Other workers may be revoking tokens at the same time
+            blob_writer = blob.get_shared_writer()
+            blob_writer.update_item(blob.CONTAINER,auth.REVOKED_BLOB,lambda revoked: auth.revoke_token(revoked,key),default={})
+        else:
+            db_writer = cosmosdb.get_shared_writer()
+            _ = db_writer.get_container("authkeys","Accounting")
+            try:
+                db_writer.delete_item("authkeys",key)
+            except cosmos_exceptions.CosmosResourceNotFoundError:
+                pass
+        return Response(None,status=204,headers=STANDARD_HEADERS)
+
     ### This function handles getOne, getMany, getManyReference and getList
     def api_get_users(self,request: Request,param=None):
 
-        blob_writer = blob.BlobWriter()
+        blob_writer = blob.get_shared_writer()
         user_d = blob_writer.read_item(blob.CONTAINER,'users')
         monitored_projects = blob_writer.read_item(blob.CONTAINER,'projectlist')
 
         if param:
             try:
-                user_d[param]['groups'] = sorted(list(set(user_d[param]["groups"]) & set(monitored_projects)))
-                return Response(json.dumps({"id":param} | user_d[param]),content_type="application/json",headers=STANDARD_HEADERS)
+                ### user_d is shared with the cache, don't modify it in place
+                user = {"id":param} | user_d[param]
+                user['groups'] = sorted(list(set(user["groups"]) & set(monitored_projects)))
+                return Response(serialise.dumps(user),content_type="application/json",headers=STANDARD_HEADERS)
             except KeyError:
                 return Response('{}',content_type="application/json",headers=STANDARD_HEADERS)
 
@@ -190,17 +623,17 @@ class AccountingAPI(object):
 
         ### Filter
         if "filter" in request.args:
-            filt=json.loads(request.args.get("filter"))
+            filt=serialise.loads(request.args.get("filter"))
             out_l = filter_list(all_user_list,filt)
 
         ### Sort
         if "sort" in request.args:
-            field,order = json.loads(request.args.get("sort"))
+            field,order = serialise.loads(request.args.get("sort"))
             out_l=sorted(out_l,key=lambda x: x[field],reverse=(order=="DESC"))
 
         ### Pagination
         if "range" in request.args:
-            start, end = json.loads(request.args["range"])
+            start, end = serialise.loads(request.args["range"])
             total = len(out_l)
             end=min(end,total-1)
             out_l=out_l[start:end+1]
@@ -209,17 +642,17 @@ class AccountingAPI(object):
         for i in out_l:
             i["groups"] = sorted(list(set(i["groups"]) & set(monitored_projects)))
 
-        return Response(json.dumps(out_l),content_type="application/json",headers=headers)
+        return json_response(request,out_l,headers)
     
     def api_get_groups(self,request: Request,param=None):
 
-        blob_writer = blob.BlobWriter()
+        blob_writer = blob.get_shared_writer()
         group_d = blob_writer.read_item(blob.CONTAINER,'groups')
         monitored_projects = blob_writer.read_item(blob.CONTAINER,'projectlist')
 
         if param:
             if param in monitored_projects:
-                return Response(json.dumps({"id":param} | group_d[param]),content_type="application/json",headers=STANDARD_HEADERS)
+                return Response(serialise.dumps({"id":param} | group_d[param]),content_type="application/json",headers=STANDARD_HEADERS)
             else:
                 return Response('{}',content_type="application/json",headers=STANDARD_HEADERS)
 
@@ -229,35 +662,42 @@ class AccountingAPI(object):
 
         ### Filter
         if "filter" in request.args:
-            filt=json.loads(request.args.get("filter"))
+            filt=serialise.loads(request.args.get("filter"))
             out_l = filter_list(all_group_list,filt)
 
         ### Sort
         if "sort" in request.args:
-            field,order = json.loads(request.args.get("sort"))
+            field,order = serialise.loads(request.args.get("sort"))
             out_l=sorted(out_l,key=lambda x: x[field],reverse=(order=="DESC"))
 
         ### Pagination
         if "range" in request.args:
-            start, end = json.loads(request.args["range"])
+            start, end = serialise.loads(request.args["range"])
             total = len(out_l)
             end=min(end,total-1)
             out_l=out_l[start:end+1]
             headers = headers | content_range_headers("groups",start,end,total)
 
-        return Response(json.dumps(out_l),content_type="application/json",headers=headers)
+        return json_response(request,out_l,headers)
 
     def api_get_compute_latest(self,request,param=None):
 
         headers=STANDARD_HEADERS
 
-        db_writer = cosmosdb.CosmosDBWriter()
+        db_writer = cosmosdb.get_shared_writer()
         _ = db_writer.get_container("compute_latest","Accounting")
 
         if param:
             ### Respond to getOne (will be a little different from the usual filtered output)
             out={ 'id':param }
-            compute_query = db_writer.query("compute_latest",where=[f"user = '{param}' OR c.project = '{param}'"])
+            ### update_nci_account precomputes these for every user and project
+            _ = db_writer.get_container("compute_summary","Accounting")
+            summary = db_writer.read_items("compute_summary",param,once_off=True)
+            if summary:
+                return Response(serialise.dumps(out | dict(summary[0]['summary'])),content_type="application/json",headers=headers)
+
+            ### Not summarised (yet), work it out from the latest entries
+            compute_query = db_writer.query("compute_latest",fields=COMPUTE_FIELDS,where=cosmosdb.Filter().any_equal(['user','project'],param))
             if compute_query:
                 tmp = { i['user']:0.0 for i in compute_query if i['user'] not in ( 'grant','total' )} | { i['project']:0.0 for i in compute_query }
                 for line in compute_query:
@@ -267,190 +707,215 @@ class AccountingAPI(object):
             else:
                 tmp = {}
 
-            return Response(json.dumps(remove_internal_data_single(out | dict(sorted(tmp.items(), key=lambda x: x[1], reverse=True)))),content_type="application/json",headers=headers)
+            return Response(serialise.dumps(remove_internal_data_single(out | dict(sorted(tmp.items(), key=lambda x: x[1], reverse=True)))),content_type="application/json",headers=headers)
 
-        where_list=[]
+        where=cosmosdb.Filter()
 
         if "filter" in request.args:
-            filt=json.loads(request.args.get("filter"))
-            for k,v in filt.items():
-                ### Handle timestamps same as any other field in this case
-                ### Should never filter this db on timestamps anyway
-                #if k == "ts": continue
-                if isinstance(v,List):
-                    filt[k] = ','.join( [ "'" + i + "'" for i in v] )
-                elif isinstance(v,str):
-                    filt[k] = "'" + v + "'"
-                where_list.append(f"{k} IN ({filt[k]})")
+            ### Handle timestamps same as any other field in this case
+            ### Should never filter this db on timestamps anyway
+            where=build_filter(serialise.loads(request.args.get("filter")))
 
         order_str=None
         if "sort" in request.args:
-            field,order = json.loads(request.args.get("sort"))
+            field,order = serialise.loads(request.args.get("sort"))
             order_str = field
             if order == "DESC":
                 order_str = order_str + " DESC"
 
-        compute_queries = db_writer.query("compute_latest",fields=None,where=where_list,order=order_str)
-
         ### Pagination
         if "range" in request.args:
-            start, end = json.loads(request.args["range"])
-            total = len(compute_queries)
+            start, end = serialise.loads(request.args["range"])
+            compute_queries, total = query_range(db_writer,"compute_latest",COMPUTE_FIELDS,where,order_str,start,end)
             end=min(end,total-1)
-            compute_queries=compute_queries[start:end+1]
             headers = headers | content_range_headers("users",start,end,total)
+        else:
+            compute_queries = db_writer.query("compute_latest",fields=COMPUTE_FIELDS,where=where,order=order_str)
 
-        return Response(json.dumps(remove_internal_data(compute_queries)),content_type="application/json",headers=headers)
+        return json_response(request,last_seen("compute_latest",compute_queries),headers)
 
     def api_get_compute(self,request,param=None):
 
         headers=STANDARD_HEADERS
 
-        quarters=[]
         filt={}
         if "filter" in request.args:
-            filt=json.loads(request.args.get("filter"))
+            filt=serialise.loads(request.args.get("filter"))
 
         ### First up. figure out how many containers we need to grab
-        if filt:
-            if "ts" in filt:
-                if isinstance(filt["ts"],str):
-                    quarters = [ sanitize_time(filt["ts"]).quarter(), ]
-                else:
-                    t_bounds = [ sanitize_time(v) for v in filt["ts"] ]
-                    t_set = { i.quarter() for i in t_bounds }
-                    ### Are we spanning 3 or more quarters?
-                    i_t = min(t_bounds) + timedelta(weeks=4)
-                    while i_t < max(t_bounds):
-                        t_set.add(i_t.quarter())
-                        i_t = i_t + four_weeks
-                quarters = sorted(list(t_set))
-            else:
-                quarters = [ Datetime_with_quarter.now().quarter(), ]
+        ### Compute data is six-hourly at 0, 6, 12 and 18 UTC
+        ### Though there is quite a bit of leeway there
+        partitions = time_partitions(filt.get("ts",None))
 
-        else:
-            quarters = [ Datetime_with_quarter.now().quarter(), ]
-            
-
-        db_writer = cosmosdb.CosmosDBWriter()
+        db_writer = cosmosdb.get_shared_writer()
         _ = db_writer.get_container("compute","Accounting",quarterly=True)
+        if compute_series.PACKED:
+            _ = db_writer.get_container(compute_series.CONTAINER,"Accounting",quarterly=True)
         
         if param:
             self.error_400()
 
-        where_list=[]
-        
-        if filt:
-            for k,v in filt.items():
-                ### Handle timestamps later
-                if k == "ts": continue
-                if isinstance(v,List):
-                    filt[k] = ','.join( [ "'" + i + "'" for i in v] )
-                elif isinstance(v,str):
-                    filt[k] = "'" + v + "'"
-                where_list.append(f"{k} IN ({filt[k]})")
-        
+        ### Handle timestamps later
+        where = build_filter(filt,skip=("ts",))
+
         order_str=None
         if "sort" in request.args:
-            field,order = json.loads(request.args.get("sort"))
+            field,order = serialise.loads(request.args.get("sort"))
             order_str = field
             if order == "DESC":
                 order_str = order_str + " DESC"
         
         start = None
-        total = None
+        end = None
         if "range" in request.args:
-            start, end = json.loads(request.args["range"])
-            total=end-start+1
+            start, end = serialise.loads(request.args["range"])
+
+        ### Each quarter lives in its own partition, query them all at once.
+        ### Rows come back from each partition in order, so the requested
+        ### range is found by merging them, and no partition ever needs to
+        ### return more than end+1 rows.
+        limit = None if end is None else end+1
+        page_size = partition_page_size(start,end,len(partitions))
+        if start is not None:
+            count_futures = [ submit(db_writer.count,"compute",within(where,p),p.key) for p in partitions ]
+        ### With packed history, each partition's packed documents are read
+        ### whole and unpacked here. Rows written before it was switched on
+        ### are still in 'compute', so those are read as well
+        packed_futures = []
+        if compute_series.PACKED:
+            packed_futures = [ submit(db_writer.query,compute_series.CONTAINER,None,packed_within(packed_filter(filt),p),None,None,None,p.key) for p in partitions ]
+        streams = prefetch([ db_writer.query_iter("compute",fields=projection(COMPUTE_FIELDS,order_str),where=within(where,p),order=order_str,limit=limit,quarter=p.key,page_size=page_size) for p in partitions ])
+
+        packed = packed_rows([ f.result() for f in packed_futures ],partitions,filt,projection(COMPUTE_FIELDS,order_str))
+        field, reverseSort = parse_order(order_str)
+        if field:
+            packed = sorted(packed,key=lambda x: x[field],reverse=reverseSort)
+        compute_queries = merge_partitions(streams + [ iter(packed), ],order_str,start,end)
+
+        if start is not None:
+            total = sum( f.result() for f in count_futures ) + len(packed)
+            end = min(end,total-1)
             headers = headers | content_range_headers("compute",start,end,total)
 
-        compute_queries=[]
-        for q in quarters:
-            where_list_w_timestamps = where_list
-            if filt:
-                timestamps = filt.get("ts",None)
-                if timestamps:
-                    ### Compute data is six-hourly at 0, 6, 12 and 18 UTC
-                    ### Though there is quite a bit of leeway there
-                    ### If timestamps is a string, construct a between statement
-                    ### for the hours either side of those
-                    if isinstance(timestamps,str):
-                        t=sanitize_time(timestamps)
-                        where_list_w_timestamps = where_list + [ f"ts > '{(t - one_hour).isoformat()}'", f"ts < '{(t + one_hour).isoformat()}'" ]
-                    elif isinstance(timestamps,List):
-                        ### Handle an interval otherwise
-                        timelist=sorted(timestamps)
-                        tstart = sanitize_time(timelist[0])
-                        tend = sanitize_time(timelist[-1])
-                        where_list_w_timestamps = where_list + [ f"ts > '{(tstart - one_hour).isoformat()}'", f"ts < '{(tend + one_hour).isoformat()}'"]
-            compute_queries.extend(db_writer.query("compute",fields=None,where=where_list_w_timestamps,order=order_str,offset=start,limit=total,quarter=q))
-
-        return Response(json.dumps(remove_internal_data(compute_queries)),content_type="application/json",headers=headers)
+        return json_response(request,compute_queries,headers)
 
-    def api_get_storage_latest(self,request,param=None):
+    def api_get_compute_rollup(self,request,param=None):
 
+        ### Compute history reduced to one value per user, project and
+        ### day/week/month. Usage is cumulative over a quarter, so each
+        ### bucket holds the last value recorded in it
         headers=STANDARD_HEADERS
 
-        db_writer = cosmosdb.CosmosDBWriter()
-        _ = db_writer.get_container("files_report_latest","Accounting")
-        _ = db_writer.get_container("storage_latest","Accounting")
+        if param:
+            return self.error_400()
+
+        bucket = request.args.get("bucket","day")
+        if bucket not in ROLLUP_BUCKETS:
+            return self.error_400()
+
+        filt={}
+        if "filter" in request.args:
+            filt=serialise.loads(request.args.get("filter"))
+
+        partitions = time_partitions(filt.get("ts",None))
+
+        db_writer = cosmosdb.get_shared_writer()
+        _ = db_writer.get_container("compute","Accounting",quarterly=True)
+        if compute_series.PACKED:
+            _ = db_writer.get_container(compute_series.CONTAINER,"Accounting",quarterly=True)
+
+        where = build_filter(filt,skip=("ts",))
+
+        ### Let the server reduce each partition to daily values, anything
+        ### coarser is reduced from those here
+        ### Packed documents hold at most a week of samples each, they are
+        ### reduced here along with everything else
+        packed_futures = []
+        if compute_series.PACKED:
+            packed_futures = [ submit(db_writer.query,compute_series.CONTAINER,None,packed_within(packed_filter(filt),p),None,None,None,p.key) for p in partitions ]
+        rows = [ row for result in fan_out(lambda p: daily_last(db_writer,within(where,p),p.key),partitions) for row in result ]
+        rows.extend([ row | { 'day': row['ts'][:10] } for row in packed_rows([ f.result() for f in packed_futures ],partitions,filt) ])
+        rollup={}
+        for row in rows:
+            k = ( row['project'], row['user'], bucket_start(row['day'],bucket) )
+            if k not in rollup or rollup[k]['ts'] < row['ts']:
+                rollup[k] = row
+
+        out_l = [ { 'id': f"{project}_{user}_{b}",
+                    'bucket': b,
+                    'ts': row['ts'],
+                    'project': project,
+                    'user': user,
+                    'usage': row['usage'] } for (project,user,b),row in rollup.items() ]
+
+        ### Sort
+        field, order = "bucket", "ASC"
+        if "sort" in request.args:
+            field,order = serialise.loads(request.args.get("sort"))
+            if field not in ROLLUP_FIELDS:
+                return self.error_400()
+        out_l=sorted(out_l,key=lambda x: x[field],reverse=(order=="DESC"))
+
+        ### Pagination
+        if "range" in request.args:
+            start, end = serialise.loads(request.args["range"])
+            total = len(out_l)
+            end=min(end,total-1)
+            out_l=out_l[start:end+1]
+            headers = headers | content_range_headers("compute",start,end,total)
+
+        return json_response(request,out_l,headers)
+
+    def api_get_storage_latest(self,request,param=None):
+
+        headers=STANDARD_HEADERS
 
         if param:
             ### Not necessary to support
             return self.error_400()
 
-        where_list=[]
-        quota_where_list=[]
+        ### The ingest jobs publish the merged result, serve from that
+        blob_writer = blob.get_shared_writer()
+        snapshot = blob_writer.read_item(blob.CONTAINER,storage_snapshot.BLOB,default=None)
+        if snapshot is not None:
+            return self._storage_latest_from_snapshot(request,snapshot['rows'],headers)
+
+        db_writer = cosmosdb.get_shared_writer()
+        _ = db_writer.get_container("files_report_latest","Accounting")
+        _ = db_writer.get_container("storage_latest","Accounting")
 
+        filt={}
         if "filter" in request.args:
-            filt=json.loads(request.args.get("filter"))
-            quota_filt={}
-            for k,v in filt.items():
-                ### Handle timestamps same as any other field in this case
-                ### Should never filter this db on timestamps anyway
-                #if k == "ts": continue
-                if isinstance(v,List):
-                    filt[k] = ','.join( [ "'" + i + "'" for i in v] )
-                elif isinstance(v,str):
-                    filt[k] = "'" + v + "'"
-                where_list.append(f"{k} IN ({filt[k]})")
-                if k in ( 'ownership', 'location' ):
-                    quota_filt["project"] = filt[k]
-                elif k in ( 'fs', 'system', 'PartitionKey' ):
-                    quota_filt[k] = filt[k]
-            quota_where_list=[ f"{k} IN ({v})" for k,v in quota_filt.items() ]
+            filt=serialise.loads(request.args.get("filter"))
+        ### Handle timestamps same as any other field in this case
+        ### Should never filter this db on timestamps anyway
+        where = build_filter(filt)
+        quota_where = build_filter(quota_filter(filt))
 
         order_str=None
         if "sort" in request.args:
-            field,order = json.loads(request.args.get("sort"))
+            field,order = serialise.loads(request.args.get("sort"))
             order_str = field
             if order == "DESC":
                 order_str = order_str + " DESC"
 
         ### Don't want totals if we're looking for a specific user
+        ### in which case everything comes from the one container and the
+        ### server can do the paging
+        if "user" in filt and "range" in request.args:
+            start, end = serialise.loads(request.args["range"])
+            storage_queries, total = query_range(db_writer,"files_report_latest",FILES_REPORT_FIELDS,where,order_str,start,end)
+            end=min(end,total-1)
+            headers = headers | content_range_headers("users",start,end,total)
+            return json_response(request,last_seen("files_report_latest",storage_queries),headers)
+
         quota_queries=[]
-        storage_queries = db_writer.query("files_report_latest",fields=None,where=where_list,order=order_str)
+        storage_queries = last_seen("files_report_latest",db_writer.query("files_report_latest",fields=projection(FILES_REPORT_FIELDS,order_str),where=where,order=order_str))
         if "user" not in filt:
-            totals_queries = db_writer.query("storage_latest",fields=None,where=quota_where_list,order=order_str)
+            ### Sorted below once these have been converted
+            totals_queries = last_seen("storage_latest",db_writer.query("storage_latest",fields=storage_snapshot.QUOTA_FIELDS,where=quota_where))
             for i in totals_queries:
-                quota_queries.append({"ts":i["ts"], 
-                                        "id":f'{i["system"]}_{i["fs"]}_total_{i["project"]}_{i["project"]}',
-                                        "fs":i["fs"],
-                                        "user":"total",
-                                        "ownership":i["project"],
-                                        "location":i["project"],
-                                        "size":i["usage"],
-                                        "inodes":i["iusage"],
-                                        })
-                quota_queries.append({"ts":i["ts"], 
-                                        "id":f'{i["system"]}_{i["fs"]}_quota_{i["project"]}_{i["project"]}',
-                                        "fs":i["fs"],
-                                        "user":"grant",
-                                        "ownership":i["project"],
-                                        "location":i["project"],
-                                        "size":i["quota"],
-                                        "inodes":i["iquota"],
-                                        })
+                quota_queries.extend(storage_snapshot.quota_rows(i))
 
             storage_queries = storage_queries + quota_queries
 
@@ -463,193 +928,153 @@ class AccountingAPI(object):
 
         ### Pagination
         if "range" in request.args:
-            start, end = json.loads(request.args["range"])
+            start, end = serialise.loads(request.args["range"])
             total = len(storage_queries)
             end=min(end,total-1)
             storage_queries=storage_queries[start:end+1]
             headers = headers | content_range_headers("users",start,end,total)
 
-        return Response(json.dumps(remove_internal_data(storage_queries)),content_type="application/json",headers=headers)
+        return json_response(request,storage_queries,headers)
+
+    def _storage_latest_from_snapshot(self,request,rows,headers):
+
+        out_l=rows
+        if "filter" in request.args:
+            filt=serialise.loads(request.args.get("filter"))
+            out_l = [ i for i in rows if snapshot_row_matches(i,filt) ]
+
+        ### Sort
+        if "sort" in request.args:
+            field,order = serialise.loads(request.args.get("sort"))
+            out_l=sorted(out_l,key=lambda x: x[field],reverse=(order=="DESC"))
+
+        ### Pagination
+        if "range" in request.args:
+            start, end = serialise.loads(request.args["range"])
+            total = len(out_l)
+            end=min(end,total-1)
+            out_l=out_l[start:end+1]
+            headers = headers | content_range_headers("users",start,end,total)
+
+        return json_response(request,out_l,headers)
 
     def api_get_storage_project_latest(self,request,param=None):
 
         headers=STANDARD_HEADERS
 
-        db_writer = cosmosdb.CosmosDBWriter()
+        db_writer = cosmosdb.get_shared_writer()
         _ = db_writer.get_container("storage_latest","Accounting")
 
         if param:
             ### Don't need to support
             return self.error_400()
 
-        where_list=[]
+        where=cosmosdb.Filter()
 
         if "filter" in request.args:
-            filt=json.loads(request.args.get("filter"))
-            for k,v in filt.items():
-                ### Handle timestamps same as any other field in this case
-                ### Should never filter this db on timestamps anyway
-                #if k == "ts": continue
-                if isinstance(v,List):
-                    filt[k] = ','.join( [ "'" + i + "'" for i in v] )
-                elif isinstance(v,str):
-                    filt[k] = "'" + v + "'"
-                where_list.append(f"{k} IN ({filt[k]})")
+            ### Handle timestamps same as any other field in this case
+            ### Should never filter this db on timestamps anyway
+            where=build_filter(serialise.loads(request.args.get("filter")))
 
         order_str=None
         if "sort" in request.args:
-            field,order = json.loads(request.args.get("sort"))
+            field,order = serialise.loads(request.args.get("sort"))
             order_str = field
             if order == "DESC":
                 order_str = order_str + " DESC"
 
-        storage_queries = db_writer.query("storage_latest",fields=None,where=where_list,order=order_str)
-
         ### Pagination
         if "range" in request.args:
-            start, end = json.loads(request.args["range"])
-            total = len(storage_queries)
+            start, end = serialise.loads(request.args["range"])
+            storage_queries, total = query_range(db_writer,"storage_latest",STORAGE_FIELDS,where,order_str,start,end)
             end=min(end,total-1)
-            storage_queries=storage_queries[start:end+1]
             headers = headers | content_range_headers("users",start,end,total)
+        else:
+            storage_queries = db_writer.query("storage_latest",fields=STORAGE_FIELDS,where=where,order=order_str)
 
-        return Response(json.dumps(remove_internal_data(storage_queries)),content_type="application/json",headers=headers)
+        return json_response(request,last_seen("storage_latest",storage_queries),headers)
 
     def api_get_storage(self,request,param=None):
 
         headers=STANDARD_HEADERS
 
-        quarters=[]
         filt={}
         if "filter" in request.args:
-            filt=json.loads(request.args.get("filter"))
+            filt=serialise.loads(request.args.get("filter"))
 
         ### First up. figure out how many containers we need to grab
-        if filt:
-            if "ts" in filt:
-                if isinstance(filt["ts"],str):
-                    quarters = [ sanitize_time(filt["ts"]).quarter(), ]
-                else:
-                    t_bounds = [ sanitize_time(v) for v in filt["ts"] ]
-                    t_set = { i.quarter() for i in t_bounds }
-                    ### Are we spanning 3 or more quarters?
-                    i_t = min(t_bounds) + timedelta(weeks=4)
-                    while i_t < max(t_bounds):
-                        t_set.add(i_t.quarter())
-                        i_t = i_t + four_weeks
-                quarters = sorted(list(t_set))
-            else:
-                quarters = [ Datetime_with_quarter.now().quarter(), ]
-
-        else:
-            quarters = [ Datetime_with_quarter.now().quarter(), ]
+        ### Quota data is daily at 2205 UTC
+        partitions = time_partitions(filt.get("ts",None))
+        quota_partitions = partitions
+        if storage_series.CHANGE_ONLY:
+            quota_partitions, series_start, series_end = series_partitions(filt.get("ts",None))
 
-        db_writer = cosmosdb.CosmosDBWriter()
+        db_writer = cosmosdb.get_shared_writer()
         _ = db_writer.get_container("files_report","Accounting",quarterly=True)
         _ = db_writer.get_container("storage","Accounting",quarterly=True)
 
         if param:
             self.error_400()
 
-        where_list=[]
-        quota_where_list=[]
-
-        if filt:
-            quota_filt={}
-            for k,v in filt.items():
-                ### Handle timestamps later
-                if k == "ts": continue
-                if isinstance(v,List):
-                    filt[k] = ','.join( [ "'" + i + "'" for i in v] )
-                elif isinstance(v,str):
-                    filt[k] = "'" + v + "'"
-                where_list.append(f"{k} IN ({filt[k]})")
-                if k in ( 'ownership', 'location' ):
-                    quota_filt["project"] = filt[k]
-                elif k in ( 'fs', 'system', 'PartitionKey' ):
-                    quota_filt[k] = filt[k]
-            quota_where_list=[ f"{k} IN ({v})" for k,v in quota_filt.items() ]
+        ### Handle timestamps later
+        where = build_filter(filt,skip=("ts",))
+        quota_where = build_filter(quota_filter(filt),skip=("ts",))
 
         order_str=None
         if "sort" in request.args:
-            field,order = json.loads(request.args.get("sort"))
+            field,order = serialise.loads(request.args.get("sort"))
             order_str = field
             if order == "DESC":
                 order_str = order_str + " DESC"
 
         start = None
-        total = None
+        end = None
         if "range" in request.args:
-            start, end = json.loads(request.args["range"])
-            total=end-start+1
-            headers = headers | content_range_headers("compute",start,end,total)
+            start, end = serialise.loads(request.args["range"])
 
         do_total_query=False
         do_grant_query=False
         if "user" in filt:
-            if any( [i == "'total'" for i in filt["user"].split(',')] ):
-                do_total_query=True
-            if any( [i == "'quota'" for i in filt["user"].split(',')] ):
-                do_grant_query=True
+            users = filt["user"] if isinstance(filt["user"],List) else [ filt["user"], ]
+            do_total_query = "total" in users
+            do_grant_query = "grant" in users or "quota" in users
         else:
             do_total_query=True
             do_grant_query=True
 
+        ### Every (container, quarter) pair is an independent partition query,
+        ### run them all at once. files_report rows are streamed back in order
+        ### and merged, so no quarter returns more than end+1 rows.
+        limit = None if end is None else end+1
+        page_size = partition_page_size(start,end,len(partitions))
+        if start is not None:
+            count_futures = [ submit(db_writer.count,"files_report",within(where,p),p.key) for p in partitions ]
+        quota_futures = []
+        if do_grant_query | do_total_query:
+            ### quota/usage, on the other hand comes in at 0, 6, 12 and 18 UTC from a different table
+            ### These rows don't have the fields we sort on until they've been
+            ### converted, so sort them here instead
+            quota_futures = [ submit(db_writer.query,"storage",storage_snapshot.QUOTA_FIELDS,within(quota_where,p),None,None,None,p.key) for p in quota_partitions ]
+        streams = prefetch([ db_writer.query_iter("files_report",fields=projection(FILES_REPORT_FIELDS,order_str),where=within(where,p),order=order_str,limit=limit,quarter=p.key,page_size=page_size) for p in partitions ])
+
+        quota_entries = [ i for f in quota_futures for i in f.result() ]
+        if storage_series.CHANGE_ONLY:
+            quota_entries = storage_series.expand(quota_entries,series_start,series_end)
         quota_queries=[]
-        storage_queries=[]
-        for q in quarters:
-            where_list_w_timestamps = where_list
-            if filt:
-                timestamps = filt.get("ts",None)
-                if timestamps:
-                    ### Quota data is daily at 2205 UTC
-                    if isinstance(timestamps,str):
-                        t=sanitize_time(timestamps)
-                        where_list_w_timestamps = where_list + [ f"ts > '{(t - one_hour).isoformat()}'", f"ts < '{(t + one_hour).isoformat()}'" ]
-                        quota_where_list_w_timestamps = quota_where_list + [ f"ts > '{(t - one_hour).isoformat()}'", f"ts < '{(t + one_hour).isoformat()}'" ]
-                    elif isinstance(timestamps,List):
-                        ### Handle an interval otherwise
-                        timelist=sorted(timestamps)
-                        tstart = sanitize_time(timelist[0])
-                        tend = sanitize_time(timelist[-1])
-                        where_list_w_timestamps = where_list + [ f"ts > '{(tstart - one_hour).isoformat()}'", f"ts < '{(tend + one_hour).isoformat()}'"]
-                        quota_where_list_w_timestamps = quota_where_list + [ f"ts > '{(tstart - one_hour).isoformat()}'", f"ts < '{(tend + one_hour).isoformat()}'"]
-            storage_queries.extend(db_writer.query("files_report",fields=None,where=where_list_w_timestamps,order=order_str,offset=start,limit=total,quarter=q))
-            if do_grant_query | do_total_query:
-                ### quota/usage, on the other hand comes in at 0, 6, 12 and 18 UTC from a different table
-                totals_queries = db_writer.query("storage",fields=None,where=quota_where_list_w_timestamps,order=order_str,quarter=q)
-                for i in totals_queries:
-                    if do_total_query:
-                        quota_queries.append({"ts":i["ts"],
-                                            "id":f'{i["system"]}_{i["fs"]}_total_{i["project"]}_{i["project"]}',
-                                            "fs":i["fs"],
-                                            "user":"total",
-                                            "ownership":i["project"],
-                                            "location":i["project"],
-                                            "size":i["usage"],
-                                            "inodes":i["iusage"],
-                                            })
-                    if do_grant_query:
-                        quota_queries.append({"ts":i["ts"],
-                                            "id":f'{i["system"]}_{i["fs"]}_quota_{i["project"]}_{i["project"]}',
-                                            "fs":i["fs"],
-                                            "user":"grant",
-                                            "ownership":i["project"],
-                                            "location":i["project"],
-                                            "size":i["quota"],
-                                            "inodes":i["iquota"],
-                                            })
-        storage_queries = storage_queries + quota_queries
-
-        if order_str:
-            reverseSort=False
-            order_tuple = order_str.split(' ')
-            if len(order_tuple) == 2:
-                reverseSort=(order_tuple[1] == "DESC")
-
-            storage_queries = sorted(storage_queries,key=lambda x:x[order_tuple[0]],reverse=reverseSort)
-
-        return Response(json.dumps(remove_internal_data(storage_queries)),content_type="application/json",headers=headers)
+        for i in quota_entries:
+            quota_queries.extend(storage_snapshot.quota_rows(i,do_total_query,do_grant_query))
+
+        field, reverseSort = parse_order(order_str)
+        if field:
+            quota_queries = sorted(quota_queries,key=lambda x:x[field],reverse=reverseSort)
+        storage_queries = merge_partitions(streams + [ iter(quota_queries), ],order_str,start,end)
+
+        if start is not None:
+            total = sum( f.result() for f in count_futures ) + len(quota_queries)
+            end = min(end,total-1)
+            headers = headers | content_range_headers("compute",start,end,total)
+
+        return json_response(request,storage_queries,headers)
 
 werkzeug_app = AccountingAPI({})
 
@@ -1,20 +1,26 @@
 #!/usr/bin/env python3
-from ..lib import remote_command, config, group_list
+from ..lib import remote_command, config, group_list, blob, storage_snapshot, storage_series
 from ..lib.cosmosdb import aio as cosmosdb
 
 import asyncio
 import uuid
 from datetime import datetime
 
+from typing import Any, Dict
+
+def latest_id(entry: Dict[str,Any]) -> str:
+    return f"{entry['system']}_{entry['fs']}_{entry['project']}"
+
 async def main():
     
     writer = cosmosdb.CosmosDBWriter()
     get_future = writer.get_container("storage",cosmosdb.DATABASE_ID,quarterly=True)
     latest_future = writer.get_container("storage_latest",cosmosdb.DATABASE_ID)
+    files_latest_future = writer.get_container("files_report_latest",cosmosdb.DATABASE_ID)
     lquota_out=remote_command.run_remote_cmd(["lquota","-q","--no-pretty-print"])
     
     if not lquota_out:
-        await asyncio.wait([get_future,latest_future])
+        await asyncio.gather(get_future,latest_future,files_latest_future)
         await writer.close()
         exit("No data received, check subprocess status")
 
@@ -22,10 +28,9 @@ async def main():
     field_names=[ 'project','fs','usage','quota','limit','iusage','iquota','ilimit' ]
 
     my_groups = group_list.get_group_list()
-    futures=[]
     entries=[]
 
-    await asyncio.wait([get_future,latest_future])
+    await asyncio.gather(get_future,latest_future,files_latest_future)
 
     for line in lquota_out:
         fields=line.split(maxsplit=len(field_names))
@@ -49,31 +54,39 @@ async def main():
 
         if entry['project'] in my_groups:
             entries.append(entry)
-            futures.append(writer.create_item("storage",entry))
 
-    if futures:
-        await asyncio.wait(futures)
+    latest_where = cosmosdb.Filter().compare('fs','!=','massdata')
 
-    print("Making latest entries")
+    ### In change-only mode, storage_latest keeps the last row stored for
+    ### each project and filesystem, and only entries that differ enough
+    ### from that are stored
+    samples = {}
+    if storage_series.CHANGE_ONLY:
+        samples = { i['id']:i.get('sample',None) for i in await writer.query('storage_latest',['id','sample'],latest_where) }
+    due = [ storage_series.due(samples.get(latest_id(entry),None),entry) for entry in entries ]
+    history = [ entry for entry,d in zip(entries,due) if d ]
+    await writer.create_items("storage",history)
+    print(f"Stored {len(history)} of {len(entries)} entries")
 
-    futures = []
-    for entry in entries:
-        entry['id'] = f"{entry['system']}_{entry['fs']}_{entry['project']}"
-        if entry['project'] in my_groups:
-            futures.append(writer.upsert_item("storage_latest",entry))
+    print("Making latest entries")
 
-    if futures:
-        await asyncio.wait(futures)
-    futures = []
+    for entry,d in zip(entries,due):
+        entry['id'] = latest_id(entry)
+        if storage_series.CHANGE_ONLY:
+            entry['sample'] = storage_series.sample(entry) if d else samples[entry['id']]
 
-    ### Finally, handle stale entries in 'storage_latest' database
-    for item in await writer.query('storage_latest',where=[f'ts != "{ts}"','fs != "massdata"']):
-        futures.append(writer.delete_item('storage_latest',item))
+    ### Only changed entries are written, and anything in 'storage_latest'
+    ### that wasn't seen this time is removed, leaving massdata entries to
+    ### update_nci_account
+    written, deleted = await writer.sync_latest("storage_latest",entries,where=latest_where)
+    print(f"{written} of {len(entries)} latest entries changed, {deleted} removed")
 
-    if futures:
-        await asyncio.wait(futures)
+    blob_writer = blob.BlobWriter()
+    storage_snapshot.publish(blob_writer,await writer.query('files_report_latest'),await writer.query('storage_latest'),ts,['storage','lquota'])
     await writer.close()
 
+    blob_writer.mark_ingest(['storage','lquota'],ts)
+
 def async_main():
     asyncio.run(main())
 
@@ -3,13 +3,11 @@ import uuid
 import asyncio
 from datetime import datetime
 
-from typing import Dict, List, Union
+from typing import Any, Dict, List, Union
 
-from ..lib import remote_command, config, group_list
+from ..lib import remote_command, config, group_list, blob, storage_snapshot, compute_series
 from ..lib.cosmosdb import aio as cosmosdb
 
-RATE_LIMIT=100
-
 def construct_compute_entry(user: str, val: float, ts: str, proj: str) -> Dict[str,Union[str,float]]:
     return {
         'id': str(uuid.uuid4()),
@@ -79,12 +77,45 @@ def parse_block(block: List[str],ts: str) -> List[Dict[str,Union[str,float]]]:
     return out
         
 
+def summarise_compute(entries: List[Dict[str,Union[str,float]]], ts: str) -> List[Dict[str,Any]]:
+    ### For every user and project, the usage breakdown served by a getOne
+    ### on compute_latest: the user's (project's) total across all their
+    ### projects (users), followed by their usage in each project (by each
+    ### user), largest first.
+    lines={}
+    for entry in entries:
+        if 'fs' in entry: continue
+        lines.setdefault(entry['user'],[]).append(entry)
+        if entry['project'] != entry['user']:
+            lines.setdefault(entry['project'],[]).append(entry)
+
+    out=[]
+    for name, name_lines in lines.items():
+        if name in ( 'grant','total' ): continue
+        tmp = { i['user']:0.0 for i in name_lines if i['user'] not in ( 'grant','total' )} | { i['project']:0.0 for i in name_lines }
+        for line in name_lines:
+            if line['user'] in ( 'grant','total' ): continue
+            tmp[line['user']] = round(line['usage']+tmp[line['user']],2)
+            tmp[line['project']] = round(line['usage']+tmp[line['project']],2)
+        out.append({
+            'id': name,
+            'ts': ts,
+            'system': config.settings['remote_cmd_host'],
+            ### Pairs rather than an object to keep the ordering
+            'summary': sorted(tmp.items(), key=lambda x: x[1], reverse=True),
+        })
+    return out
+
 async def main():
 
     writer = cosmosdb.CosmosDBWriter()
-    compute_future = writer.get_container('compute',cosmosdb.DATABASE_ID,quarterly=True)
+    ### Compute history goes to one or the other, see lib/compute_series.py
+    compute_container = compute_series.CONTAINER if compute_series.PACKED else 'compute'
+    compute_future = writer.get_container(compute_container,cosmosdb.DATABASE_ID,quarterly=True)
     compute_latest_future = writer.get_container('compute_latest',cosmosdb.DATABASE_ID)
+    compute_summary_future = writer.get_container('compute_summary',cosmosdb.DATABASE_ID)
     storage_latest_future = writer.get_container('storage_latest',cosmosdb.DATABASE_ID)
+    files_latest_future = writer.get_container('files_report_latest',cosmosdb.DATABASE_ID)
     storage_future = writer.get_container('storage',cosmosdb.DATABASE_ID,quarterly=True)
     ### Placeholder for grabbing list of groups
     ts = datetime.now().isoformat() + "Z"
@@ -92,7 +123,7 @@ async def main():
 
     nci_account_out = remote_command.run_remote_cmd([f'for i in {" ".join(my_groups)}; do nci_account -P $i -vvv --no-pretty-print; sleep 0.1; done'])
     if not nci_account_out:
-        await asyncio.wait([compute_future,storage_future,compute_latest_future,storage_latest_future])
+        await asyncio.gather(compute_future,storage_future,compute_latest_future,storage_latest_future,compute_summary_future,files_latest_future)
         await writer.close()
         exit("No data received, check subprocess status")
 
@@ -108,59 +139,44 @@ async def main():
     ### Get the last entry
     entry_list.extend(parse_block(nci_account_out[block_start:],ts))
     
-    await asyncio.wait([compute_future,storage_future,compute_latest_future,storage_latest_future])
-
-    futures = []
-    counter = 0
-    for entry in entry_list:
-        ### In this case we can have both 'storage' and 'compute' entries
-        ### Figure out which and create the item in the right database
-            if 'fs' in entry:
-                futures.append(writer.create_item('storage',entry))
-            else:
-                futures.append(writer.create_item('compute',entry))
-
-            counter += 1
-            if counter >= RATE_LIMIT:
-                await asyncio.wait(futures)
-                counter=0
-                futures=[]
-
-    if futures:
-        await asyncio.wait(futures)
-
-    futures = []
-    counter = 0
-    for entry in entry_list:
-        if 'fs' in entry:
-            entry['id'] = f"{entry['system']}_massdata_{entry['project']}"
-            futures.append(writer.upsert_item('storage_latest',entry))
-        else:
-            entry['id'] = f"{entry['system']}_{entry['user']}_{entry['project']}"
-            futures.append(writer.upsert_item('compute_latest',entry))
-
-        counter += 1
-        if counter >= RATE_LIMIT:
-            await asyncio.wait(futures)
-            counter=0
-            futures=[]
-
-    if futures:
-        await asyncio.wait(futures)
-    futures = []
-
-    ### Finally, handle stale entries 'compute_latest' database
-    for item in await writer.query('compute_latest',where=f'ts != "{ts}"'):
-        futures.append(writer.delete_item('compute_latest',item))
-
-    ### And any stale massdata entries
-    for item in await writer.query('storage_latest',where=[f'ts != "{ts}"','fs = "massdata"']):
-        futures.append(writer.delete_item('storage_latest',item))
-
-    if futures:
-        await asyncio.wait(futures)
+    await asyncio.gather(compute_future,storage_future,compute_latest_future,storage_latest_future,compute_summary_future,files_latest_future)
+
+    ### In this case we can have both 'storage' and 'compute' entries
+    ### Figure out which and create the items in the right database
+    storage_entries = [ entry for entry in entry_list if 'fs' in entry ]
+    compute_entries = [ entry for entry in entry_list if 'fs' not in entry ]
+    if compute_series.PACKED:
+        _, created = await asyncio.gather(writer.create_items('storage',storage_entries),
+                                          writer.append_items(compute_series.CONTAINER,compute_series.pack(compute_entries),'samples'))
+        print(f"{compute_series.CONTAINER}: {len(compute_entries)} samples appended, {created} new documents")
+    else:
+        await asyncio.gather(writer.create_items('storage',storage_entries),
+                             writer.create_items('compute',compute_entries))
+
+    for entry in storage_entries:
+        entry['id'] = f"{entry['system']}_massdata_{entry['project']}"
+    for entry in compute_entries:
+        entry['id'] = f"{entry['system']}_{entry['user']}_{entry['project']}"
+
+    ### Materialise the per-user and per-project summaries so the API can
+    ### serve them with a single point read
+    summaries = summarise_compute(entry_list,ts)
+    ### Only changed entries are written. Anything in 'compute_latest' that
+    ### wasn't seen this time is removed, as are summaries for users or
+    ### projects that have gone away and any stale massdata entries
+    results = await asyncio.gather(writer.sync_latest('storage_latest',storage_entries,where=cosmosdb.Filter().compare('fs','=','massdata')),
+                                   writer.sync_latest('compute_latest',compute_entries),
+                                   writer.sync_latest('compute_summary',summaries))
+    for container,docs,( written, deleted ) in zip([ 'storage_latest', 'compute_latest', 'compute_summary' ],[ storage_entries, compute_entries, summaries ],results):
+        print(f"{container}: {written} of {len(docs)} entries changed, {deleted} removed")
+
+    ### massdata entries are part of storage_latest too
+    blob_writer = blob.BlobWriter()
+    storage_snapshot.publish(blob_writer,await writer.query('files_report_latest'),await writer.query('storage_latest'),ts,['compute','storage','massdata'])
     await writer.close()
 
+    blob_writer.mark_ingest(['compute','storage','massdata'],ts)
+
 def async_main():
     asyncio.run(main())
 
@@ -1,189 +1,227 @@
 #!/usr/bin/env python3
-import json
+import asyncio
 import uuid
 from datetime import datetime
 
-from ..lib import cosmosdb, remote_command, config, group_list, blob
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
 
-def main():
+from ..lib import remote_command, config, group_list, blob, serialise, storage_snapshot
+from ..lib.cosmosdb import aio as cosmosdb
+
+### How many ssh sessions to the remote host can be open at once
+REMOTE_CONCURRENCY=4
+
+def latest_id(entry: Dict[str,Any]) -> str:
+    return f"{entry['system']}_{entry['fs']}_{entry['user']}_{entry['ownership']}_{entry['location']}"
+
+async def run_remote_cmd(sem: asyncio.Semaphore, cmd: List[str]) -> List[str]:
+    ### ssh blocks, so run it off the event loop
+    async with sem:
+        return await asyncio.to_thread(remote_command.run_remote_cmd,cmd)
+
+async def get_quota_types(sem: asyncio.Semaphore, fs_path: str, all_groups: Dict[int,str], my_groups: List[str]) -> Dict[str,List[str]]:
+
+    ### Figure out if their {{filesystem}} directories a) exist and b) use group or
+    ### project quotas
+    ### Figure out some way to capture this in the db
+    quota_types = await run_remote_cmd(sem, [ f'for i in {" ".join([ i[1] + "+" + str(i[0]) for i in all_groups.items() if i[1] in my_groups])}; do if [[ -d {fs_path}/${{i%+*}} ]]; then lfs quota -p ${{i#*+}} {fs_path}/${{i%+*}} > /dev/null 2>&1 && echo ${{i%+*}} --project || echo "${{i%+*}}" "--group"; fi; done' ] )
+    ### Organise into quota types dict
+    quota_types_d={}
+    for i in quota_types:
+        proj, kind = i.split()
+        try:
+            quota_types_d[kind].append(proj)
+        except KeyError:
+            quota_types_d[kind] = [ proj, ]
+    return quota_types_d
+
+def make_entries(report: List[Dict[str,Any]], fs: str, ts: str, all_users: Dict[int,str], all_groups: Dict[int,str], unknown_users: Set[Union[int,str]], unknown_groups: Set[Union[int,str]]) -> Tuple[List[Dict[str,Any]],List[Dict[str,Any]]]:
+
+    ### Returns the entries that can be written straight away, and those
+    ### that have to wait until their unknown users or groups are looked up
+    entries=[]
+    deferred_entries=[]
+    group_names = set(all_groups.values())
+    for entry in report:
+        defer_entry = False
+
+        try:
+            user = all_users[entry['uid']]
+        except:
+            user = entry['uid']
+            defer_entry = True
+            unknown_users.add(entry['uid'])
+
+        try:
+            ownership = all_groups[entry['gid']]
+        except KeyError:
+            ownership = entry['gid']
+            defer_entry = True
+            unknown_groups.add(entry['gid'])
+
+        location = entry['project']
+        ### In theory this should never happen as we can't access
+        ### quota info about projects we're not a member of
+        if location not in group_names:
+            defer_entry = True
+            unknown_groups.add(entry['project'])
+
+        size = 512 * int(entry['blocks']['single'] + entry['blocks']['multiple'])
+        inodes = int(entry['count']['single'] + entry['count']['multiple'])
+
+        db_entry= { 'ts':ts,
+                    'id':str(uuid.uuid4()),
+                    'fs':fs,
+                    'user':user,
+                    'ownership':ownership,
+                    'location':location,
+                    'size':size,
+                    'inodes':inodes,
+                    'system':config.settings['remote_cmd_host']
+                  }
+
+        if defer_entry:
+            deferred_entries.append(db_entry)
+        else:
+            entries.append(db_entry)
+
+    return entries, deferred_entries
+
+async def write_entries(writer: cosmosdb.CosmosDBWriter, entries: List[Dict[str,Any]]) -> List[Dict[str,Any]]:
+    ### Returns the entries for files_report_latest, which are written
+    ### once every report is in
+    latest_entries = []
+    for entry in entries:
+        latest_db_entry = entry.copy()
+        latest_db_entry['id'] = latest_id(entry)
+        latest_entries.append(latest_db_entry)
+    await writer.create_items("files_report",entries)
+    return latest_entries
+
+async def process_report(sem: asyncio.Semaphore, writer: cosmosdb.CosmosDBWriter, fs: str, kind: str, projects: List[str], ts: str, all_users: Dict[int,str], all_groups: Dict[int,str], unknown_users: Set[Union[int,str]], unknown_groups: Set[Union[int,str]]) -> Optional[Tuple[List[Dict[str,Any]],List[Dict[str,Any]]]]:
+
+    ### Fetch, transform and write one report. Several of these run at once,
+    ### so the next report is on its way while this one is being written.
+    ### Returns the latest entries and the deferred entries, or None when
+    ### the report comes back empty.
+    out = await run_remote_cmd(sem,['nci-files-report',kind,' '.join(projects),'--filesystem',fs,'--json'])
+    nci_files_report_out = serialise.loads(out[0]) if out else None
+    if not nci_files_report_out:
+        return None
+    entries, deferred_entries = make_entries(nci_files_report_out,fs,ts,all_users,all_groups,unknown_users,unknown_groups)
+    return await write_entries(writer,entries), deferred_entries
+
+async def resolve_unknown(sem: asyncio.Semaphore, blob_writer: blob.BlobWriter, unknown_users: Set[Union[int,str]], unknown_groups: Set[Union[int,str]], all_users_d: Dict[str,Any], all_groups_d: Dict[str,Any], all_users: Dict[int,str], all_groups: Dict[int,str]) -> None:
+
+    if unknown_users:
+        missing_user_data=await run_remote_cmd(sem,[f'for i in {" ".join([ str(i) for i in unknown_users ])}; do getent passwd $i; id -Gn $i; sleep 0.01; done'])
+        for passwd,idgn in zip(missing_user_data[0::2],missing_user_data[1::2]):
+            pw=passwd.split(':')
+            groups=idgn.split()
+            all_users_d[pw[0]]={ 'uid': int(pw[2]),
+                         'gid': int(pw[3]),
+                         'pw_name': pw[4],
+                         'home': pw[5],
+                         'groups': groups
+                        }
+            print(f"User entry for {pw[0]} created")
+            all_users[int(pw[2])]=pw[0]
+        await asyncio.to_thread(blob_writer.write_item,all_users_d,blob.CONTAINER,'users')
+
+    if unknown_groups:
+        missing_group_data=await run_remote_cmd(sem,[f'for i in {" ".join([ str(i) for i in unknown_groups ])}; do getent group $i; done'])
+        print(missing_group_data)
+        for line in missing_group_data:
+            print(unknown_groups)
+            split_line=line.split(':')
+            if split_line[0] in unknown_groups or int(split_line[2]) in unknown_groups:
+                group_users=split_line[3].split(',')
+                all_groups_d[split_line[0]]={ 'gid': int(split_line[2]),
+                              'users': group_users
+                            }
+                ### unknown_groups can contain either gids or group names
+                ### Fortunately, gids are always first, so we can discard the
+                ### group name if it exists to prevent multiple entries
+                ### being created for the same group name.
+                unknown_groups.discard(split_line[0])
+                unknown_groups.discard(int(split_line[2]))
+                print(f"Group entry for {split_line[0]} created")
+                all_groups[int(split_line[2])]=split_line[0]
+        await asyncio.to_thread(blob_writer.write_item,all_groups_d,blob.CONTAINER,'groups')
+
+async def main():
 
     ### Grab the list of groups we care about out of the database
     blob_writer=blob.BlobWriter()
     writer = cosmosdb.CosmosDBWriter()
-    #_ = writer.get_container("groups",cosmosdb.DATABASE_ID)
-    #_ = writer.get_container("users",cosmosdb.DATABASE_ID)
-    _ = writer.get_container("files_report",cosmosdb.DATABASE_ID,quarterly=True)
-    _ = writer.get_container("files_report_latest",cosmosdb.DATABASE_ID)
-    #await asyncio.gather(groups_future,users_future)
-    
-    all_groups_d = blob_writer.read_item(blob.CONTAINER,'groups')
-    all_users_d = blob_writer.read_item(blob.CONTAINER,'users')
+    containers_future = asyncio.gather(writer.get_container("files_report",cosmosdb.DATABASE_ID,quarterly=True),
+                                       writer.get_container("files_report_latest",cosmosdb.DATABASE_ID),
+                                       writer.get_container("storage_latest",cosmosdb.DATABASE_ID))
 
-    my_groups = group_list.get_group_list()
+    all_groups_d, all_users_d, my_groups = await asyncio.gather(asyncio.to_thread(blob_writer.read_item,blob.CONTAINER,'groups'),
+                                                                asyncio.to_thread(blob_writer.read_item,blob.CONTAINER,'users'),
+                                                                asyncio.to_thread(group_list.get_group_list))
 
     ts=datetime.now().isoformat() + "Z"
 
-    defer_entry = False
-    unknown_users=set()
-    unknown_groups=set()
-    deferred_entries=[]
-
-    #all_groups_d, all_users_d = await asyncio.gather(all_groups_future,all_users_future)
     all_groups = dict([ (v['gid'],k ) for k,v in all_groups_d.items() ])
     ### Use this to key off of username rather than uid on db insert
     all_users = dict([(v['uid'],k) for k,v in all_users_d.items() ])
 
-    #futures=[]
-
-    #_ = await files_report_future
-
-    for i,fs in enumerate(config.settings['remote_fs_keys']):
-        fs_path=config.settings['remote_fs_paths'][i]
-
-        ### Figure out if their {{filesystem}} directories a) exist and b) use group or
-        ### project quotas
-        ### Figure out some way to capture this in the db
-        quota_types = remote_command.run_remote_cmd( [ f'for i in {" ".join([ i[1] + "+" + str(i[0]) for i in all_groups.items() if i[1] in my_groups])}; do if [[ -d {fs_path}/${{i%+*}} ]]; then lfs quota -p ${{i#*+}} {fs_path}/${{i%+*}} > /dev/null 2>&1 && echo ${{i%+*}} --project || echo "${{i%+*}}" "--group"; fi; done' ] )
-        if not quota_types:
-            exit("No data received, check subprocess status")
-        ### Organise into quota types dict
-        quota_types_d={}
-        for i in quota_types:
-            proj, kind = i.split()
-            try:
-                quota_types_d[kind].append(proj)
-            except KeyError:
-                quota_types_d[kind] = [ proj, ]
-        
-        unknown_users=set()
-        unknown_groups=set()
-        deferred_entries=[]
-
-        for k,v in quota_types_d.items():
-            if v:
-                nci_files_report_out = json.loads(remote_command.run_remote_cmd(['nci-files-report',k,' '.join(v),'--filesystem',fs,'--json'])[0])
-                if not nci_files_report_out:
-                    exit("No data received, check subprocess status")
-                for entry in nci_files_report_out:
-                    defer_entry = False
-
-                    try:
-                        user = all_users[entry['uid']]
-                    except:
-                        user = entry['uid']
-                        defer_entry = True
-                        unknown_users.add(entry['uid'])
-                    
-                    try:
-                        ownership = all_groups[entry['gid']]
-                    except KeyError:
-                        ownership = entry['gid']
-                        defer_entry = True
-                        unknown_groups.add(entry['gid'])
-
-                    
-                    location = entry['project']
-                    ### In theory this should never happen as we can't access
-                    ### quota info about projects we're not a member of
-                    if location not in list(all_groups.values()):
-                        defer_entry = True
-                        unknown_groups.add(entry['project'])
-
-                    size = 512 * int(entry['blocks']['single'] + entry['blocks']['multiple'])
-                    inodes = int(entry['count']['single'] + entry['count']['multiple'])
-
-                    db_entry= { 'ts':ts,
-                                'id':str(uuid.uuid4()),
-                                'fs':fs,
-                                'user':user,
-                                'ownership':ownership,
-                                'location':location,
-                                'size':size,
-                                'inodes':inodes,
-                                'system':config.settings['remote_cmd_host']
-                              }
-
-                    if defer_entry:
-                        deferred_entries.append(db_entry)
-                    else:
-                        #futures.append(writer.create_item("files_report",db_entry))
-                        writer.create_item("files_report",db_entry)
-                        latest_db_entry = db_entry.copy()
-                        latest_db_entry['id'] = f"{db_entry['system']}_{db_entry['fs']}_{db_entry['user']}_{db_entry['ownership']}_{db_entry['location']}"
-                        writer.upsert_item("files_report_latest",latest_db_entry)
-        
-        if unknown_users:
-            missing_user_data=remote_command.run_remote_cmd([f'for i in {" ".join([ str(i) for i in unknown_users ])}; do getent passwd $i; id -Gn $i; sleep 0.01; done'])
-            for passwd,idgn in zip(missing_user_data[0::2],missing_user_data[1::2]):
-                pw=passwd.split(':')
-                groups=idgn.split()
-                all_users_d[pw[0]]={ 'uid': int(pw[2]),
-                             'gid': int(pw[3]),
-                             'pw_name': pw[4],
-                             'home': pw[5],
-                             'groups': groups
-                            }
-                #futures.append(writer.create_item('users',user_entry))
-                print(f"User entry for {pw[0]} created")
-                all_users[int(pw[2])]=pw[0]
-            blob_writer.write_item(all_users_d,blob.CONTAINER,'users')
-
-        if unknown_groups:
-            missing_group_data=remote_command.run_remote_cmd([f'for i in {" ".join([ str(i) for i in unknown_groups ])}; do getent group $i; done'])
-            print(missing_group_data)
-            for line in missing_group_data:
-                print(unknown_groups)
-                split_line=line.split(':')
-                if split_line[0] in unknown_groups or int(split_line[2]) in unknown_groups:
-                    group_users=split_line[3].split(',')
-                    all_groups_d[split_line[0]]={ 'gid': int(split_line[2]),
-                                  'users': group_users
-                                }
-                    #futures.append(writer.create_item('groups',group_entry))
-                    #writer.create_item('groups',group_entry)
-                    ### unknown_groups can contain either gids or group names
-                    ### Fortunately, gids are always first, so we can discard the
-                    ### group name if it exists to prevent multiple entries
-                    ### being created for the same group name.
-                    unknown_groups.discard(split_line[0])
-                    unknown_groups.discard(int(split_line[2]))
-                    print(f"Group entry for {split_line[0]} created")
-                    all_groups[int(split_line[2])]=split_line[0]
-            blob_writer.write_item(all_groups_d,blob.CONTAINER,'groups')
-        
-        for entry in deferred_entries:
-            try:
-                entry['user']=all_users[entry['user']]
-            except KeyError:
-                ### OK to pass, means its already a valid group
-                pass
-            
-            try:
-                entry['ownership']=all_groups[entry['ownership']]
-            except KeyError:
-                pass
-
-            try:
-                entry['location']=all_groups[entry['location']]
-            except KeyError:
-                pass
-
-            #futures.append(writer.create_item("files_report",db_entry))
-            writer.create_item("files_report",entry)
-            latest_db_entry = entry.copy()
-            latest_db_entry['id'] = f"{entry['system']}_{entry['fs']}_{entry['user']}_{entry['ownership']}_{entry['location']}"
-            writer.upsert_item("files_report_latest",latest_db_entry)
-    
-    #await asyncio.gather(*futures)
-    #await writer.close()
-    ### Finally, handle stale entries in 'files_report_latest' database
-    for item in writer.query('files_report_latest',where=f'ts != "{ts}"'):
-        writer.delete_item('files_report_latest',item)
-
-
-#def async_main():
-#    asyncio.run(main())
+    sem = asyncio.Semaphore(REMOTE_CONCURRENCY)
+    all_quota_types = await asyncio.gather(*[ get_quota_types(sem,fs_path,all_groups,my_groups) for fs_path in config.settings['remote_fs_paths'] ])
+    await containers_future
+    if not all(all_quota_types):
+        await writer.close()
+        exit("No data received, check subprocess status")
+
+    ### Every report across every filesystem is in flight at once, limited
+    ### by REMOTE_CONCURRENCY for the remote side and the writer's
+    ### scheduler for Cosmos
+    unknown_users=set()
+    unknown_groups=set()
+    reports = await asyncio.gather(*[ process_report(sem,writer,fs,k,v,ts,all_users,all_groups,unknown_users,unknown_groups)
+                                       for fs,quota_types_d in zip(config.settings['remote_fs_keys'],all_quota_types)
+                                       for k,v in quota_types_d.items() if v ])
+    if any([ r is None for r in reports ]):
+        await writer.close()
+        exit("No data received, check subprocess status")
+
+    await resolve_unknown(sem,blob_writer,unknown_users,unknown_groups,all_users_d,all_groups_d,all_users,all_groups)
+
+    latest_entries = [ entry for l,_ in reports for entry in l ]
+    deferred_entries = [ entry for _,d in reports for entry in d ]
+    for entry in deferred_entries:
+        try:
+            entry['user']=all_users[entry['user']]
+        except KeyError:
+            ### OK to pass, means its already a valid group
+            pass
+
+        try:
+            entry['ownership']=all_groups[entry['ownership']]
+        except KeyError:
+            pass
+
+        try:
+            entry['location']=all_groups[entry['location']]
+        except KeyError:
+            pass
+
+    latest_entries.extend(await write_entries(writer,deferred_entries))
+
+    ### Finally, bring 'files_report_latest' up to date. Only changed entries
+    ### are written, and anything that wasn't seen this time is removed
+    written, deleted = await writer.sync_latest('files_report_latest',latest_entries)
+    print(f"{written} of {len(latest_entries)} latest entries changed, {deleted} removed")
+
+    storage_snapshot.publish(blob_writer,await writer.query('files_report_latest'),await writer.query('storage_latest'),ts,['files_report'])
+    await writer.close()
+
+    blob_writer.mark_ingest(['files_report'],ts)
+
+def async_main():
+    asyncio.run(main())
 
 if __name__ == "__main__":
-    #async_main()
-    main()
\ No newline at end of file
+    async_main()
@@ -0,0 +1,69 @@
+import base64
+import hashlib
+import hmac
+import json
+import time
+import uuid
+
+from typing import Container, Dict, Optional
+
+from . import config
+
+SECRET: Optional[str] = config.settings['auth_secret']
+TOKEN_LIFETIME: int = config.settings['auth_token_lifetime']
+REVOKED_BLOB: str = 'revoked_tokens'
+
+### Tokens are <payload>.<signature>, both unpadded urlsafe base64. The
+### payload carries a token id (for revocation) and an expiry time, the
+### signature is an HMAC-SHA256 of the encoded payload.
+
+def _encode(b: bytes) -> str:
+    return base64.urlsafe_b64encode(b).rstrip(b'=').decode()
+
+def _decode(s: str) -> bytes:
+    return base64.urlsafe_b64decode(s + '=' * (-len(s) % 4))
+
+def _sign(payload: str, secret: str) -> str:
+    return _encode(hmac.new(secret.encode(),payload.encode(),hashlib.sha256).digest())
+
+def is_signed_token(key: str) -> bool:
+    return key.count('.') == 1
+
+def issue_token(secret: str=SECRET, lifetime: int=TOKEN_LIFETIME) -> str:
+    payload = _encode(json.dumps({'jti':str(uuid.uuid4()),'exp':int(time.time())+lifetime},separators=(',',':')).encode())
+    return f"{payload}.{_sign(payload,secret)}"
+
+def read_token(key: str, secret: str=SECRET) -> Optional[Dict[str,int]]:
+    ### Returns the token's claims if the signature is valid and it has not
+    ### expired, None otherwise. Does no I/O.
+    try:
+        payload, signature = key.split('.')
+    except ValueError:
+        return None
+    ### compare_digest only takes str if it's all ASCII, and this is
+    ### straight from a request header
+    if not hmac.compare_digest(signature.encode(),_sign(payload,secret).encode()):
+        return None
+    try:
+        claims = json.loads(_decode(payload))
+    except ValueError:
+        return None
+    if claims.get('exp',0) < time.time():
+        return None
+    return claims
+
+def verify_token(key: str, revoked: Container[str], secret: str=SECRET) -> bool:
+    claims = read_token(key,secret)
+    if not claims:
+        return False
+    return claims['jti'] not in revoked
+
+def revoke_token(revoked: Dict[str,int], key: str, secret: str=SECRET) -> Dict[str,int]:
+    ### Adds a token to a deny list of jti -> expiry, and drops any entries
+    ### that have expired anyway so the list stays small
+    claims = read_token(key,secret)
+    now = time.time()
+    out = { k:v for k,v in revoked.items() if v >= now }
+    if claims:
+        out[claims['jti']] = claims['exp']
+    return out
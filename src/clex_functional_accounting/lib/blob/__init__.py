@@ -1,22 +1,53 @@
 from azure.storage.blob import BlobServiceClient, BlobClient, ContainerClient
+from azure.core import MatchConditions
 import azure.core.exceptions as az_exceptions
-import json
+import random
+import threading
+import time
 
-from typing import Dict, Any, Optional, List, Union
+from typing import Callable, Dict, Any, Optional, List, Union
 
 
-from .. import config
+from .. import config, local, pool, serialise, timing
+from ..cache import TTLCache
 
 HOST: str = config.settings['blob_host']
 WRITER_KEY: str = config.settings['blob_key']
 CONTAINER: str = config.settings['blob_container']
 DRY_RUN: bool = config.settings['dry_run']
+### Use the in-process stand-in instead of Blob storage
+LOCAL: bool = bool(config.settings['local_backend'])
+CACHE_TTL: float = config.settings['blob_cache_ttl']
+CACHE_SIZE: int = config.settings['blob_cache_size']
+### Records the last time each Cosmos-backed source was ingested
+INGEST_STATE: str = 'ingest_state'
+### How many times update_item tries before giving up
+UPDATE_ATTEMPTS: int = 10
+
+_MISSING = object()
+
+_shared_writer: Optional["BlobWriter"] = None
+_shared_lock = threading.Lock()
+
+def get_shared_writer() -> "BlobWriter":
+    ### One writer per process, reading through a process-wide cache, so
+    ### blobs are only downloaded when they change
+    global _shared_writer
+    with _shared_lock:
+        if _shared_writer is None:
+            _shared_writer = BlobWriter(cache=TTLCache(CACHE_TTL,CACHE_SIZE),pooled=True)
+    return _shared_writer
 
 class BlobWriter():
-    def __init__(self):
-        self.client = BlobServiceClient(HOST, WRITER_KEY)
+    def __init__(self,cache: Optional[TTLCache]=None,pooled: bool=False):
+        kwargs = {}
+        if pooled and not LOCAL:
+            kwargs['transport'] = pool.pooled_transport()
+        client_class = local.BlobServiceClient if LOCAL else BlobServiceClient
+        self.client = client_class(HOST, WRITER_KEY, **kwargs)
         self.container_clients = {}
         self.client_caches = {}
+        self.cache = cache
 
         if CONTAINER:
             _ = self.get_container(CONTAINER)
@@ -41,18 +72,118 @@ class BlobWriter():
         self.client_caches[f"{container}_{item}"] = data
 
         with self.client.get_blob_client(container=container,blob=item) as blob_client:
-            to_write = json.dumps(data)
-            blob_client.upload_blob(to_write,overwrite=True)
+            to_write = serialise.dumps(data)
+            with timing.span('blob.write'):
+                resp = blob_client.upload_blob(to_write,overwrite=True)
 
-    def read_item(self, container: str, item: str) -> Dict[Any,Any]:
+        if self.cache is not None:
+            self.cache.put(f"{container}_{item}",resp.get('etag',None),data)
+
+    def read_item(self, container: str, item: str, default: Any=_MISSING) -> Dict[Any,Any]:
+
+        ### If a default is given it is returned (and cached) in place of
+        ### a blob that does not exist
+        if self.cache is not None:
+            return self._read_item_cached(container,item,default)
 
         k = f"{container}_{item}"
         if k not in self.client_caches:
             with self.client.get_blob_client(container=container,blob=item) as blob_client:
-                to_read = blob_client.download_blob().readall()
-                self.client_caches[k] = json.loads(to_read)
+                try:
+                    with timing.span('blob.read'):
+                        to_read = blob_client.download_blob().readall()
+                except az_exceptions.ResourceNotFoundError:
+                    if default is _MISSING:
+                        raise
+                    return default
+                self.client_caches[k] = serialise.loads(to_read)
         return self.client_caches[k]
-        
+
+    def _read_item_cached(self, container: str, item: str, default: Any=_MISSING) -> Dict[Any,Any]:
+
+        ### Callers share the returned object with every other request in
+        ### this process, so it must be treated as read-only
+        k = f"{container}_{item}"
+        entry = self.cache.get(k)
+        if entry and entry.expires > time.monotonic():
+            return entry.data
+
+        with self.client.get_blob_client(container=container,blob=item) as blob_client, timing.span('blob.read'):
+            try:
+                if entry and entry.etag:
+                    downloader = blob_client.download_blob(etag=entry.etag,match_condition=MatchConditions.IfModified)
+                else:
+                    downloader = blob_client.download_blob()
+            except az_exceptions.ResourceNotModifiedError:
+                self.cache.refresh(k)
+                return entry.data
+            except az_exceptions.ResourceNotFoundError:
+                if default is _MISSING:
+                    raise
+                self.cache.put(k,None,default)
+                return default
+            data = serialise.loads(downloader.readall())
+
+        self.cache.put(k,downloader.properties.etag,data)
+        return data
+
+    def update_item(self, container: str, item: str, update: Callable[[Any],Dict[Any,Any]], default: Any=_MISSING) -> Dict[Any,Any]:
+
+        ### Read-modify-write of a blob that several processes update. The
+        ### blob is read uncached and update() applied to it, and the result
+        ### is only written if the blob hasn't changed since. If it has, the
+        ### whole thing is done again, so no concurrent update is lost.
+        ### default is passed to update() in place of a blob that does not
+        ### exist. Returns what was written
+        k = f"{container}_{item}"
+        for attempt in range(UPDATE_ATTEMPTS):
+            with self.client.get_blob_client(container=container,blob=item) as blob_client:
+                try:
+                    with timing.span('blob.read'):
+                        downloader = blob_client.download_blob()
+                    current, etag = serialise.loads(downloader.readall()), downloader.properties.etag
+                except az_exceptions.ResourceNotFoundError:
+                    if default is _MISSING:
+                        raise
+                    current, etag = default, None
+
+                data = update(current)
+                if DRY_RUN:
+                    print(f"Would have updated blob {item}")
+                    return data
+
+                try:
+                    with timing.span('blob.write'):
+                        if etag:
+                            resp = blob_client.upload_blob(serialise.dumps(data),overwrite=True,etag=etag,match_condition=MatchConditions.IfNotModified)
+                        else:
+                            resp = blob_client.upload_blob(serialise.dumps(data),overwrite=False)
+                except ( az_exceptions.ResourceModifiedError, az_exceptions.ResourceExistsError ):
+                    if attempt == UPDATE_ATTEMPTS - 1:
+                        raise
+                    time.sleep(random.uniform(0,0.05*2**min(attempt,5)))
+                    continue
+
+            self.client_caches[k] = data
+            if self.cache is not None:
+                self.cache.put(k,resp.get('etag',None),data)
+            return data
+
+    def get_etag(self, container: str, item: str) -> Optional[str]:
+
+        ### ETag of a blob as of the last time it was (re)validated
+        if self.cache is None:
+            return None
+        self._read_item_cached(container,item)
+        entry = self.cache.get(f"{container}_{item}")
+        return entry.etag if entry else None
+
+    def mark_ingest(self, sources: List[str], ts: str) -> None:
+
+        ### Ingest jobs finish close together, so this mustn't lose another
+        ### job's update
+        self.update_item(CONTAINER,INGEST_STATE,lambda state: state | { s:ts for s in sources },default={})
+
     def finalise(self):
         for c in self.container_clients.values():
             c.close()
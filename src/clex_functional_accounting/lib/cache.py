@@ -0,0 +1,53 @@
+import threading
+import time
+from collections import OrderedDict
+
+from typing import Any, Optional, NamedTuple
+
+class CacheEntry(NamedTuple):
+    expires: float
+    etag: Optional[str]
+    data: Any
+
+class TTLCache():
+    ### Thread-safe LRU cache whose entries carry an expiry time and an
+    ### optional validator (e.g. an ETag) to revalidate them with once they
+    ### expire. Expired entries are still returned by get(), use fresh() to
+    ### only see live ones.
+    def __init__(self,ttl: float,max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries: OrderedDict[str,CacheEntry] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self,key: str) -> Optional[CacheEntry]:
+        with self.lock:
+            entry = self.entries.get(key,None)
+            if entry:
+                self.entries.move_to_end(key)
+            return entry
+
+    def fresh(self,key: str) -> Optional[CacheEntry]:
+        entry = self.get(key)
+        if entry and entry.expires > time.monotonic():
+            return entry
+        return None
+
+    def put(self,key: str,etag: Optional[str],data: Any) -> None:
+        with self.lock:
+            self.entries[key] = CacheEntry(time.monotonic() + self.ttl,etag,data)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def refresh(self,key: str) -> None:
+        with self.lock:
+            if key in self.entries:
+                self.entries[key] = self.entries[key]._replace(expires=time.monotonic() + self.ttl)
+
+    def invalidate(self,key: Optional[str]=None) -> None:
+        with self.lock:
+            if key:
+                self.entries.pop(key,None)
+            else:
+                self.entries.clear()
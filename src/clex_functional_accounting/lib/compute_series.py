@@ -0,0 +1,59 @@
+from datetime import datetime, timedelta
+
+from typing import Any, Dict, List, Optional
+
+from . import config, quarters
+
+### Packed compute history. With compute_packed set, update_nci_account
+### stores each (system, project, user) series in 'compute_packed' as one
+### document per day, or per week with compute_pack_period set to 'week',
+### holding the [ts, usage] samples taken in it. Each run appends its
+### sample to the document for the current period, in place of writing a
+### 'compute' row. unpack() turns the documents back into 'compute' rows.
+
+PACKED: bool = config.settings['compute_packed']
+PERIOD: str = config.settings['compute_pack_period']
+CONTAINER = 'compute_packed'
+### Fields of a packed document that are the same for every sample in it
+SERIES_FIELDS = ( 'system', 'project', 'user' )
+
+def parse_ts(ts: str) -> datetime:
+    return datetime.fromisoformat(ts[:-1] if ts.endswith('Z') else ts)
+
+def period_start(t: datetime) -> datetime:
+    ### A document can only live in one quarterly partition, so weeks that
+    ### span a new quarter are cut in two
+    start = datetime(t.year,t.month,t.day)
+    if PERIOD == 'week':
+        start = max(start - timedelta(days=start.weekday()),quarters.quarter_start(t))
+    return start
+
+def pack(entries: List[Dict[str,Any]]) -> List[Dict[str,Any]]:
+    ### Compute entries, as documents to append to
+    out: Dict[str,Dict[str,Any]] = {}
+    for entry in sorted(entries,key=lambda x: x['ts']):
+        period = period_start(parse_ts(entry['ts'])).date().isoformat()
+        id = f"{entry['system']}_{entry['user']}_{entry['project']}_{period}"
+        if id in out:
+            out[id]['ts'] = entry['ts']
+            out[id]['samples'].append([ entry['ts'], entry['usage'] ])
+            continue
+        out[id] = { 'id': id,
+                    'period': period,
+                    'ts': entry['ts'],
+                    'samples': [ [ entry['ts'], entry['usage'] ], ] } | { f:entry[f] for f in SERIES_FIELDS }
+    return list(out.values())
+
+def unpack(docs: List[Dict[str,Any]], start: Optional[datetime] = None, end: Optional[datetime] = None) -> List[Dict[str,Any]]:
+    ### The 'compute' rows held in docs with start < ts < end
+    lo = start.isoformat() if start else None
+    hi = end.isoformat() if end else None
+    out=[]
+    for doc in docs:
+        for ts, usage in doc['samples']:
+            if ( lo and ts <= lo ) or ( hi and ts >= hi ):
+                continue
+            out.append({ 'id': f"{doc['system']}_{doc['user']}_{doc['project']}_{ts}",
+                         'ts': ts,
+                         'usage': usage } | { f:doc[f] for f in SERIES_FIELDS })
+    return out
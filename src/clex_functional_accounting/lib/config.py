@@ -20,5 +20,20 @@ settings = {
     'dry_run': os.environ.get('CLEXFA_DRY_RUN',False),
     'blob_container': os.environ.get('REMOTE_CMD_HOST',None),
     'blob_host': os.environ.get('BLOB_ACCOUNT_HOST'),
-    'blob_key': os.environ.get('BLOB_ACCOUNT_KEY')
+    'blob_key': os.environ.get('BLOB_ACCOUNT_KEY'),
+    'blob_cache_ttl': float(os.environ.get('CLEXFA_BLOB_CACHE_TTL',300)),
+    'blob_cache_size': int(os.environ.get('CLEXFA_BLOB_CACHE_SIZE',16)),
+    'client_pool_size': int(os.environ.get('CLEXFA_CLIENT_POOL_SIZE',16)),
+    'query_concurrency': int(os.environ.get('CLEXFA_QUERY_CONCURRENCY',8)),
+    'continuation_cache_ttl': float(os.environ.get('CLEXFA_CONTINUATION_CACHE_TTL',300)),
+    'continuation_cache_size': int(os.environ.get('CLEXFA_CONTINUATION_CACHE_SIZE',1024)),
+    'auth_secret': os.environ.get('CLEXFA_AUTH_SECRET',None),
+    'auth_token_lifetime': int(os.environ.get('CLEXFA_AUTH_TOKEN_LIFETIME',86400)),
+    'auth_legacy_keys': os.environ.get('CLEXFA_AUTH_LEGACY_KEYS','1') not in ( '0', 'false', 'False' ),
+    'local_backend': os.environ.get('CLEXFA_LOCAL_BACKEND',None),
+    'storage_change_only': os.environ.get('CLEXFA_STORAGE_CHANGE_ONLY','0') not in ( '0', 'false', 'False' ),
+    'storage_change_threshold': float(os.environ.get('CLEXFA_STORAGE_CHANGE_THRESHOLD',0.0)),
+    'storage_max_sample_age': float(os.environ.get('CLEXFA_STORAGE_MAX_SAMPLE_AGE',24)),
+    'compute_packed': os.environ.get('CLEXFA_COMPUTE_PACKED','0') not in ( '0', 'false', 'False' ),
+    'compute_pack_period': os.environ.get('CLEXFA_COMPUTE_PACK_PERIOD','day'),
 }
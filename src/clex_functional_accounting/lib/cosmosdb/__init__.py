@@ -4,19 +4,41 @@ import azure.cosmos.container as cosmos_container
 import azure.cosmos.exceptions as cosmos_exceptions
 from azure.cosmos.partition_key import PartitionKey
 from datetime import datetime
+import threading
 
-from typing import Dict, Any, Optional, List, Union
+from typing import Callable, Dict, Any, Iterator, Optional, List, Tuple, Union
 
-from .. import config
+from .. import config, local, pool, timing
+from . import batch, query_builder
+from .query_builder import Filter, InvalidQuery
 
 HOST: str = config.settings['cosmos_host']
 WRITER_KEY: str = config.settings['key']
 DATABASE_ID:str = config.settings['database_id']
 DRY_RUN: bool = config.settings['dry_run']
+### Use the in-process stand-in instead of Cosmos DB
+LOCAL: bool = bool(config.settings['local_backend'])
+
+_shared_writer: Optional["CosmosDBWriter"] = None
+_shared_lock = threading.Lock()
+
+def get_shared_writer() -> "CosmosDBWriter":
+    ### One writer per process. Database and container proxies are resolved
+    ### (and create-if-missing attempted) on first use only, after which
+    ### every caller reuses them along with the client's connection pool
+    global _shared_writer
+    with _shared_lock:
+        if _shared_writer is None:
+            _shared_writer = CosmosDBWriter(pooled=True)
+    return _shared_writer
 
 class CosmosDBWriter():
-    def __init__(self):
-        self.client = cosmos_client.CosmosClient(HOST, {'masterKey':WRITER_KEY}, user_agent="CosmosDBPythonQuickstart", user_agent_overwrite=True)
+    def __init__(self,pooled: bool=False):
+        kwargs = {}
+        if pooled and not LOCAL:
+            kwargs['transport'] = pool.pooled_transport()
+        client_class = local.CosmosClient if LOCAL else cosmos_client.CosmosClient
+        self.client = client_class(HOST, {'masterKey':WRITER_KEY}, user_agent="CosmosDBPythonQuickstart", user_agent_overwrite=True, **kwargs)
         self.db_clients = {}
         self.container_clients = {}
         self.quarterly = {}
@@ -54,7 +76,8 @@ class CosmosDBWriter():
         
         container_client=self.get_container(container)
         d['PartitionKey'] = self._get_partition_key_val(container)
-        container_client.create_item(body=d)
+        with timing.span('cosmos.write') as s:
+            container_client.create_item(body=d,response_hook=s.hook)
 
     def delete_item(self, container: str, d: Union[Dict[str,Any],str] ) -> None:
 
@@ -71,7 +94,8 @@ class CosmosDBWriter():
             pk=d.get('PartitionKey',None)
         if not pk:
             pk = self._get_partition_key_val(container)
-        container_client.delete_item(d,pk)
+        with timing.span('cosmos.write') as s:
+            container_client.delete_item(d,pk,response_hook=s.hook)
 
     def read_items(self, container: str, item: Any, field: Optional[str] = None, quarter: Optional[str] = None, once_off: bool = False) -> List[Dict[str,Any]]:
 
@@ -88,7 +112,8 @@ class CosmosDBWriter():
             partition_key_val = self._get_partition_key_val(container,quarter)
 
             try:
-                return [ container_client.read_item(item=item,partition_key=partition_key_val), ]
+                with timing.span('cosmos.read') as s:
+                    return [ container_client.read_item(item=item,partition_key=partition_key_val,response_hook=s.hook), ]
             except cosmos_exceptions.CosmosResourceNotFoundError:
                 return []
 
@@ -115,7 +140,8 @@ class CosmosDBWriter():
             if container not in self.container_clients:
                 raise NotImplementedError("Container client does not exist")
             
-            self.client_caches[container] = list(self.container_clients[container].read_all_items())
+            with timing.span('cosmos.read') as s:
+                self.client_caches[container] = list(self.container_clients[container].read_all_items(response_hook=s.hook))
         
         return self.client_caches[container]
         
@@ -131,53 +157,120 @@ class CosmosDBWriter():
 
         container_client=self.get_container(container)
         d['PartitionKey'] = self._get_partition_key_val(container)
-        container_client.upsert_item(body=d)
+        with timing.span('cosmos.write') as s:
+            container_client.upsert_item(body=d,response_hook=s.hook)
 
-    def query(self, container: str, fields: Optional[Union[str,List[str]]]=None,where: Optional[List[str]] = None,order: Optional[str] = None,offset: Optional[int] = None,limit: Optional[int] = None, quarter: Optional[str] = None):
+    def create_items(self, container: str, docs: List[Dict[str,Any]]) -> None:
+        self._bulk(container,'create',docs)
+
+    def upsert_items(self, container: str, docs: List[Dict[str,Any]]) -> None:
+        self._bulk(container,'upsert',docs)
+
+    def delete_items(self, container: str, items: List[Union[Dict[str,Any],str]]) -> None:
+        self._bulk(container,'delete',items)
+
+    def _bulk(self, container: str, kind: str, items: List[Union[Dict[str,Any],str]]) -> None:
+
+        ### Many writes in as few requests as possible. Each batch is
+        ### transactional, if any operation in it fails none are applied
+        ### and CosmosBatchOperationError is raised
+        if DRY_RUN:
+            for d in items:
+                print(f"Would have {'deleted' if kind == 'delete' else 'created'}: {d}")
+            return
 
         if container not in self.container_clients:
             raise NotImplementedError("Container client does not exist")
-        
-        pkv = self._get_partition_key_val(container,quarter)
-
-        q = "SELECT"
-        if not fields:
-            q+=" * "
-        elif isinstance(fields,list):
-            q+=f" VALUE {{ {', '.join([ i+':  c.'+i for i in fields ])} }}"
-        elif isinstance(fields,str):
-            q+= f" VALUE {{ {fields}: c.{fields} }}"
-        q += " FROM c"
-
-        if where:
-            if isinstance(where,List):
-                q+=f" WHERE ( c.{' AND c.'.join(i for i in where)} )"
-            elif isinstance(where,str):
-                q+=f" WHERE c.{where}"
-            q+=f" AND c.PartitionKey = '{pkv}'"
-        else:
-            q+=f" WHERE c.PartitionKey = '{pkv}'"
 
-        if order:
-            q+=f" ORDER BY c.{order}"
+        container_client=self.get_container(container)
+        for pk,ops in batch.batches(batch.operations(kind,items,self._get_partition_key_val(container))):
+            with timing.span('cosmos.write') as s:
+                container_client.execute_item_batch(ops,pk,response_hook=s.hook)
 
-        if offset:
-            q+=f" OFFSET {offset}"
-        elif limit:
-            q+=f" OFFSET 0"
+    def query(self, container: str, fields: Optional[Union[str,List[str]]]=None,where: Optional[Filter] = None,order: Optional[str] = None,offset: Optional[int] = None,limit: Optional[int] = None, quarter: Optional[str] = None):
 
-        if limit:
-            q+=f" LIMIT {limit}"
-        elif offset:
-            q+=f" LIMIT 10000"
+        try:
+            return list(self.query_iter(container,fields,where,order,offset,limit,quarter))
+        except cosmos_exceptions.CosmosHttpResponseError:
+            return []
 
-        container_client = self.get_container(container)
+    def query_iter(self, container: str, fields: Optional[Union[str,List[str]]]=None,where: Optional[Filter] = None,order: Optional[str] = None,offset: Optional[int] = None,limit: Optional[int] = None, quarter: Optional[str] = None, page_size: Optional[int] = None) -> Iterator[Dict[str,Any]]:
+
+        ### Same as query, but results are fetched from the server a page
+        ### at a time as the caller iterates. Errors are raised rather than
+        ### ending the results early, as a response streaming these has
+        ### nothing else to tell a short list from a complete one by
+        q, params = query_builder.build(query_builder.select_fields(fields),where,order,offset,limit)
+
+        ### Only time spent fetching pages counts, not time spent by the caller
+        s = timing.span('cosmos.query')
+        pages = self._query_items(container,q,params,quarter,s.hook,max_item_count=page_size).by_page()
+        while True:
+            with s:
+                page = next(pages,None)
+                if page is None:
+                    return
+                page = list(page)
+            yield from page
+
+    def query_page(self, container: str, fields: Optional[Union[str,List[str]]]=None,where: Optional[Filter] = None,order: Optional[str] = None, quarter: Optional[str] = None, page_size: int = 100, continuation: Optional[str] = None) -> Tuple[List[Dict[str,Any]],Optional[str]]:
+
+        ### Returns up to page_size results starting from where the query that
+        ### returned 'continuation' left off, along with the token to pass in
+        ### to get the page after this one. The token is None when there are
+        ### no more results.
+        q, params = query_builder.build(query_builder.select_fields(fields),where,order)
+
+        items=[]
+        try:
+            with timing.span('cosmos.query') as s:
+                while len(items) < page_size:
+                    pager = self._query_items(container,q,params,quarter,s.hook,max_item_count=page_size-len(items)).by_page(continuation)
+                    items.extend(next(pager))
+                    continuation = pager.continuation_token
+                    if not continuation:
+                        break
+        except StopIteration:
+            continuation = None
+        except cosmos_exceptions.CosmosHttpResponseError:
+            return [], None
+
+        return items, continuation
+
+    def count(self, container: str, where: Optional[Filter] = None, quarter: Optional[str] = None) -> int:
+
+        q, params = query_builder.build("VALUE COUNT(1)",where)
 
         try:
-            return list(container_client.query_items(q))
+            with timing.span('cosmos.count') as s:
+                return sum(self._query_items(container,q,params,quarter,s.hook))
+        except cosmos_exceptions.CosmosHttpResponseError:
+            return 0
+
+    def aggregate(self, container: str, group: Dict[str,str], values: Dict[str,str], where: Optional[Filter] = None, quarter: Optional[str] = None) -> List[Dict[str,Any]]:
+
+        ### Server-side GROUP BY. group and values both map output field names
+        ### to expressions, e.g. group={'day': 'LEFT(c.ts,10)'} and
+        ### values={'usage': 'MAX(c.usage)'}
+        select = ', '.join([ f"{expr} AS {query_builder.check_field(alias)}" for alias,expr in ( group | values ).items() ])
+        q, params = query_builder.build(select,where,group=list(group.values()))
+
+        try:
+            with timing.span('cosmos.aggregate') as s:
+                return list(self._query_items(container,q,params,quarter,s.hook))
         except cosmos_exceptions.CosmosHttpResponseError:
             return []
 
+    def _query_items(self, container: str, q: str, params: List[Dict[str,Any]], quarter: Optional[str] = None, response_hook: Optional[Callable] = None, **kwargs):
+
+        ### Scoping the query to a single partition lets the SDK send it
+        ### straight to that partition instead of first asking the gateway
+        ### for a query plan
+        if container not in self.container_clients:
+            raise NotImplementedError("Container client does not exist")
+
+        return self.get_container(container).query_items(q,parameters=params,partition_key=self._get_partition_key_val(container,quarter),response_hook=response_hook,**kwargs)
+
     def _get_partition_key_val(self,container: str, quarter: Optional[str] = None):
         if self.quarterly[container]:
             if quarter:
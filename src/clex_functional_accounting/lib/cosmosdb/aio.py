@@ -1,21 +1,124 @@
 import azure.cosmos.aio as cosmos_aio
 import azure.cosmos.exceptions as cosmos_exceptions
+from azure.cosmos.documents import ConnectionPolicy, RetryOptions
+from azure.cosmos.http_constants import HttpHeaders, StatusCodes
 from azure.cosmos.partition_key import PartitionKey
 from datetime import datetime
 import asyncio
 
-from typing import Dict, Any, Optional, List, Union
+from typing import Awaitable, Callable, Dict, Any, Optional, List, Tuple, TypeVar, Union
 
-from .. import config
+from .. import config, latest, local
+from . import batch, query_builder
+from .query_builder import Filter
 
 HOST: str = config.settings['cosmos_host']
 WRITER_KEY: str = config.settings['key']
 DATABASE_ID:str = config.settings['database_id']
 DRY_RUN: bool = config.settings['dry_run']
+### Use the in-process stand-in instead of Cosmos DB
+LOCAL: bool = bool(config.settings['local_backend'])
+
+T = TypeVar('T')
+
+class WriteScheduler():
+    ### Sliding window over the requests a writer has in flight. The window
+    ### opens by one each time a window's worth of requests completes, and
+    ### is cut when the service throttles (halved) or when latency climbs
+    ### well past the best seen, meaning requests are queueing (by a
+    ### quarter). Only requests sent since the last cut can cut it again, so
+    ### one burst of 429s counts once. Throttled requests wait as long as
+    ### x-ms-retry-after-ms asks, holding back everything else meanwhile,
+    ### and are sent again.
+    def __init__(self, window: int = 8, min_window: int = 1, max_window: int = 64, max_retries: int = 9, latency_factor: float = 3.0):
+        self.window = float(window)
+        self.min_window = min_window
+        self.max_window = max_window
+        self.max_retries = max_retries
+        self.latency_factor = latency_factor
+        self.in_flight = 0
+        self.completed = 0
+        self.epoch = 0
+        self.latency: Optional[float] = None
+        self.best_latency: Optional[float] = None
+        self.resume_at = 0.0
+        self.throttled = 0
+        self.cond: Optional[asyncio.Condition] = None
+
+    async def run(self, fn: Callable[..., Awaitable[T]], *args, **kwargs) -> T:
+        ### fn is called again for each attempt, so pass the coroutine
+        ### function rather than a coroutine
+        loop = asyncio.get_running_loop()
+        if self.cond is None:
+            self.cond = asyncio.Condition()
+        attempt = 0
+        while True:
+            async with self.cond:
+                await self.cond.wait_for(lambda: self.in_flight < int(self.window))
+                self.in_flight += 1
+            try:
+                delay = self.resume_at - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                epoch = self.epoch
+                start = loop.time()
+                try:
+                    result = await fn(*args, **kwargs)
+                except cosmos_exceptions.CosmosHttpResponseError as e:
+                    if e.status_code != StatusCodes.TOO_MANY_REQUESTS or attempt >= self.max_retries:
+                        raise
+                    self._throttled(epoch,self._retry_after(e,attempt),loop.time())
+                    attempt += 1
+                    continue
+                self._completed(epoch,loop.time() - start)
+                return result
+            finally:
+                async with self.cond:
+                    self.in_flight -= 1
+                    self.cond.notify_all()
+
+    def _retry_after(self, e: cosmos_exceptions.CosmosHttpResponseError, attempt: int) -> float:
+        try:
+            return int(e.headers[HttpHeaders.RetryAfterInMilliseconds]) / 1000
+        except (KeyError, TypeError, ValueError):
+            return min(0.1 * 2**attempt, 10.0)
+
+    def _cut(self, epoch: int, factor: float) -> None:
+        if epoch == self.epoch:
+            self.window = max(self.min_window,self.window * factor)
+            self.epoch += 1
+            self.completed = 0
+
+    def _throttled(self, epoch: int, delay: float, now: float) -> None:
+        self.throttled += 1
+        self.resume_at = max(self.resume_at,now + delay)
+        self._cut(epoch,0.5)
+
+    def _completed(self, epoch: int, latency: float) -> None:
+        self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        if self.best_latency is None or self.latency < self.best_latency:
+            self.best_latency = self.latency
+        if self.latency > self.latency_factor * self.best_latency:
+            self._cut(epoch,0.75)
+            return
+        self.completed += 1
+        if self.completed >= int(self.window):
+            self.window = min(self.max_window,self.window + 1)
+            self.completed = 0
+
+def _connection_policy() -> ConnectionPolicy:
+    ### 429s come straight back to the WriteScheduler instead of being
+    ### retried inside the SDK, where the writer can't see them
+    policy = ConnectionPolicy()
+    policy.RetryOptions = RetryOptions(max_retry_attempt_count=0)
+    return policy
 
 class CosmosDBWriter():
-    def __init__(self):
-        self.client = cosmos_aio.CosmosClient(HOST, {'masterKey':WRITER_KEY}, user_agent="CosmosDBPythonQuickstart", user_agent_overwrite=True)
+    def __init__(self, scheduler: Optional[WriteScheduler] = None):
+        client_class = local.AsyncCosmosClient if LOCAL else cosmos_aio.CosmosClient
+        self.client = client_class(HOST, {'masterKey':WRITER_KEY}, user_agent="CosmosDBPythonQuickstart", user_agent_overwrite=True, connection_policy=_connection_policy())
+        ### Every request the writer makes goes through this
+        self.scheduler = scheduler or WriteScheduler()
         self.db_clients = {}
         self.container_clients = {}
         self.quarterly = {}
@@ -56,7 +159,7 @@ class CosmosDBWriter():
         
         container_client = await self.get_container(container)
         d['PartitionKey'] = self._get_partition_key_val(container)
-        await container_client.create_item(body=d)
+        await self.scheduler.run(container_client.create_item,body=d)
 
     async def delete_item(self, container: str, d: Union[Dict[str,Any],str] ) -> None:
 
@@ -74,7 +177,7 @@ class CosmosDBWriter():
         if not pk:
             pk = self._get_partition_key_val(container)
 
-        return await container_client.delete_item(d,pk)
+        return await self.scheduler.run(container_client.delete_item,d,pk)
 
     async def read_items(self, container: str, item: Any, field: Optional[str] =  None, partition_key_val: Optional[str] = None, once_off: bool = False) -> List[Dict[str,Any]]:
 
@@ -90,7 +193,7 @@ class CosmosDBWriter():
             partition_key_val = self._get_partition_key_val(container)
 
             try:
-                return [ await container_client.read_item(item=item,partition_key=partition_key_val), ]
+                return [ await self.scheduler.run(container_client.read_item,item=item,partition_key=partition_key_val), ]
             except cosmos_exceptions.CosmosResourceNotFoundError:
                 return []
 
@@ -117,7 +220,7 @@ class CosmosDBWriter():
             if container not in self.container_clients:
                 raise NotImplementedError("Container client does not exist")
         
-            self.client_caches[container] = [ item async for item in self.container_clients[container].read_all_items() ]
+            self.client_caches[container] = await self.scheduler.run(self._collect,self.container_clients[container].read_all_items)
         
         return self.client_caches[container]
         
@@ -133,47 +236,90 @@ class CosmosDBWriter():
 
         container_client = await self.get_container(container)
         d['PartitionKey'] = self._get_partition_key_val(container)
-        await container_client.upsert_item(body=d)
+        await self.scheduler.run(container_client.upsert_item,body=d)
+
+    async def create_items(self, container: str, docs: List[Dict[str,Any]]) -> None:
+        await self._bulk(container,'create',docs)
+
+    async def upsert_items(self, container: str, docs: List[Dict[str,Any]]) -> None:
+        await self._bulk(container,'upsert',docs)
+
+    async def delete_items(self, container: str, items: List[Union[Dict[str,Any],str]]) -> None:
+        await self._bulk(container,'delete',items)
+
+    async def append_items(self, container: str, docs: List[Dict[str,Any]], field: str, update: Tuple[str,...] = ( 'ts', )) -> int:
 
-    async def query(self, container: str, fields: Optional[Union[str,List[str]]]=None,where: Optional[List[str]] = None,order: Optional[str] = None,offset: Optional[int] = None,limit: Optional[int] = None):
+        ### Appends the elements of each doc's field, a list, to that of the
+        ### stored document with the same id, and sets the fields in update
+        ### on it. Documents not stored yet are created as they are. Only
+        ### ids are read back. Returns how many were created
+        stored = set([ row['id'] for row in await self.query(container,'id',Filter().isin('id',[ d['id'] for d in docs ])) ])
+
+        new = [ d for d in docs if d['id'] not in stored ]
+        patches = [ ( d['id'], [ { 'op': 'add', 'path': f"/{field}/-", 'value': v } for v in d[field] ] +
+                               [ { 'op': 'set', 'path': f"/{k}", 'value': d[k] } for k in update ] ) for d in docs if d['id'] in stored ]
+
+        await asyncio.gather(self.create_items(container,new),
+                             self._bulk(container,'patch',patches))
+        return len(new)
+
+    async def _bulk(self, container: str, kind: str, items: List[Union[Dict[str,Any],str,Tuple[str,List[Dict[str,Any]]]]]) -> None:
+
+        ### Many writes in as few requests as possible. Each batch is
+        ### transactional, if any operation in it fails none are applied
+        ### and CosmosBatchOperationError is raised
+        if DRY_RUN:
+            verb = { 'delete': 'deleted', 'patch': 'patched' }.get(kind,'created')
+            for d in items:
+                print(f"Would have {verb}: {d}")
+            return
 
         if container not in self.container_clients:
             raise NotImplementedError("Container client does not exist")
 
-        q = "SELECT"
-        if not fields:
-            q+=" * "
-        elif isinstance(fields,list):
-            q+=f" VALUE {{ {', '.join([ i+':  c.'+i for i in fields ])} }}"
-        elif isinstance(fields,str):
-            q+= f" VALUE {{ {fields}: c.{fields} }}"
-        q += " FROM c"
-
-        if where:
-            if isinstance(where,List):
-                q+=f" WHERE c.{' AND c.'.join(i for i in where)}"
-            elif isinstance(where,str):
-                q+=f" WHERE c.{where}"
-
-        if order:
-            q+=f" ORDER BY c.{order}"
-
-        if offset:
-            q+=f" OFFSET {offset}"
-        elif limit:
-            q+=f" OFFSET 0"
-
-        if limit:
-            q+=f" LIMIT {limit}"
-        elif offset:
-            q+=f" LIMIT 10000"
+        container_client = await self.get_container(container)
+        await asyncio.gather(*[ self.scheduler.run(container_client.execute_item_batch,ops,pk) for pk,ops in batch.batches(batch.operations(kind,items,self._get_partition_key_val(container))) ])
+
+    async def query(self, container: str, fields: Optional[Union[str,List[str]]]=None,where: Optional[Filter] = None,order: Optional[str] = None,offset: Optional[int] = None,limit: Optional[int] = None, quarter: Optional[str] = None):
+
+        if container not in self.container_clients:
+            raise NotImplementedError("Container client does not exist")
+
+        q, params = query_builder.build(query_builder.select_fields(fields),where,order,offset,limit)
 
         container_client = await self.get_container(container)
         try:
-            return [ item async for item in container_client.query_items(q)]
+            return await self.scheduler.run(self._collect,container_client.query_items,q,parameters=params,partition_key=self._get_partition_key_val(container,quarter))
         except cosmos_exceptions.CosmosHttpResponseError:
             return []
 
+    async def sync_latest(self, container: str, docs: List[Dict[str,Any]], where: Optional[Filter] = None) -> Tuple[int,int]:
+
+        ### Brings a *_latest container in line with docs, everything an
+        ### ingest run found for the part of the container matching where.
+        ### Documents are only written if their content, ts aside, differs
+        ### from what is stored, and any not in docs are deleted. Only ids
+        ### and hashes are read back. Returns how many were written and
+        ### deleted
+        current = { row['id']: row.get('hash',None) for row in await self.query(container,['id','hash'],where) }
+
+        changed = []
+        for d in docs:
+            d['hash'] = latest.content_hash(d)
+            if current.get(d['id'],None) != d['hash']:
+                changed.append(d)
+
+        keep = set([ d['id'] for d in docs ])
+        stale = [ id for id in current if id not in keep ]
+
+        await asyncio.gather(self.upsert_items(container,changed),
+                             self.delete_items(container,stale))
+        return len(changed), len(stale)
+
+    async def _collect(self, fn: Callable, *args, **kwargs) -> List[Dict[str,Any]]:
+        ### Runs a query from the start, so a throttled one can be retried
+        return [ item async for item in fn(*args,**kwargs) ]
+
     def _get_partition_key_val(self,container: str, quarter: Optional[str] = None):
         if self.quarterly[container]:
             if quarter:
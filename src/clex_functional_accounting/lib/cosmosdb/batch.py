@@ -0,0 +1,49 @@
+from typing import Any, Dict, Iterable, Iterator, List, Tuple, Union
+
+from .. import serialise
+
+### Splitting bulk writes into transactional batches. A batch can only
+### touch one partition, and the service caps it at 100 operations and
+### 2MB of payload.
+
+BATCH_LIMIT=100
+### Leave some room under the 2MB cap for the per-operation envelope
+BATCH_BYTES=2*1024*1024 - 64*1024
+
+Operation = Tuple[str,Tuple[Any,...]]
+
+def operations(kind: str, items: Iterable[Union[Dict[str,Any],str,Tuple[str,List[Dict[str,Any]]]]], pk: str) -> Iterator[Tuple[str,Operation]]:
+    ### kind is 'create', 'upsert', 'delete' or 'patch'. Documents being
+    ### written are put in partition pk, as create_item and upsert_item do.
+    ### Deletes go to the document's own PartitionKey if it has one. Patches
+    ### are (id, patch operations) pairs for documents in partition pk
+    for item in items:
+        if kind == 'patch':
+            yield pk, ( kind, tuple(item) )
+        elif kind == 'delete':
+            if isinstance(item,dict):
+                yield item.get('PartitionKey',None) or pk, ( kind, ( item['id'], ) )
+            else:
+                yield pk, ( kind, ( item, ) )
+        else:
+            item['PartitionKey'] = pk
+            yield pk, ( kind, ( item, ) )
+
+def _size(op: Operation) -> int:
+    return sum([ len(serialise.dumps(arg)) if isinstance(arg,( dict, list )) else len(str(arg)) for arg in op[1] ])
+
+def batches(ops: Iterable[Tuple[str,Operation]]) -> Iterator[Tuple[str,List[Operation]]]:
+    ### Yields (partition key, operations) pairs, keeping the order of the
+    ### operations within each partition
+    pending: Dict[str,Tuple[List[Operation],int]] = {}
+    for pk,op in ops:
+        size = _size(op)
+        batch, total = pending.get(pk,( [], 0 ))
+        if batch and ( len(batch) >= BATCH_LIMIT or total + size > BATCH_BYTES ):
+            yield pk, batch
+            batch, total = [], 0
+        batch.append(op)
+        pending[pk] = ( batch, total + size )
+    for pk,( batch, _ ) in pending.items():
+        if batch:
+            yield pk, batch
@@ -0,0 +1,140 @@
+import re
+from functools import lru_cache
+
+from typing import Any, Dict, List, Optional, Tuple
+
+### Builds parameterised Cosmos SQL. Every value that comes from a caller
+### is passed as a @parameter, and field names are checked before they
+### go anywhere near the query text. The text only depends on the 'shape'
+### of the query (which fields are compared how), so it is rendered once
+### per shape and the same text is sent for every value of a filter.
+
+FIELD_RE = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+OPERATORS = ( '=', '!=', '<', '>', '<=', '>=' )
+
+### Cosmos SQL keywords, fields with these names (e.g. 'limit') can only
+### be used as c["name"]
+RESERVED = frozenset([ 'AND', 'ARRAY', 'AS', 'ASC', 'BETWEEN', 'BY', 'CASE', 'CAST', 'CONVERT', 'CROSS', 'DESC', 'DISTINCT',
+                       'ELSE', 'END', 'ESCAPE', 'EXISTS', 'FALSE', 'FOR', 'FROM', 'GROUP', 'HAVING', 'IN', 'INNER', 'INSERT',
+                       'INTO', 'IS', 'JOIN', 'LEFT', 'LIKE', 'LIMIT', 'NOT', 'NULL', 'OFFSET', 'ON', 'OR', 'ORDER', 'OUTER',
+                       'OVER', 'RIGHT', 'SELECT', 'SET', 'THEN', 'TOP', 'TRUE', 'UDF', 'UNDEFINED', 'UPDATE', 'VALUE', 'WHEN',
+                       'WHERE', 'WITH' ])
+
+class InvalidQuery(ValueError):
+    pass
+
+def check_field(field: str) -> str:
+    if not isinstance(field,str) or not FIELD_RE.fullmatch(field):
+        raise InvalidQuery(f"Invalid field name: {field!r}")
+    return field
+
+def ref(field: str) -> str:
+    ### field of the document being queried
+    if check_field(field).upper() in RESERVED:
+        return f'c["{field}"]'
+    return f"c.{field}"
+
+def _key(field: str) -> str:
+    ### field as a property name in an object literal
+    if check_field(field).upper() in RESERVED:
+        return f'"{field}"'
+    return field
+
+class Filter():
+    ### A set of conditions that must all hold
+    def __init__(self):
+        self.shape: List[Tuple] = []
+        self.values: List[Any] = []
+
+    def copy(self) -> "Filter":
+        out = Filter()
+        out.shape = list(self.shape)
+        out.values = list(self.values)
+        return out
+
+    def isin(self, field: str, values: List[Any]) -> "Filter":
+        ### ARRAY_CONTAINS keeps the text the same however many values there are
+        self.shape.append(('in',check_field(field)))
+        self.values.append(list(values))
+        return self
+
+    def compare(self, field: str, op: str, value: Any) -> "Filter":
+        if op not in OPERATORS:
+            raise InvalidQuery(f"Invalid operator: {op!r}")
+        self.shape.append(('cmp',check_field(field),op))
+        self.values.append(value)
+        return self
+
+    def any_equal(self, fields: List[str], value: Any) -> "Filter":
+        ### At least one of fields is equal to value
+        self.shape.append(('any',tuple( check_field(i) for i in fields )))
+        self.values.append(value)
+        return self
+
+    def key(self) -> str:
+        ### Identifies both the shape and the values
+        return repr((self.shape,self.values))
+
+    def __bool__(self) -> bool:
+        return bool(self.shape)
+
+def parse_order(order: Optional[str]) -> Optional[Tuple[str,bool]]:
+    ### 'field' or 'field DESC' -> (field, descending)
+    if not order:
+        return None
+    order_tuple = order.split(' ')
+    if len(order_tuple) > 2 or ( len(order_tuple) == 2 and order_tuple[1] not in ( 'ASC', 'DESC' ) ):
+        raise InvalidQuery(f"Invalid ordering: {order!r}")
+    return check_field(order_tuple[0]), len(order_tuple) == 2 and order_tuple[1] == 'DESC'
+
+def select_fields(fields: Optional[Any]=None) -> str:
+    if not fields:
+        return "*"
+    elif isinstance(fields,list):
+        return f"VALUE {{ {', '.join([ _key(i)+': '+ref(i) for i in fields ])} }}"
+    return f"VALUE {{ {_key(fields)}: {ref(fields)} }}"
+
+@lru_cache(maxsize=512)
+def _render(select: str, shape: Tuple[Tuple,...], group: Tuple[str,...], order: Optional[Tuple[str,bool]], paged: bool) -> str:
+
+    q = f"SELECT {select} FROM c"
+
+    conditions=[]
+    n = 0
+    for cond in shape:
+        if cond[0] == 'in':
+            conditions.append(f"ARRAY_CONTAINS(@p{n}, {ref(cond[1])})")
+        elif cond[0] == 'cmp':
+            conditions.append(f"{ref(cond[1])} {cond[2]} @p{n}")
+        elif cond[0] == 'any':
+            conditions.append('( ' + ' OR '.join([ f"{ref(i)} = @p{n}" for i in cond[1] ]) + ' )')
+        n += 1
+    if conditions:
+        q += f" WHERE {' AND '.join(conditions)}"
+
+    if group:
+        q += f" GROUP BY {', '.join(group)}"
+
+    if order:
+        q += f" ORDER BY {ref(order[0])}{' DESC' if order[1] else ''}"
+
+    if paged:
+        q += " OFFSET @offset LIMIT @limit"
+
+    return q
+
+def build(select: str = "*", where: Optional[Filter] = None, order: Optional[str] = None, offset: Optional[int] = None, limit: Optional[int] = None, group: Optional[List[str]] = None) -> Tuple[str,List[Dict[str,Any]]]:
+
+    ### Returns the query text and its parameters in the form query_items expects
+    if where is None:
+        where = Filter()
+
+    parameters = [ {'name':f"@p{n}",'value':v} for n,v in enumerate(where.values) ]
+
+    paged = bool(offset or limit)
+    if paged:
+        parameters.append({'name':'@offset','value':int(offset or 0)})
+        ### Cosmos requires a limit with an offset
+        parameters.append({'name':'@limit','value':int(limit or 10000)})
+
+    return _render(select,tuple(where.shape),tuple(group or ()),parse_order(order),paged), parameters
@@ -0,0 +1,36 @@
+import hashlib
+
+from typing import Any, Dict, List
+
+from . import serialise
+
+### The *_latest containers only have a document rewritten when its content
+### changes, so the ts stored with it is when it last changed. Every
+### document still there after an ingest run was seen by that run though,
+### so the ts to serve is the one the run recorded with mark_ingest for the
+### document's source.
+
+### Not part of a document's content
+IGNORED_FIELDS = ( 'ts', 'hash', 'PartitionKey' )
+
+def content_hash(doc: Dict[str,Any]) -> str:
+    ### Cosmos system properties all start with '_'
+    content = sorted([ ( k, v ) for k,v in doc.items() if k not in IGNORED_FIELDS and not k.startswith('_') ])
+    return hashlib.blake2b(serialise.dumps(content),digest_size=8).hexdigest()
+
+def source(container: str, doc: Dict[str,Any]) -> str:
+    ### The ingest state key for the job that writes doc. storage_latest is
+    ### written by update_lquota and, for massdata, update_nci_account
+    if container == 'storage_latest':
+        return 'massdata' if doc.get('fs',None) == 'massdata' else 'lquota'
+    return { 'compute_latest': 'compute', 'compute_summary': 'compute', 'files_report_latest': 'files_report' }[container]
+
+def refresh(container: str, docs: List[Dict[str,Any]], ingest_state: Dict[str,str]) -> List[Dict[str,Any]]:
+    ### Sets ts on docs (in place) to when they were last seen
+    for doc in docs:
+        if 'ts' not in doc:
+            continue
+        ts = ingest_state.get(source(container,doc),None)
+        if ts and ts > doc['ts']:
+            doc['ts'] = ts
+    return docs
@@ -0,0 +1,83 @@
+import atexit
+import base64
+import os
+import threading
+
+from typing import Any, Dict, Optional, Tuple
+
+from .. import config, serialise
+
+### In-process stand-in for Cosmos DB and Blob storage, used in place of the
+### real services when CLEXFA_LOCAL_BACKEND is set. Set it to a directory to
+### have the data loaded from and saved (on exit) to state.json in there, so
+### it survives between runs of the ingest tools and the API, or to
+### ':memory:' to start empty every time.
+
+PATH: Optional[str] = config.settings['local_backend']
+MEMORY: str = ':memory:'
+
+class Store():
+    def __init__(self, path: Optional[str] = None):
+        self.lock = threading.RLock()
+        self.path = path
+        ### database -> container -> partition key -> id -> document
+        self.cosmos: Dict[str,Dict[str,Dict[str,Dict[str,Dict[str,Any]]]]] = {}
+        ### container -> blob -> (etag, contents)
+        self.blobs: Dict[str,Dict[str,Tuple[str,bytes]]] = {}
+        self.counter = 0
+        self.dirty = False
+
+        if path:
+            self.load()
+            atexit.register(self.save)
+
+    def next_etag(self) -> str:
+        with self.lock:
+            self.counter += 1
+            return f'"0x{self.counter:016X}"'
+
+    def load(self) -> None:
+        fn = os.path.join(self.path,'state.json')
+        if not os.path.exists(fn):
+            return
+        with open(fn,'rb') as f:
+            state = serialise.loads(f.read())
+        self.counter = state['counter']
+        for db,containers in state['cosmos'].items():
+            self.cosmos[db] = {}
+            for container,docs in containers.items():
+                partitions = self.cosmos[db].setdefault(container,{})
+                for d in docs:
+                    partitions.setdefault(d.get('PartitionKey',None),{})[d['id']] = d
+        for container,blobs in state['blobs'].items():
+            self.blobs[container] = { k:( etag, base64.b64decode(data) ) for k,( etag, data ) in blobs.items() }
+
+    def save(self) -> None:
+        with self.lock:
+            if not self.dirty:
+                return
+            state = {
+                'counter': self.counter,
+                'cosmos': { db: { container: [ d for p in partitions.values() for d in p.values() ] for container,partitions in containers.items() } for db,containers in self.cosmos.items() },
+                'blobs': { container: { k:[ etag, base64.b64encode(data).decode() ] for k,( etag, data ) in blobs.items() } for container,blobs in self.blobs.items() },
+            }
+            os.makedirs(self.path,exist_ok=True)
+            tmp = os.path.join(self.path,'state.json.tmp')
+            with open(tmp,'wb') as f:
+                f.write(serialise.dumps(state))
+            os.replace(tmp,os.path.join(self.path,'state.json'))
+            self.dirty = False
+
+_store: Optional[Store] = None
+_store_lock = threading.Lock()
+
+def get_store() -> Store:
+    ### Every client in the process shares the one store
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = Store(None if PATH in ( None, '', MEMORY ) else PATH)
+    return _store
+
+from .cosmos import CosmosClient, AsyncCosmosClient
+from .blob import BlobServiceClient
@@ -0,0 +1,82 @@
+from azure.core import MatchConditions
+import azure.core.exceptions as az_exceptions
+from types import SimpleNamespace
+
+from typing import Any, Dict, Optional, Union
+
+from . import get_store, Store
+
+### Stand-ins for azure.storage.blob BlobServiceClient, ContainerClient and
+### BlobClient, covering the parts of them this package uses
+
+class BlobServiceClient():
+    def __init__(self, *args, **kwargs):
+        self.store = get_store()
+
+    def create_container(self, name: str, **kwargs) -> "ContainerClient":
+        with self.store.lock:
+            if name in self.store.blobs:
+                raise az_exceptions.ResourceExistsError(message=f"Container {name} already exists")
+            self.store.blobs[name] = {}
+            self.store.dirty = True
+        return ContainerClient(name)
+
+    def get_container_client(self, name: str) -> "ContainerClient":
+        return ContainerClient(name)
+
+    def get_blob_client(self, container: str, blob: str, **kwargs) -> "BlobClient":
+        return BlobClient(self.store,container,blob)
+
+    def close(self) -> None:
+        pass
+
+class ContainerClient():
+    def __init__(self, name: str):
+        self.container_name = name
+
+    def close(self) -> None:
+        pass
+
+class Downloader():
+    def __init__(self, etag: str, data: bytes):
+        self.properties = SimpleNamespace(etag=etag,size=len(data))
+        self.data = data
+
+    def readall(self) -> bytes:
+        return self.data
+
+class BlobClient():
+    def __init__(self, store: Store, container: str, blob: str):
+        self.store = store
+        self.container = container
+        self.blob = blob
+
+    def __enter__(self) -> "BlobClient":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        pass
+
+    def upload_blob(self, data: Union[bytes,str], overwrite: bool = False, etag: Optional[str] = None, match_condition: Optional[MatchConditions] = None, **kwargs) -> Dict[str,Any]:
+        if isinstance(data,str):
+            data = data.encode()
+        with self.store.lock:
+            ### Unlike the real thing, containers are created on first use
+            blobs = self.store.blobs.setdefault(self.container,{})
+            if self.blob in blobs and not overwrite:
+                raise az_exceptions.ResourceExistsError(message=f"Blob {self.blob} already exists")
+            if match_condition == MatchConditions.IfNotModified and ( self.blob not in blobs or blobs[self.blob][0] != etag ):
+                raise az_exceptions.ResourceModifiedError(message="The condition specified using HTTP conditional header(s) is not met")
+            etag = self.store.next_etag()
+            blobs[self.blob] = ( etag, bytes(data) )
+            self.store.dirty = True
+        return { 'etag': etag }
+
+    def download_blob(self, etag: Optional[str] = None, match_condition: Optional[MatchConditions] = None, **kwargs) -> Downloader:
+        with self.store.lock:
+            found = self.store.blobs.get(self.container,{}).get(self.blob,None)
+        if found is None:
+            raise az_exceptions.ResourceNotFoundError(message=f"Blob {self.blob} does not exist")
+        if match_condition == MatchConditions.IfModified and etag == found[0]:
+            raise az_exceptions.ResourceNotModifiedError(message="Not modified")
+        return Downloader(*found)
@@ -0,0 +1,368 @@
+import azure.cosmos.exceptions as cosmos_exceptions
+import time
+import uuid
+
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+from . import get_store, sql, Store
+from .. import serialise
+
+### Stand-ins for azure.cosmos CosmosClient, DatabaseProxy and
+### ContainerProxy (and their azure.cosmos.aio counterparts), covering the
+### parts of them this package uses
+
+### The SDK's default when max_item_count isn't given
+DEFAULT_PAGE_SIZE=100
+### Most operations the service accepts in one transactional batch
+BATCH_LIMIT=100
+
+def _not_found(what: str) -> cosmos_exceptions.CosmosResourceNotFoundError:
+    return cosmos_exceptions.CosmosResourceNotFoundError(status_code=404,message=f"{what} does not exist")
+
+def _exists(what: str) -> cosmos_exceptions.CosmosResourceExistsError:
+    return cosmos_exceptions.CosmosResourceExistsError(status_code=409,message=f"{what} already exists")
+
+def _patched(doc: Dict[str,Any], patch_operations: List[Dict[str,Any]]) -> Dict[str,Any]:
+    ### A copy of doc with patch_operations applied. Paths are /-separated,
+    ### and 'add' to /-, at the end of an array path, appends to it
+    out = serialise.loads(serialise.dumps(doc))
+    for op in patch_operations:
+        path = op['path'].strip('/').split('/')
+        if path[0] in ( 'id', 'PartitionKey' ):
+            raise cosmos_exceptions.CosmosHttpResponseError(status_code=400,message=f"{op['path']} cannot be patched")
+        parent = out
+        try:
+            for p in path[:-1]:
+                parent = parent[int(p)] if isinstance(parent,list) else parent[p]
+            last = path[-1]
+            if op['op'] == 'add' and isinstance(parent,list):
+                if last == '-':
+                    parent.append(op['value'])
+                else:
+                    parent.insert(int(last),op['value'])
+            elif op['op'] in ( 'add', 'set', 'replace' ):
+                if op['op'] == 'replace' and last not in parent:
+                    raise KeyError(last)
+                parent[int(last) if isinstance(parent,list) else last] = op['value']
+            elif op['op'] == 'incr':
+                parent[last] = parent.get(last,0) + op['value']
+            elif op['op'] == 'remove':
+                del parent[int(last) if isinstance(parent,list) else last]
+            else:
+                raise cosmos_exceptions.CosmosHttpResponseError(status_code=400,message=f"Unsupported patch operation {op['op']}")
+        except ( AttributeError, KeyError, IndexError, ValueError, TypeError ):
+            raise cosmos_exceptions.CosmosHttpResponseError(status_code=400,message=f"Cannot {op['op']} {op['path']}")
+    return out
+
+class CosmosClient():
+    def __init__(self, *args, **kwargs):
+        self.store = get_store()
+
+    def create_database(self, id: str, **kwargs) -> "DatabaseProxy":
+        with self.store.lock:
+            if id in self.store.cosmos:
+                raise _exists(f"Database {id}")
+            self.store.cosmos[id] = {}
+            self.store.dirty = True
+        return DatabaseProxy(self.store,id)
+
+    def get_database_client(self, id: str) -> "DatabaseProxy":
+        with self.store.lock:
+            self.store.cosmos.setdefault(id,{})
+        return DatabaseProxy(self.store,id)
+
+    def close(self) -> None:
+        pass
+
+class DatabaseProxy():
+    def __init__(self, store: Store, id: str):
+        self.store = store
+        self.id = id
+
+    def create_container(self, id: str, partition_key: Any = None, **kwargs) -> "ContainerProxy":
+        with self.store.lock:
+            if id in self.store.cosmos[self.id]:
+                raise _exists(f"Container {id}")
+            self.store.cosmos[self.id][id] = {}
+            self.store.dirty = True
+        return ContainerProxy(self.store,self.id,id)
+
+    def get_container_client(self, id: str) -> "ContainerProxy":
+        with self.store.lock:
+            self.store.cosmos[self.id].setdefault(id,{})
+        return ContainerProxy(self.store,self.id,id)
+
+class QueryIterable():
+    ### Iterates over every result, or a page at a time with by_page().
+    ### The query runs when the first page is asked for.
+    def __init__(self, run: Callable[[], List[Any]], page_size: Optional[int], response_hook: Optional[Callable]):
+        self.run = run
+        self.page_size = page_size or DEFAULT_PAGE_SIZE
+        self.response_hook = response_hook
+
+    def __iter__(self) -> Iterator[Any]:
+        for page in self.by_page():
+            yield from page
+
+    def by_page(self, continuation_token: Optional[str] = None) -> "Pager":
+        return Pager(self,int(continuation_token or 0))
+
+class Pager():
+    def __init__(self, iterable: QueryIterable, start: int):
+        self.iterable = iterable
+        self.start = start
+        self.results = None
+        self.continuation_token = None
+        self.done = False
+
+    def __iter__(self) -> "Pager":
+        return self
+
+    def __next__(self) -> Iterator[Any]:
+        if self.done:
+            raise StopIteration
+        if self.results is None:
+            self.results = self.iterable.run()
+        end = self.start + self.iterable.page_size
+        page = self.results[self.start:end]
+        if end < len(self.results):
+            self.continuation_token = str(end)
+        else:
+            self.continuation_token = None
+            self.done = True
+        self.start = end
+        if self.iterable.response_hook:
+            self.iterable.response_hook({ 'x-ms-item-count': str(len(page)) },{})
+        return iter(page)
+
+class ContainerProxy():
+    def __init__(self, store: Store, db: str, id: str):
+        self.store = store
+        self.db = db
+        self.id = id
+
+    @property
+    def partitions(self) -> Dict[Any,Dict[str,Dict[str,Any]]]:
+        return self.store.cosmos[self.db][self.id]
+
+    def _hook(self, response_hook: Optional[Callable], result: Any) -> None:
+        if response_hook:
+            response_hook({},result)
+
+    def _docs(self, partition_key: Any = None) -> List[Dict[str,Any]]:
+        with self.store.lock:
+            if partition_key is None:
+                return [ d for p in self.partitions.values() for d in p.values() ]
+            return list(self.partitions.get(partition_key,{}).values())
+
+    def _stamp(self, body: Dict[str,Any]) -> Dict[str,Any]:
+        ### Stored documents are copies, with the system properties Cosmos adds
+        if 'id' not in body:
+            raise cosmos_exceptions.CosmosHttpResponseError(status_code=400,message="Document has no id")
+        doc = serialise.loads(serialise.dumps(body))
+        doc |= { '_rid': uuid.uuid4().hex[:16],
+                 '_self': f"dbs/{self.db}/colls/{self.id}/docs/{doc['id']}",
+                 '_etag': self.store.next_etag(),
+                 '_attachments': 'attachments/',
+                 '_ts': int(time.time()) }
+        return doc
+
+    def _write(self, body: Dict[str,Any], must_not_exist: bool) -> Dict[str,Any]:
+        doc = self._stamp(body)
+        with self.store.lock:
+            partition = self.partitions.setdefault(doc.get('PartitionKey',None),{})
+            if must_not_exist and doc['id'] in partition:
+                raise _exists(f"Document {doc['id']}")
+            partition[doc['id']] = doc
+            self.store.dirty = True
+        return dict(doc)
+
+    def create_item(self, body: Dict[str,Any], response_hook: Optional[Callable] = None, **kwargs) -> Dict[str,Any]:
+        out = self._write(body,True)
+        self._hook(response_hook,out)
+        return out
+
+    def upsert_item(self, body: Dict[str,Any], response_hook: Optional[Callable] = None, **kwargs) -> Dict[str,Any]:
+        out = self._write(body,False)
+        self._hook(response_hook,out)
+        return out
+
+    def read_item(self, item: Union[str,Dict[str,Any]], partition_key: Any, response_hook: Optional[Callable] = None, **kwargs) -> Dict[str,Any]:
+        id = item['id'] if isinstance(item,dict) else item
+        with self.store.lock:
+            doc = self.partitions.get(partition_key,{}).get(id,None)
+        if doc is None:
+            raise _not_found(f"Document {id}")
+        self._hook(response_hook,doc)
+        return dict(doc)
+
+    def delete_item(self, item: Union[str,Dict[str,Any]], partition_key: Any, response_hook: Optional[Callable] = None, **kwargs) -> None:
+        id = item['id'] if isinstance(item,dict) else item
+        with self.store.lock:
+            partition = self.partitions.get(partition_key,{})
+            if id not in partition:
+                raise _not_found(f"Document {id}")
+            del partition[id]
+            self.store.dirty = True
+        self._hook(response_hook,None)
+
+    def patch_item(self, item: Union[str,Dict[str,Any]], partition_key: Any, patch_operations: List[Dict[str,Any]], response_hook: Optional[Callable] = None, **kwargs) -> Dict[str,Any]:
+        id = item['id'] if isinstance(item,dict) else item
+        with self.store.lock:
+            partition = self.partitions.get(partition_key,{})
+            if id not in partition:
+                raise _not_found(f"Document {id}")
+            doc = self._stamp(_patched(partition[id],patch_operations))
+            partition[id] = doc
+            self.store.dirty = True
+        self._hook(response_hook,doc)
+        return dict(doc)
+
+    def execute_item_batch(self, batch_operations: List[Tuple[str,Tuple[Any,...]]], partition_key: Any, response_hook: Optional[Callable] = None, **kwargs) -> List[Dict[str,Any]]:
+        ### All or nothing, as with the real thing. Each operation records
+        ### what it replaced so a failure part way through can be undone
+        if len(batch_operations) > BATCH_LIMIT:
+            raise cosmos_exceptions.CosmosHttpResponseError(status_code=400,message=f"Batch has more than {BATCH_LIMIT} operations")
+        results = []
+        with self.store.lock:
+            partition = self.partitions.setdefault(partition_key,{})
+            undo = []
+            try:
+                for kind,args in batch_operations:
+                    if kind in ( 'create', 'upsert', 'replace' ):
+                        doc = self._stamp(args[-1])
+                        if doc.get('PartitionKey',None) != partition_key:
+                            raise cosmos_exceptions.CosmosHttpResponseError(status_code=400,message=f"Document {doc['id']} is not in partition {partition_key}")
+                        if kind == 'create' and doc['id'] in partition:
+                            raise _exists(f"Document {doc['id']}")
+                        if kind == 'replace' and doc['id'] not in partition:
+                            raise _not_found(f"Document {doc['id']}")
+                        undo.append(( doc['id'], partition.get(doc['id'],None) ))
+                        partition[doc['id']] = doc
+                        results.append({ 'statusCode': 201 if kind == 'create' else 200, 'resourceBody': dict(doc) })
+                    elif kind in ( 'read', 'delete' ):
+                        id = args[0]
+                        if id not in partition:
+                            raise _not_found(f"Document {id}")
+                        if kind == 'delete':
+                            undo.append(( id, partition.pop(id) ))
+                            results.append({ 'statusCode': 204 })
+                        else:
+                            results.append({ 'statusCode': 200, 'resourceBody': dict(partition[id]) })
+                    elif kind == 'patch':
+                        id, patch_operations = args[0], args[1]
+                        if id not in partition:
+                            raise _not_found(f"Document {id}")
+                        doc = self._stamp(_patched(partition[id],patch_operations))
+                        undo.append(( id, partition[id] ))
+                        partition[id] = doc
+                        results.append({ 'statusCode': 200, 'resourceBody': dict(doc) })
+                    else:
+                        raise cosmos_exceptions.CosmosHttpResponseError(status_code=400,message=f"Unsupported batch operation {kind}")
+            except cosmos_exceptions.CosmosHttpResponseError as e:
+                for id,doc in reversed(undo):
+                    if doc is None:
+                        partition.pop(id,None)
+                    else:
+                        partition[id] = doc
+                raise cosmos_exceptions.CosmosBatchOperationError(error_index=len(results),headers={},status_code=e.status_code,message=f"Batch failed at operation {len(results)}: {e.message}",operation_responses=results)
+            if undo:
+                self.store.dirty = True
+        self._hook(response_hook,results)
+        return results
+
+    def read_all_items(self, max_item_count: Optional[int] = None, response_hook: Optional[Callable] = None, **kwargs) -> QueryIterable:
+        return QueryIterable(lambda: [ dict(d) for d in self._docs() ],max_item_count,response_hook)
+
+    def query_items(self, query: str, parameters: Optional[List[Dict[str,Any]]] = None, partition_key: Any = None, enable_cross_partition_query: Optional[bool] = None, max_item_count: Optional[int] = None, response_hook: Optional[Callable] = None, **kwargs) -> QueryIterable:
+        def run():
+            try:
+                return sql.run(query,parameters,self._docs(partition_key))
+            except sql.QueryError as e:
+                raise cosmos_exceptions.CosmosHttpResponseError(status_code=400,message=str(e))
+        return QueryIterable(run,max_item_count,response_hook)
+
+### azure.cosmos.aio versions, all the work is done by the sync ones above
+
+class AsyncCosmosClient():
+    def __init__(self, *args, **kwargs):
+        self.sync = CosmosClient()
+
+    async def create_database(self, id: str, **kwargs) -> "AsyncDatabaseProxy":
+        return AsyncDatabaseProxy(self.sync.create_database(id,**kwargs))
+
+    def get_database_client(self, id: str) -> "AsyncDatabaseProxy":
+        return AsyncDatabaseProxy(self.sync.get_database_client(id))
+
+    async def close(self) -> None:
+        pass
+
+class AsyncDatabaseProxy():
+    def __init__(self, sync: DatabaseProxy):
+        self.sync = sync
+
+    async def create_container(self, id: str, partition_key: Any = None, **kwargs) -> "AsyncContainerProxy":
+        return AsyncContainerProxy(self.sync.create_container(id,partition_key,**kwargs))
+
+    def get_container_client(self, id: str) -> "AsyncContainerProxy":
+        return AsyncContainerProxy(self.sync.get_container_client(id))
+
+class AsyncQueryIterable():
+    def __init__(self, sync: QueryIterable):
+        self.sync = sync
+
+    async def __aiter__(self) -> AsyncIterator[Any]:
+        for i in self.sync:
+            yield i
+
+    def by_page(self, continuation_token: Optional[str] = None) -> "AsyncPager":
+        return AsyncPager(self.sync.by_page(continuation_token))
+
+class AsyncPager():
+    def __init__(self, sync: Pager):
+        self.sync = sync
+
+    @property
+    def continuation_token(self) -> Optional[str]:
+        return self.sync.continuation_token
+
+    def __aiter__(self) -> "AsyncPager":
+        return self
+
+    async def __anext__(self) -> AsyncIterator[Any]:
+        try:
+            page = next(self.sync)
+        except StopIteration:
+            raise StopAsyncIteration
+        async def items():
+            for i in page:
+                yield i
+        return items()
+
+class AsyncContainerProxy():
+    def __init__(self, sync: ContainerProxy):
+        self.sync = sync
+
+    async def create_item(self, body: Dict[str,Any], **kwargs) -> Dict[str,Any]:
+        return self.sync.create_item(body,**kwargs)
+
+    async def upsert_item(self, body: Dict[str,Any], **kwargs) -> Dict[str,Any]:
+        return self.sync.upsert_item(body,**kwargs)
+
+    async def read_item(self, item: Union[str,Dict[str,Any]], partition_key: Any, **kwargs) -> Dict[str,Any]:
+        return self.sync.read_item(item,partition_key,**kwargs)
+
+    async def delete_item(self, item: Union[str,Dict[str,Any]], partition_key: Any, **kwargs) -> None:
+        return self.sync.delete_item(item,partition_key,**kwargs)
+
+    async def patch_item(self, item: Union[str,Dict[str,Any]], partition_key: Any, patch_operations: List[Dict[str,Any]], **kwargs) -> Dict[str,Any]:
+        return self.sync.patch_item(item,partition_key,patch_operations,**kwargs)
+
+    async def execute_item_batch(self, batch_operations: List[Tuple[str,Tuple[Any,...]]], partition_key: Any, **kwargs) -> List[Dict[str,Any]]:
+        return self.sync.execute_item_batch(batch_operations,partition_key,**kwargs)
+
+    def read_all_items(self, **kwargs) -> AsyncQueryIterable:
+        return AsyncQueryIterable(self.sync.read_all_items(**kwargs))
+
+    def query_items(self, query: str, **kwargs) -> AsyncQueryIterable:
+        return AsyncQueryIterable(self.sync.query_items(query,**kwargs))
@@ -0,0 +1,466 @@
+import re
+from functools import lru_cache
+
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+### A small interpreter for the subset of Cosmos SQL that this package
+### generates: SELECT (*, VALUE expr, expr AS alias, ...) FROM c, WHERE,
+### GROUP BY, ORDER BY, OFFSET/LIMIT, @parameters, the usual operators
+### and a handful of built in and aggregate functions. Missing fields are
+### 'undefined' as they are in Cosmos: comparisons involving them are
+### neither true nor false, and rows that don't have the ORDER BY field
+### are left out.
+
+class QueryError(ValueError):
+    pass
+
+class _Undefined():
+    def __repr__(self):
+        return "undefined"
+    def __bool__(self):
+        return False
+
+UNDEFINED = _Undefined()
+
+KEYWORDS = { 'SELECT', 'VALUE', 'TOP', 'FROM', 'WHERE', 'AND', 'OR', 'NOT', 'IN', 'GROUP', 'ORDER', 'BY', 'ASC', 'DESC', 'OFFSET', 'LIMIT', 'AS', 'TRUE', 'FALSE', 'NULL', 'UNDEFINED' }
+AGGREGATES = { 'COUNT', 'MAX', 'MIN', 'SUM', 'AVG' }
+
+TOKEN_RE = re.compile(r'''
+    (?P<ws>\s+)
+  | (?P<num>\d+(?:\.\d+)?(?:[eE][-+]?\d+)?)
+  | (?P<str>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")
+  | (?P<param>@[A-Za-z_][A-Za-z0-9_]*)
+  | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+  | (?P<op>!=|<>|<=|>=|\|\||[=<>(){}\[\],.:*+\-/%])
+''',re.VERBOSE)
+
+def tokenise(q: str) -> List[Tuple[str,Any]]:
+    out=[]
+    pos=0
+    while pos < len(q):
+        m = TOKEN_RE.match(q,pos)
+        if not m:
+            raise QueryError(f"Unexpected character at {pos}: {q[pos:pos+10]!r}")
+        pos = m.end()
+        kind = m.lastgroup
+        text = m.group()
+        if kind == 'ws':
+            continue
+        elif kind == 'num':
+            out.append(('lit',float(text) if any( i in text for i in '.eE' ) else int(text)))
+        elif kind == 'str':
+            out.append(('lit',re.sub(r'\\(.)',r'\1',text[1:-1])))
+        elif kind == 'name' and text.upper() in KEYWORDS:
+            out.append(('kw',text.upper()))
+        else:
+            out.append((kind,text))
+    out.append(('end',None))
+    return out
+
+class Parser():
+
+    def __init__(self, q: str):
+        self.tokens = tokenise(q)
+        self.pos = 0
+        self.alias = None
+
+    def peek(self, kind: str, value: Any=None) -> bool:
+        tok = self.tokens[self.pos]
+        return tok[0] == kind and ( value is None or tok[1] == value )
+
+    def accept(self, kind: str, value: Any=None) -> Optional[Tuple[str,Any]]:
+        if self.peek(kind,value):
+            self.pos += 1
+            return self.tokens[self.pos-1]
+        return None
+
+    def expect(self, kind: str, value: Any=None) -> Tuple[str,Any]:
+        tok = self.accept(kind,value)
+        if tok is None:
+            raise QueryError(f"Expected {value or kind}, got {self.tokens[self.pos][1]!r}")
+        return tok
+
+    def parse(self) -> Dict[str,Any]:
+        query = { 'select': None, 'top': None, 'where': None, 'group': [], 'order': [], 'offset': None, 'limit': None }
+        self.expect('kw','SELECT')
+        if self.accept('kw','TOP'):
+            query['top'] = self.primary()
+        ### The alias isn't known until FROM, so parse the selection later
+        select_start = self.pos
+        depth = 0
+        while not ( depth == 0 and self.peek('kw','FROM') ):
+            if self.peek('end'):
+                raise QueryError("Missing FROM")
+            if self.peek('op','(') or self.peek('op','{') or self.peek('op','['): depth += 1
+            if self.peek('op',')') or self.peek('op','}') or self.peek('op',']'): depth -= 1
+            self.pos += 1
+        self.expect('kw','FROM')
+        self.alias = self.expect('name')[1]
+        from_end = self.pos
+
+        self.pos = select_start
+        query['select'] = self.selection()
+        self.expect('kw','FROM')
+        self.pos = from_end
+
+        if self.accept('kw','WHERE'):
+            query['where'] = self.expr()
+        if self.accept('kw','GROUP'):
+            self.expect('kw','BY')
+            query['group'] = self.expr_list()
+        if self.accept('kw','ORDER'):
+            self.expect('kw','BY')
+            while True:
+                e = self.expr()
+                desc = bool(self.accept('kw','DESC'))
+                if not desc: self.accept('kw','ASC')
+                query['order'].append((e,desc))
+                if not self.accept('op',','):
+                    break
+        if self.accept('kw','OFFSET'):
+            query['offset'] = self.primary()
+            self.expect('kw','LIMIT')
+            query['limit'] = self.primary()
+        self.expect('end')
+        return query
+
+    def selection(self) -> Tuple:
+        if self.accept('op','*'):
+            return ('star',)
+        if self.accept('kw','VALUE'):
+            return ('value',self.expr())
+        fields=[]
+        while True:
+            e = self.expr()
+            if self.accept('kw','AS'):
+                name = self.expect('name')[1]
+            elif e[0] == 'ref' and e[1]:
+                name = e[1][-1]
+            else:
+                name = f"${len(fields)+1}"
+            fields.append((name,e))
+            if not self.accept('op',','):
+                return ('fields',fields)
+
+    def expr_list(self) -> List[Tuple]:
+        out=[ self.expr(), ]
+        while self.accept('op',','):
+            out.append(self.expr())
+        return out
+
+    def expr(self) -> Tuple:
+        left = self.conjunction()
+        while self.accept('kw','OR'):
+            left = ('or',left,self.conjunction())
+        return left
+
+    def conjunction(self) -> Tuple:
+        left = self.negation()
+        while self.accept('kw','AND'):
+            left = ('and',left,self.negation())
+        return left
+
+    def negation(self) -> Tuple:
+        if self.accept('kw','NOT'):
+            return ('not',self.negation())
+        return self.comparison()
+
+    def comparison(self) -> Tuple:
+        left = self.additive()
+        for op in ( '=', '!=', '<>', '<=', '>=', '<', '>' ):
+            if self.accept('op',op):
+                return ('cmp','!=' if op == '<>' else op,left,self.additive())
+        negate = bool(self.accept('kw','NOT'))
+        if self.accept('kw','IN'):
+            self.expect('op','(')
+            node = ('in',left,self.expr_list())
+            self.expect('op',')')
+            return ('not',node) if negate else node
+        if negate:
+            raise QueryError("Expected IN after NOT")
+        return left
+
+    def additive(self) -> Tuple:
+        left = self.multiplicative()
+        while True:
+            tok = self.accept('op','+') or self.accept('op','-') or self.accept('op','||')
+            if not tok:
+                return left
+            left = ('arith',tok[1],left,self.multiplicative())
+
+    def multiplicative(self) -> Tuple:
+        left = self.unary()
+        while True:
+            tok = self.accept('op','*') or self.accept('op','/') or self.accept('op','%')
+            if not tok:
+                return left
+            left = ('arith',tok[1],left,self.unary())
+
+    def unary(self) -> Tuple:
+        if self.accept('op','-'):
+            return ('arith','-',('lit',0),self.unary())
+        return self.primary()
+
+    def primary(self) -> Tuple:
+        tok = self.tokens[self.pos]
+        if self.accept('lit'):
+            return ('lit',tok[1])
+        if self.accept('param'):
+            return ('param',tok[1])
+        if self.accept('kw','TRUE'):
+            return ('lit',True)
+        if self.accept('kw','FALSE'):
+            return ('lit',False)
+        if self.accept('kw','NULL'):
+            return ('lit',None)
+        if self.accept('kw','UNDEFINED'):
+            return ('lit',UNDEFINED)
+        if self.accept('op','('):
+            e = self.expr()
+            self.expect('op',')')
+            return e
+        if self.accept('op','{'):
+            items=[]
+            while not self.accept('op','}'):
+                key = self.accept('name') or self.expect('lit')
+                self.expect('op',':')
+                items.append((str(key[1]),self.expr()))
+                self.accept('op',',')
+            return ('obj',items)
+        if self.accept('op','['):
+            items=[]
+            while not self.accept('op',']'):
+                items.append(self.expr())
+                self.accept('op',',')
+            return ('arr',items)
+        if self.accept('name'):
+            name = tok[1]
+            if self.accept('op','('):
+                args = []
+                if not self.accept('op',')'):
+                    args = self.expr_list()
+                    self.expect('op',')')
+                return ('call',name.upper(),args)
+            if name != self.alias:
+                raise QueryError(f"Unknown identifier {name!r}")
+            path=[]
+            while True:
+                if self.accept('op','.'):
+                    path.append(self.expect('name')[1])
+                elif self.accept('op','['):
+                    path.append(self.expect('lit')[1])
+                    self.expect('op',']')
+                else:
+                    return ('ref',tuple(path))
+        raise QueryError(f"Unexpected {tok[1]!r}")
+
+@lru_cache(maxsize=256)
+def parse(q: str) -> Dict[str,Any]:
+    ### Queries from query_builder have stable text, so this is mostly hits
+    query = Parser(q).parse()
+    query['aggregate'] = bool(query['group']) or _has_aggregate(query['select'])
+    return query
+
+def _has_aggregate(node: Any) -> bool:
+    if isinstance(node,tuple):
+        if node and node[0] == 'call' and node[1] in AGGREGATES:
+            return True
+        return any( _has_aggregate(i) for i in node )
+    if isinstance(node,list):
+        return any( _has_aggregate(i) for i in node )
+    return False
+
+### Cosmos orders values of different types by type first
+def _type_rank(v: Any) -> int:
+    if v is None: return 1
+    if isinstance(v,bool): return 2
+    if isinstance(v,(int,float)): return 3
+    if isinstance(v,str): return 4
+    if isinstance(v,list): return 5
+    return 6
+
+def sort_key(v: Any) -> Tuple[int,Any]:
+    rank = _type_rank(v)
+    return ( rank, v if rank in ( 2, 3, 4 ) else 0 )
+
+def _compare(op: str, a: Any, b: Any) -> Any:
+    if a is UNDEFINED or b is UNDEFINED:
+        return UNDEFINED
+    if _type_rank(a) != _type_rank(b):
+        return UNDEFINED
+    if op == '=': return a == b
+    if op == '!=': return a != b
+    if _type_rank(a) not in ( 2, 3, 4 ):
+        return UNDEFINED
+    if op == '<': return a < b
+    if op == '>': return a > b
+    if op == '<=': return a <= b
+    return a >= b
+
+def _arith(op: str, a: Any, b: Any) -> Any:
+    if op == '||':
+        return a + b if isinstance(a,str) and isinstance(b,str) else UNDEFINED
+    if _type_rank(a) != 3 or _type_rank(b) != 3:
+        return UNDEFINED
+    try:
+        if op == '+': return a + b
+        if op == '-': return a - b
+        if op == '*': return a * b
+        if op == '/': return a / b
+        return a % b
+    except ZeroDivisionError:
+        return UNDEFINED
+
+def _str_fn(fn: Callable) -> Callable:
+    def wrapped(*args):
+        if not all( isinstance(i,(str,int,float)) and not isinstance(i,bool) for i in args ) or not isinstance(args[0],str):
+            return UNDEFINED
+        return fn(*args)
+    return wrapped
+
+FUNCTIONS: Dict[str,Callable] = {
+    'ARRAY_CONTAINS': lambda arr,v,partial=False: UNDEFINED if not isinstance(arr,list) else any( i == v or ( partial and isinstance(i,dict) and isinstance(v,dict) and all( i.get(k,UNDEFINED) == w for k,w in v.items() ) ) for i in arr ),
+    'ARRAY_LENGTH': lambda arr: len(arr) if isinstance(arr,list) else UNDEFINED,
+    'IS_DEFINED': lambda v: v is not UNDEFINED,
+    'IS_NULL': lambda v: v is None,
+    'LEFT': _str_fn(lambda s,n: s[:int(n)]),
+    'RIGHT': _str_fn(lambda s,n: s[len(s)-int(n):] if n else ''),
+    'SUBSTRING': _str_fn(lambda s,start,n: s[int(start):int(start)+int(n)]),
+    'LENGTH': _str_fn(len),
+    'LOWER': _str_fn(str.lower),
+    'UPPER': _str_fn(str.upper),
+    'CONTAINS': _str_fn(lambda s,sub: sub in s),
+    'STARTSWITH': _str_fn(lambda s,sub: s.startswith(sub)),
+    'ENDSWITH': _str_fn(lambda s,sub: s.endswith(sub)),
+}
+
+def _aggregate(fn: str, values: List[Any]) -> Any:
+    values = [ v for v in values if v is not UNDEFINED ]
+    if fn == 'COUNT':
+        return len(values)
+    if fn in ( 'MAX', 'MIN' ):
+        if not values:
+            return UNDEFINED
+        return ( max if fn == 'MAX' else min )(values,key=sort_key)
+    numbers = [ v for v in values if _type_rank(v) == 3 ]
+    if len(numbers) != len(values):
+        return UNDEFINED
+    if fn == 'SUM':
+        return sum(numbers)
+    return sum(numbers)/len(numbers) if numbers else UNDEFINED
+
+class Evaluator():
+
+    def __init__(self, params: Dict[str,Any]):
+        self.params = params
+
+    def ev(self, node: Tuple, doc: Any, group: Optional[List[Any]]=None) -> Any:
+        kind = node[0]
+        if kind == 'ref':
+            v = doc
+            for k in node[1]:
+                if isinstance(v,dict) and isinstance(k,str):
+                    v = v.get(k,UNDEFINED)
+                elif isinstance(v,list) and isinstance(k,int) and 0 <= k < len(v):
+                    v = v[k]
+                else:
+                    return UNDEFINED
+            return v
+        if kind == 'lit':
+            return node[1]
+        if kind == 'param':
+            if node[1] not in self.params:
+                raise QueryError(f"Missing parameter {node[1]}")
+            return self.params[node[1]]
+        if kind == 'cmp':
+            return _compare(node[1],self.ev(node[2],doc,group),self.ev(node[3],doc,group))
+        if kind == 'and':
+            a = self.ev(node[1],doc,group)
+            if a is False: return False
+            b = self.ev(node[2],doc,group)
+            if b is False: return False
+            return True if a is True and b is True else UNDEFINED
+        if kind == 'or':
+            a = self.ev(node[1],doc,group)
+            if a is True: return True
+            b = self.ev(node[2],doc,group)
+            if b is True: return True
+            return False if a is False and b is False else UNDEFINED
+        if kind == 'not':
+            v = self.ev(node[1],doc,group)
+            return not v if isinstance(v,bool) else UNDEFINED
+        if kind == 'in':
+            v = self.ev(node[1],doc,group)
+            if v is UNDEFINED: return UNDEFINED
+            return any( _compare('=',v,self.ev(i,doc,group)) is True for i in node[2] )
+        if kind == 'arith':
+            return _arith(node[1],self.ev(node[2],doc,group),self.ev(node[3],doc,group))
+        if kind == 'obj':
+            out={}
+            for k,e in node[1]:
+                v = self.ev(e,doc,group)
+                if v is not UNDEFINED:
+                    out[k] = v
+            return out
+        if kind == 'arr':
+            return [ v for v in ( self.ev(e,doc,group) for e in node[1] ) if v is not UNDEFINED ]
+        if kind == 'call':
+            if node[1] in AGGREGATES:
+                if group is None:
+                    raise QueryError(f"{node[1]} used outside of an aggregate query")
+                return _aggregate(node[1],[ self.ev(node[2][0],d) for d in group ])
+            if node[1] not in FUNCTIONS:
+                raise QueryError(f"Unsupported function {node[1]}")
+            args = [ self.ev(e,doc,group) for e in node[2] ]
+            return FUNCTIONS[node[1]](*args)
+        raise QueryError(f"Unsupported expression {kind}")
+
+    def project(self, select: Tuple, doc: Any, group: Optional[List[Any]]=None) -> Any:
+        if select[0] == 'star':
+            return dict(doc)
+        if select[0] == 'value':
+            return self.ev(select[1],doc,group)
+        out={}
+        for name,e in select[1]:
+            v = self.ev(e,doc,group)
+            if v is not UNDEFINED:
+                out[name] = v
+        return out
+
+def run(q: str, parameters: Optional[List[Dict[str,Any]]], docs: Iterable[Dict[str,Any]]) -> List[Any]:
+
+    query = parse(q)
+    evaluator = Evaluator({ p['name']:p['value'] for p in parameters or [] })
+
+    if query['where'] is not None:
+        docs = [ d for d in docs if evaluator.ev(query['where'],d) is True ]
+    else:
+        docs = list(docs)
+
+    if query['aggregate']:
+        groups: Dict[Any,List[Any]] = {}
+        if query['group']:
+            for d in docs:
+                key = repr([ evaluator.ev(e,d) for e in query['group'] ])
+                groups.setdefault(key,[]).append(d)
+        else:
+            groups[None] = docs
+        out = [ evaluator.project(query['select'],g[0] if g else {},g) for g in groups.values() ]
+    else:
+        for e,desc in reversed(query['order']):
+            keyed = [ ( evaluator.ev(e,d), d ) for d in docs ]
+            keyed = [ i for i in keyed if i[0] is not UNDEFINED ]
+            keyed.sort(key=lambda x: sort_key(x[0]),reverse=desc)
+            docs = [ d for _,d in keyed ]
+        out = [ evaluator.project(query['select'],d) for d in docs ]
+
+    out = [ i for i in out if i is not UNDEFINED ]
+
+    if query['offset'] is not None:
+        offset = evaluator.ev(query['offset'],{})
+        limit = evaluator.ev(query['limit'],{})
+        out = out[offset:offset+limit]
+    if query['top'] is not None:
+        out = out[:evaluator.ev(query['top'],{})]
+
+    return out
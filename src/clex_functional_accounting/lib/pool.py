@@ -0,0 +1,16 @@
+import requests
+from azure.core.pipeline.transport import RequestsTransport
+
+from . import config
+
+POOL_SIZE: int = config.settings['client_pool_size']
+
+def pooled_transport(pool_size: int=POOL_SIZE) -> RequestsTransport:
+    ### A keep-alive session large enough for every thread in the worker
+    ### to hold its own connection, so long-lived clients never have to
+    ### wait on or re-establish TLS connections between requests
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,pool_maxsize=pool_size)
+    session.mount('https://',adapter)
+    session.mount('http://',adapter)
+    return RequestsTransport(session=session,session_owner=False)
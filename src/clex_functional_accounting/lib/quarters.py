@@ -0,0 +1,46 @@
+from datetime import datetime
+
+from typing import List, NamedTuple, Optional
+
+### Time series containers are partitioned by quarter, with partition keys
+### of the form YYYY.qN (see CosmosDBWriter._get_partition_key_val)
+
+class Partition(NamedTuple):
+    key: str
+    ### Bounds on ts within this partition, None where the range covers
+    ### the quarter up to its edge
+    start: Optional[datetime]
+    end: Optional[datetime]
+
+def quarter(t: datetime) -> str:
+    return f"{t.year}.q{(t.month-1)//3+1}"
+
+def quarter_start(t: datetime) -> datetime:
+    return datetime(t.year,3*((t.month-1)//3)+1,1)
+
+def next_quarter_start(t: datetime) -> datetime:
+    start = quarter_start(t)
+    if start.month == 10:
+        return datetime(start.year+1,1,1)
+    return datetime(start.year,start.month+3,1)
+
+def plan(start: Optional[datetime] = None, end: Optional[datetime] = None, now: Optional[datetime] = None) -> List[Partition]:
+
+    ### Every quarter overlapping start to end, in order. Nothing is ever
+    ### written ahead of the current time, so later quarters are left out.
+    ### Without a range, only the current quarter is of interest.
+    if not now:
+        now = datetime.now()
+    if start is None:
+        return [ Partition(quarter(now),None,None), ]
+    last = now if end is None or end > now else end
+
+    out=[]
+    q_start = quarter_start(start)
+    while q_start <= last:
+        q_end = next_quarter_start(q_start)
+        out.append(Partition(quarter(q_start),
+                             start if start > q_start else None,
+                             end if end is not None and end < q_end else None))
+        q_start = q_end
+    return out
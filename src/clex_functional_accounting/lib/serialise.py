@@ -0,0 +1,50 @@
+import json
+import logging
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+from typing import Any, Callable, Dict, Tuple, Union
+
+### JSON encoding and decoding for the API, blobs and ingest tools. Uses
+### the fastest library installed, falling back to the standard library.
+### Whichever backend is in use, dumps() returns bytes and loads() accepts
+### either bytes or str.
+
+def _stdlib_dumps(obj: Any) -> bytes:
+    return json.dumps(obj).encode()
+
+def _orjson_dumps(obj: Any) -> bytes:
+    return orjson.dumps(obj,option=orjson.OPT_NON_STR_KEYS)
+
+BACKENDS: Dict[str,Tuple[Callable[[Any],bytes],Callable[[Union[bytes,str]],Any]]] = {
+    'json': (_stdlib_dumps,json.loads),
+}
+if msgspec:
+    BACKENDS['msgspec'] = (msgspec.json.Encoder().encode,msgspec.json.Decoder().decode)
+if orjson:
+    BACKENDS['orjson'] = (_orjson_dumps,orjson.loads)
+
+DEFAULT_BACKEND: str = next(i for i in ( 'orjson', 'msgspec', 'json' ) if i in BACKENDS)
+
+### Can be overridden, e.g. to compare against the standard library. A
+### backend that isn't installed falls back to the default rather than
+### stopping everything that imports this from loading
+BACKEND: str = os.environ.get('CLEXFA_JSON_BACKEND',None) or DEFAULT_BACKEND
+if BACKEND not in BACKENDS:
+    logging.getLogger("clex_functional_accounting.serialise").warning(
+        f"CLEXFA_JSON_BACKEND={BACKEND!r} is not available, valid choices are {', '.join(sorted(BACKENDS))}. Using {DEFAULT_BACKEND!r}")
+    BACKEND = DEFAULT_BACKEND
+
+dumps, loads = BACKENDS[BACKEND]
+
+def dumps_str(obj: Any) -> str:
+    return dumps(obj).decode()
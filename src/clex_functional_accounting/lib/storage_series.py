@@ -0,0 +1,88 @@
+from datetime import datetime, timedelta
+
+from typing import Any, Dict, List, Optional, Tuple
+
+from . import config, quarters
+
+### Change-only storage history. With storage_change_only set, update_lquota
+### only adds a row to 'storage' when a project's usage, quota or inodes on a
+### filesystem has moved by more than storage_change_threshold (a fraction
+### of the value) since the last row stored for it. It also stores one the
+### first time a series is seen in a quarter and often enough that the
+### sample in force at any time is never more than storage_max_sample_age
+### hours old. expand() fills the unchanged samples back in when reading.
+
+CHANGE_ONLY: bool = config.settings['storage_change_only']
+THRESHOLD: float = config.settings['storage_change_threshold']
+MAX_AGE = timedelta(hours=config.settings['storage_max_sample_age'])
+### How often update_lquota runs
+INTERVAL = timedelta(hours=6)
+### How much the time between two runs can exceed INTERVAL by, as cron
+### starts them late
+RUN_SLACK = timedelta(hours=1)
+### Age at which an unchanged series is stored again. The run before was
+### younger than this and runs are at most INTERVAL + RUN_SLACK apart, so
+### it is stored before its last row is MAX_AGE old, which is as far back
+### as expand() and the API look for it
+REWRITE_AGE = max(MAX_AGE - INTERVAL - RUN_SLACK,timedelta(0))
+SAMPLE_FIELDS = ( 'usage', 'quota', 'limit', 'iusage', 'iquota', 'ilimit' )
+
+def parse_ts(ts: str) -> datetime:
+    return datetime.fromisoformat(ts[:-1] if ts.endswith('Z') else ts)
+
+def format_ts(t: datetime) -> str:
+    return t.isoformat() + "Z"
+
+def sample(entry: Dict[str,Any]) -> Dict[str,Any]:
+    ### What's kept in storage_latest of the last row stored for a series
+    return { 'ts': entry['ts'] } | { f:entry[f] for f in SAMPLE_FIELDS if f in entry }
+
+def _moved(old: Any, new: Any) -> bool:
+    if old == new:
+        return False
+    ### lquota reports e.g. 'Over ... quota' in place of some numbers
+    if not isinstance(old,( int, float )) or not isinstance(new,( int, float )):
+        return True
+    return abs(new - old) > THRESHOLD * abs(old)
+
+def due(previous: Optional[Dict[str,Any]], entry: Dict[str,Any]) -> bool:
+    ### Whether entry needs storing, given the sample() of the last row
+    ### stored for its series
+    if not previous:
+        return True
+    then = parse_ts(previous['ts'])
+    now = parse_ts(entry['ts'])
+    if quarters.quarter(then) != quarters.quarter(now) or now - then >= REWRITE_AGE:
+        return True
+    return any([ _moved(previous.get(f,None),entry.get(f,None)) for f in SAMPLE_FIELDS ])
+
+def _series(row: Dict[str,Any]) -> Tuple:
+    return ( row.get('system',None), row['fs'], row['project'] )
+
+def expand(rows: List[Dict[str,Any]], start: Optional[datetime], end: Optional[datetime], now: Optional[datetime] = None) -> List[Dict[str,Any]]:
+
+    ### Steps each series' stored samples forward to every time update_lquota
+    ### ran in between, as if each of those runs had stored a row. The last
+    ### sample stands for as long as it could without a newer one being
+    ### stored. Only rows with start < ts < end are returned.
+    if now is None:
+        now = datetime.now()
+
+    series: Dict[Tuple,List[Dict[str,Any]]] = {}
+    for row in rows:
+        series.setdefault(_series(row),[]).append(row)
+
+    out=[]
+    for samples in series.values():
+        samples.sort(key=lambda x: x['ts'])
+        times = [ parse_ts(i['ts']) for i in samples ]
+        for i,row in enumerate(samples):
+            stop = times[i+1] if i+1 < len(samples) else min(now,times[i] + MAX_AGE)
+            t = times[i]
+            while end is None or t < end:
+                if start is None or t > start:
+                    out.append(row if t == times[i] else row | { 'ts': format_ts(t) })
+                t = t + INTERVAL
+                if t >= stop:
+                    break
+    return out
@@ -0,0 +1,57 @@
+from typing import Any, Dict, List
+
+from . import blob, latest
+
+### Pre-merged contents of files_report_latest and storage_latest as served
+### by the storage_latest endpoint. Rebuilt by each ingest job that writes
+### to either container.
+BLOB: str = 'storage_latest_snapshot'
+
+### Fields served from files_report(_latest), and those quota_rows() needs
+### from storage(_latest)
+FILES_REPORT_FIELDS: List[str] = [ 'id', 'ts', 'fs', 'user', 'ownership', 'location', 'size', 'inodes' ]
+QUOTA_FIELDS: List[str] = [ 'ts', 'system', 'project', 'fs', 'usage', 'quota', 'iusage', 'iquota' ]
+
+def quota_rows(entry: Dict[str,Any], total: bool=True, grant: bool=True) -> List[Dict[str,Any]]:
+    ### Present a storage (lquota) entry as files_report style rows for
+    ### the project's total usage and its quota. Fields starting with '_'
+    ### are for filtering only and are never sent to clients
+    out=[]
+    if total:
+        out.append({"ts":entry["ts"],
+                    "id":f'{entry["system"]}_{entry["fs"]}_total_{entry["project"]}_{entry["project"]}',
+                    "fs":entry["fs"],
+                    "user":"total",
+                    "ownership":entry["project"],
+                    "location":entry["project"],
+                    "size":entry["usage"],
+                    "inodes":entry["iusage"],
+                    "_system":entry["system"],
+                    "_quota":True,
+                    })
+    if grant:
+        out.append({"ts":entry["ts"],
+                    "id":f'{entry["system"]}_{entry["fs"]}_quota_{entry["project"]}_{entry["project"]}',
+                    "fs":entry["fs"],
+                    "user":"grant",
+                    "ownership":entry["project"],
+                    "location":entry["project"],
+                    "size":entry["quota"],
+                    "inodes":entry["iquota"],
+                    "_system":entry["system"],
+                    "_quota":True,
+                    })
+    return out
+
+def build(files_report_latest: List[Dict[str,Any]], storage_latest: List[Dict[str,Any]], ts: str) -> Dict[str,Any]:
+    rows = [ { k:i[k] for k in FILES_REPORT_FIELDS if k in i } | { '_system': i['system'] } for i in files_report_latest ]
+    for i in storage_latest:
+        rows.extend(quota_rows(i))
+    return { 'ts': ts, 'rows': rows }
+
+def publish(blob_writer: blob.BlobWriter, files_report_latest: List[Dict[str,Any]], storage_latest: List[Dict[str,Any]], ts: str, sources: List[str]) -> None:
+    ### sources are those the caller is about to mark_ingest with ts
+    ingest_state = blob_writer.read_item(blob.CONTAINER,blob.INGEST_STATE,default={}) | { s:ts for s in sources }
+    latest.refresh('files_report_latest',files_report_latest,ingest_state)
+    latest.refresh('storage_latest',storage_latest,ingest_state)
+    blob_writer.write_item(build(files_report_latest,storage_latest,ts),blob.CONTAINER,BLOB)
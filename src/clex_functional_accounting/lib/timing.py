@@ -0,0 +1,88 @@
+import contextvars
+import logging
+import time
+
+from typing import Any, Dict, List, Mapping, Optional
+
+from . import serialise
+
+### Records where the time (and Cosmos request units) went while serving a
+### request. Spans are collected in a context variable, so they follow the
+### request into worker threads as long as work is submitted with a copy of
+### the context (see contextvars.copy_context). Outside of a request,
+### spans are still timed but not kept anywhere.
+
+logger = logging.getLogger("clex_functional_accounting.timing")
+
+_spans: contextvars.ContextVar[Optional[List["Span"]]] = contextvars.ContextVar("clexfa_spans",default=None)
+
+class Span():
+    ### Can be entered more than once, e.g. once per page of a query, and
+    ### accumulates the time spent inside it
+    __slots__ = ( 'name', 'duration', 'charge', '_start' )
+
+    def __init__(self, name: str):
+        self.name = name
+        self.duration = 0.0
+        self.charge = 0.0
+        self._start = 0.0
+
+    def __enter__(self) -> "Span":
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.duration += time.perf_counter() - self._start
+
+    def hook(self, headers: Mapping[str,str], *_) -> None:
+        ### For the azure-cosmos response_hook keyword, called once per response
+        self.charge += float(headers.get('x-ms-request-charge',0) or 0)
+
+def span(name: str) -> Span:
+    s = Span(name)
+    spans = _spans.get()
+    if spans is not None:
+        spans.append(s)
+    return s
+
+def begin() -> List[Span]:
+    ### Start keeping the spans of this context (and copies of it)
+    spans = []
+    _spans.set(spans)
+    return spans
+
+def end() -> None:
+    _spans.set(None)
+
+def summarise(spans: List[Span]) -> Dict[str,Dict[str,Any]]:
+    ### Total time (ms), request units and number of calls for each span name
+    out={}
+    for s in spans:
+        entry = out.setdefault(s.name,{ 'dur': 0.0, 'ru': 0.0, 'calls': 0 })
+        entry['dur'] += s.duration*1000
+        entry['ru'] += s.charge
+        entry['calls'] += 1
+    for entry in out.values():
+        entry['dur'] = round(entry['dur'],2)
+        entry['ru'] = round(entry['ru'],2)
+    return out
+
+def server_timing(spans: List[Span], total: float) -> str:
+    out=[ f"total;dur={total*1000:.2f}", ]
+    for name,entry in summarise(spans).items():
+        desc = f"{entry['calls']} calls"
+        if entry['ru']:
+            desc += f", {entry['ru']} RU"
+        out.append(f'{name};dur={entry["dur"]:.2f};desc="{desc}"')
+    return ', '.join(out)
+
+def log(endpoint: str, status: int, spans: List[Span], total: float) -> None:
+    ### One line per request, as JSON so it can be queried from
+    ### Application Insights (traces | extend d=parse_json(message))
+    logger.info(serialise.dumps_str({
+        'endpoint': endpoint,
+        'status': status,
+        'dur': round(total*1000,2),
+        'ru': round(sum( s.charge for s in spans ),2),
+        'spans': summarise(spans),
+    }))
@@ -0,0 +1,38 @@
+import os
+import sys
+
+import pytest
+
+### Configuration is read at import time, so this has to happen before
+### anything from the package is imported. Everything runs against the
+### in-process stand-in backend (lib/local)
+os.environ['CLEXFA_LOCAL_BACKEND'] = ':memory:'
+os.environ['REMOTE_CMD_HOST'] = 'gadi'
+os.environ['CLEXFA_AUTH_SECRET'] = 'test-secret'
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','src','clex_functional_accounting','function'))
+
+from werkzeug.test import Client
+
+from clex_functional_accounting.lib import auth, blob, cosmosdb, local
+
+@pytest.fixture
+def store() -> local.Store:
+    ### An empty store, and writers that haven't cached anything from it
+    s = local.get_store()
+    with s.lock:
+        s.cosmos.clear()
+        s.blobs.clear()
+    cosmosdb._shared_writer = None
+    blob._shared_writer = None
+    import function_app
+    function_app.continuation_cache.invalidate()
+    return s
+
+@pytest.fixture
+def api(store) -> Client:
+    import function_app
+    return Client(function_app.werkzeug_app)
+
+@pytest.fixture
+def token() -> str:
+    return auth.issue_token()
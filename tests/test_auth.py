@@ -0,0 +1,56 @@
+import threading
+import time
+
+from clex_functional_accounting.lib import auth, blob
+
+def test_issued_token_verifies():
+    token = auth.issue_token('s')
+    claims = auth.read_token(token,'s')
+    assert claims is not None
+    assert claims['exp'] > time.time()
+    assert auth.verify_token(token,{},'s')
+
+def test_tampered_token_is_rejected():
+    payload, signature = auth.issue_token('s').split('.')
+    other_payload, _ = auth.issue_token('s').split('.')
+    assert auth.read_token(f"{other_payload}.{signature}",'s') is None
+    assert auth.read_token(f"{payload}.{signature[:-2]}AA",'s') is None
+    assert auth.read_token(auth.issue_token('other'),'s') is None
+
+def test_malformed_tokens_are_rejected():
+    for key in ( '', 'abc', 'a.b.c', 'é.é', '.', 'not base64!.x' ):
+        assert auth.read_token(key,'s') is None
+
+def test_expired_token_is_rejected():
+    assert auth.read_token(auth.issue_token('s',lifetime=-1),'s') is None
+
+def test_revoked_token_is_rejected():
+    token = auth.issue_token('s')
+    revoked = auth.revoke_token({},token,'s')
+    assert not auth.verify_token(token,revoked,'s')
+    assert auth.verify_token(auth.issue_token('s'),revoked,'s')
+
+def test_revoke_drops_expired_entries():
+    revoked = auth.revoke_token({ 'old': int(time.time()) - 10 },auth.issue_token('s'),'s')
+    assert 'old' not in revoked
+    assert len(revoked) == 1
+
+def test_api_rejects_missing_and_bad_tokens(api, token):
+    assert api.get('/api/v0/compute').status_code == 401
+    assert api.get('/api/v0/compute',headers={'Authorization':'é.é'}).status_code == 401
+    assert api.get('/api/v0/compute',headers={'Authorization':token[:-2]+'AA'}).status_code == 401
+    assert api.get('/api/v0/compute',headers={'Authorization':token}).status_code == 200
+
+def test_logout_revokes_token(api, token):
+    assert api.post('/api/v0/logout',headers={'Authorization':token}).status_code == 204
+    assert api.get('/api/v0/compute',headers={'Authorization':token}).status_code == 401
+
+def test_concurrent_logouts_are_all_kept(api):
+    tokens = [ auth.issue_token() for _ in range(8) ]
+    threads = [ threading.Thread(target=api.post,args=('/api/v0/logout',),kwargs={'headers':{'Authorization':t}}) for t in tokens ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    revoked = blob.BlobWriter().read_item(blob.CONTAINER,auth.REVOKED_BLOB)
+    assert set(revoked) == set([ auth.read_token(t)['jti'] for t in tokens ])
@@ -0,0 +1,30 @@
+import threading
+import time
+
+from clex_functional_accounting.lib import blob
+
+def test_concurrent_updates_are_all_kept(store):
+    def add(i: int):
+        ### A writer each, as separate processes would have
+        def update(d):
+            time.sleep(0.005)
+            return d | { str(i): i }
+        blob.BlobWriter().update_item(blob.CONTAINER,'counts',update,default={})
+    threads = [ threading.Thread(target=add,args=(i,)) for i in range(16) ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert blob.BlobWriter().read_item(blob.CONTAINER,'counts') == { str(i): i for i in range(16) }
+
+def test_concurrent_ingest_jobs_are_all_marked(store):
+    jobs = [ [ 'storage', 'lquota' ], [ 'compute', 'storage', 'massdata' ], [ 'files_report' ] ]
+    threads = [ threading.Thread(target=blob.BlobWriter().mark_ingest,args=(sources,f"2026-10-18T00:{i:02d}:00Z")) for i,sources in enumerate(jobs) ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    state = blob.BlobWriter().read_item(blob.CONTAINER,blob.INGEST_STATE)
+    assert set(state) == { 'storage', 'lquota', 'compute', 'massdata', 'files_report' }
+    assert state['lquota'] == "2026-10-18T00:00:00Z"
+    assert state['files_report'] == "2026-10-18T00:02:00Z"
@@ -0,0 +1,84 @@
+import json
+from datetime import datetime, timedelta
+from urllib.parse import quote
+
+import azure.cosmos.exceptions as cosmos_exceptions
+import pytest
+
+from clex_functional_accounting.lib import cosmosdb, quarters
+from clex_functional_accounting.lib.local import cosmos as local_cosmos
+
+import function_app
+
+START = datetime(2026,2,1)
+### Three quarters, with rows at the six-hourly ingest times
+TIMES = [ START + timedelta(hours=6*i,minutes=25) for i in range(0,4*200,7) ]
+USERS = [ 'abc123', 'def456', 'total' ]
+
+@pytest.fixture
+def rows(store):
+    writer = cosmosdb.get_shared_writer()
+    container = writer.get_container('compute','Accounting',quarterly=True)
+    out=[]
+    for i,t in enumerate(TIMES):
+        for j,user in enumerate(USERS):
+            row = { 'id': f"{i}_{user}",
+                    'ts': t.isoformat() + "Z",
+                    'project': 'w40' if j % 2 else 'w41',
+                    'user': user,
+                    'usage': float((i*7 + j*13) % 50) }
+            container.upsert_item(row | { 'system': 'gadi', 'PartitionKey': quarters.quarter(t) })
+            out.append(row)
+    return out
+
+def get(api, token, **args):
+    query = '&'.join([ f"{k}={quote(json.dumps(v))}" for k,v in args.items() ])
+    return api.get(f'/api/v0/compute?{query}',headers={'Authorization':token})
+
+def test_rows_span_several_quarters(rows):
+    assert len(set([ r['ts'][:7] for r in rows ])) > 6
+    assert len(function_app.time_partitions([ rows[0]['ts'], rows[-1]['ts'] ])) == 3
+
+@pytest.mark.parametrize('field,order',[ ( 'ts', 'ASC' ), ( 'ts', 'DESC' ), ( 'usage', 'DESC' ), ( 'id', 'ASC' ) ])
+@pytest.mark.parametrize('start,end',[ ( 0, 9 ), ( 0, 0 ), ( 95, 140 ), ( 290, 330 ), ( 0, 1000 ) ])
+def test_ranges_match_a_sort_of_everything(api, token, rows, field, order, start, end):
+    filt = { 'ts': [ TIMES[0].isoformat(), TIMES[-1].isoformat() ] }
+    r = get(api,token,filter=filt,sort=[ field, order ],range=[ start, end ])
+    assert r.status_code == 200
+    got = r.get_json()
+    expected = sorted(rows,key=lambda x: x[field],reverse=order == 'DESC')[start:end+1]
+    ### Rows with equal sort keys can come back in any order
+    assert [ i[field] for i in got ] == [ i[field] for i in expected ]
+    last = min(end,len(rows)-1)
+    assert r.headers['Content-Range'] == f"compute {start}-{last}/{len(rows)}"
+
+def test_filters_apply_in_every_quarter(api, token, rows):
+    filt = { 'ts': [ TIMES[0].isoformat(), TIMES[-1].isoformat() ], 'user': 'total' }
+    got = get(api,token,filter=filt,sort=[ 'ts', 'ASC' ],range=[ 0, 9999 ]).get_json()
+    assert [ i['id'] for i in got ] == [ i['id'] for i in rows if i['user'] == 'total' ]
+
+def test_merge_partitions_is_lazy():
+    pulled = []
+    def stream(values):
+        for v in values:
+            pulled.append(v)
+            yield { 'ts': v }
+    merged = function_app.merge_partitions([ stream([ 1, 4, 7, 10 ]), stream([ 2, 5, 8 ]), stream([ 3, 6, 9 ]) ],'ts',2,4)
+    assert [ i['ts'] for i in merged ] == [ 3, 4, 5 ]
+    assert max(pulled) <= 7
+
+def test_errors_part_way_through_are_not_a_short_list(api, token, rows, monkeypatch):
+    ### Fail every page after the first of each partition. This range is
+    ### fetched 37 rows at a time, so the first quarter's rows take more
+    ### than one page
+    pages = {}
+    next_page = local_cosmos.Pager.__next__
+    def failing(self):
+        pages[id(self)] = pages.get(id(self),0) + 1
+        if pages[id(self)] > 1:
+            raise cosmos_exceptions.CosmosHttpResponseError(status_code=429,message="throttled")
+        return next_page(self)
+    monkeypatch.setattr(local_cosmos.Pager,'__next__',failing)
+    filt = { 'ts': [ TIMES[0].isoformat(), TIMES[-1].isoformat() ] }
+    with pytest.raises(cosmos_exceptions.CosmosHttpResponseError):
+        get(api,token,filter=filt,sort=[ 'ts', 'ASC' ],range=[ 100, 110 ]).get_data()
@@ -0,0 +1,49 @@
+import json
+from urllib.parse import quote
+
+import pytest
+
+from clex_functional_accounting.lib.cosmosdb import query_builder
+from clex_functional_accounting.lib.cosmosdb.query_builder import Filter, InvalidQuery
+
+@pytest.mark.parametrize('field',[ 'c.id', 'id OR 1=1', 'id--', '1abc', '', 'a b', 'ts"]', None, 3 ])
+def test_invalid_field_names_are_rejected(field):
+    with pytest.raises(InvalidQuery):
+        query_builder.build(where=Filter().compare(field,'=',1))
+    with pytest.raises(InvalidQuery):
+        query_builder.select_fields([ 'id', field ])
+
+@pytest.mark.parametrize('op',[ '==', 'LIKE', '= 1 OR 1 =', '' ])
+def test_invalid_operators_are_rejected(op):
+    with pytest.raises(InvalidQuery):
+        Filter().compare('id',op,1)
+
+@pytest.mark.parametrize('order',[ 'ts; DROP', 'ts DESC DESC', 'ts SIDEWAYS', 'c.ts', 'ts OFFSET 0 LIMIT 1' ])
+def test_invalid_orderings_are_rejected(order):
+    with pytest.raises(InvalidQuery):
+        query_builder.build(order=order)
+
+def test_values_are_only_ever_parameters():
+    q, params = query_builder.build(where=Filter().compare('ts','>',"x' OR 1=1 --").isin('project',[ "w40", "') OR (1=1" ]))
+    assert "1=1" not in q
+    assert [ p['value'] for p in params ] == [ "x' OR 1=1 --", [ "w40", "') OR (1=1" ] ]
+    assert q == "SELECT * FROM c WHERE c.ts > @p0 AND ARRAY_CONTAINS(@p1, c.project)"
+
+def test_text_depends_only_on_shape():
+    q1, _ = query_builder.build(where=Filter().isin('user',[ 'a' ]),order='ts DESC',limit=5)
+    q2, p2 = query_builder.build(where=Filter().isin('user',[ 'b', 'c' ]),order='ts DESC',limit=10)
+    assert q1 == q2
+    assert p2[-1] == { 'name': '@limit', 'value': 10 }
+
+def test_reserved_words_are_quoted():
+    q, _ = query_builder.build(query_builder.select_fields([ 'id', 'limit' ]),Filter().compare('value','>',0),order='limit')
+    assert q == 'SELECT VALUE { id: c.id, "limit": c["limit"] } FROM c WHERE c["value"] > @p0 ORDER BY c["limit"]'
+
+@pytest.mark.parametrize('endpoint',[ 'compute', 'storage', 'compute_rollup' ])
+@pytest.mark.parametrize('args',[ { 'filter': { 'id OR 1=1': 'x' } },
+                                  { 'filter': { 'c.project': 'w40' } },
+                                  { 'sort': [ 'ts) OR (1=1', 'ASC' ] } ])
+def test_api_returns_400_for_bad_queries(api, token, endpoint, args):
+    query = '&'.join([ f"{k}={quote(json.dumps(v))}" for k,v in args.items() ])
+    r = api.get(f'/api/v0/{endpoint}?{query}',headers={'Authorization':token})
+    assert r.status_code == 400
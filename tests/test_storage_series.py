@@ -0,0 +1,67 @@
+from datetime import datetime, timedelta
+import random
+
+from clex_functional_accounting.lib import storage_series
+from clex_functional_accounting.lib.storage_series import INTERVAL, MAX_AGE, REWRITE_AGE, RUN_SLACK, format_ts
+
+T0 = datetime(2026,10,5,0,15)
+
+def row(t: datetime, usage: int, project: str = 'w40') -> dict:
+    return { 'ts': format_ts(t), 'system': 'gadi', 'fs': 'gdata', 'project': project, 'usage': usage }
+
+def times(rows):
+    return [ r['ts'] for r in sorted(rows,key=lambda x: x['ts']) ]
+
+def test_samples_are_stepped_forward_to_every_run():
+    rows = [ row(T0,1), row(T0 + 2*INTERVAL,2) ]
+    out = storage_series.expand(rows,None,None,now=T0 + 3*INTERVAL)
+    assert times(out) == [ format_ts(T0 + i*INTERVAL) for i in range(3) ]
+    assert [ r['usage'] for r in sorted(out,key=lambda x: x['ts']) ] == [ 1, 1, 2 ]
+
+def test_last_sample_stands_for_at_most_max_age():
+    out = storage_series.expand([ row(T0,1) ],None,None,now=T0 + 10*MAX_AGE)
+    assert len(out) == MAX_AGE // INTERVAL
+    assert max(times(out)) < format_ts(T0 + MAX_AGE)
+
+def test_last_sample_stops_at_now():
+    out = storage_series.expand([ row(T0,1) ],None,None,now=T0 + INTERVAL + timedelta(minutes=1))
+    assert len(out) == 2
+
+def test_range_is_exclusive_and_needs_the_sample_before_it():
+    rows = [ row(T0,1), row(T0 + 3*INTERVAL,2) ]
+    out = storage_series.expand(rows,T0 + INTERVAL,T0 + 3*INTERVAL,now=T0 + 10*INTERVAL)
+    ### Filled in from the sample stored before the range started
+    assert times(out) == [ format_ts(T0 + 2*INTERVAL) ]
+    assert out[0]['usage'] == 1
+
+def test_series_are_expanded_separately():
+    rows = [ row(T0,1,'w40'), row(T0 + INTERVAL,5,'w41') ]
+    out = storage_series.expand(rows,None,None,now=T0 + 2*INTERVAL)
+    assert sorted([ ( r['project'], r['ts'] ) for r in out ]) == [ ( 'w40', format_ts(T0) ), ( 'w40', format_ts(T0 + INTERVAL) ), ( 'w41', format_ts(T0 + INTERVAL) ) ]
+
+def test_due():
+    previous = storage_series.sample(row(T0,100))
+    assert storage_series.due(None,row(T0,100))
+    assert not storage_series.due(previous,row(T0 + INTERVAL,100))
+    assert storage_series.due(previous,row(T0 + INTERVAL,101))
+    assert not storage_series.due(previous,row(T0 + REWRITE_AGE - timedelta(minutes=1),100))
+    assert storage_series.due(previous,row(T0 + REWRITE_AGE,100))
+    ### First sample of a new quarter
+    assert storage_series.due(storage_series.sample(row(datetime(2026,9,30,18,15),100)),row(datetime(2026,10,1,0,15),100))
+
+def test_unchanged_series_is_stored_again_within_max_age():
+    ### Runs start up to RUN_SLACK late, in any pattern
+    rng = random.Random(1)
+    runs = [ T0 + i*INTERVAL + rng.uniform(0,1)*RUN_SLACK for i in range(200) ]
+    stored = []
+    for t in runs:
+        entry = row(t,100)
+        if storage_series.due(storage_series.sample(stored[-1]) if stored else None,entry):
+            stored.append(entry)
+    assert len(stored) < len(runs)
+    stored_at = [ storage_series.parse_ts(r['ts']) for r in stored ]
+    assert max([ b - a for a,b in zip(stored_at,stored_at[1:]) ]) < MAX_AGE
+    ### So the series never drops out of a range
+    for t in runs[:-2]:
+        out = storage_series.expand(stored,t - timedelta(minutes=1),t - timedelta(minutes=1) + INTERVAL,now=runs[-1])
+        assert out
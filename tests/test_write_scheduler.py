@@ -0,0 +1,73 @@
+import asyncio
+
+import azure.cosmos.exceptions as cosmos_exceptions
+import pytest
+
+from clex_functional_accounting.lib.cosmosdb.aio import WriteScheduler
+
+def throttle(retry_after_ms: int) -> cosmos_exceptions.CosmosHttpResponseError:
+    e = cosmos_exceptions.CosmosHttpResponseError(status_code=429,message="throttled")
+    e.headers = { 'x-ms-retry-after-ms': str(retry_after_ms) }
+    return e
+
+class Service():
+    ### Throttles any request beyond capacity in flight at once
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.in_flight = 0
+        self.most_in_flight = 0
+        self.throttled = 0
+
+    async def request(self, i: int) -> int:
+        self.in_flight += 1
+        self.most_in_flight = max(self.most_in_flight,self.in_flight)
+        try:
+            if self.in_flight > self.capacity:
+                self.throttled += 1
+                raise throttle(1)
+            await asyncio.sleep(0.001)
+            return i
+        finally:
+            self.in_flight -= 1
+
+def run_all(scheduler: WriteScheduler, service: Service, n: int):
+    async def main():
+        return await asyncio.gather(*[ scheduler.run(service.request,i) for i in range(n) ])
+    return asyncio.run(main())
+
+def test_never_more_in_flight_than_the_window():
+    service = Service(capacity=1000)
+    scheduler = WriteScheduler(window=4,max_window=4)
+    assert run_all(scheduler,service,50) == list(range(50))
+    assert service.most_in_flight == 4
+
+def test_window_opens_when_nothing_is_throttled():
+    scheduler = WriteScheduler(window=2,max_window=64)
+    run_all(scheduler,Service(capacity=1000),200)
+    assert scheduler.window > 2
+
+def test_throttled_requests_are_retried_and_the_window_shrinks():
+    service = Service(capacity=3)
+    scheduler = WriteScheduler(window=16)
+    assert run_all(scheduler,service,200) == list(range(200))
+    assert service.throttled > 0
+    assert scheduler.throttled == service.throttled
+    assert scheduler.window < 16
+
+def test_other_errors_are_not_retried():
+    calls = []
+    async def fail():
+        calls.append(1)
+        raise cosmos_exceptions.CosmosHttpResponseError(status_code=400,message="bad request")
+    with pytest.raises(cosmos_exceptions.CosmosHttpResponseError):
+        asyncio.run(WriteScheduler().run(fail))
+    assert len(calls) == 1
+
+def test_gives_up_after_max_retries():
+    calls = []
+    async def busy():
+        calls.append(1)
+        raise throttle(1)
+    with pytest.raises(cosmos_exceptions.CosmosHttpResponseError):
+        asyncio.run(WriteScheduler(max_retries=3).run(busy))
+    assert len(calls) == 4